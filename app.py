@@ -1,55 +1,76 @@
-import contextlib
-import copy
-from datetime import datetime
 import logging
-import jinja2
-import json
 import os
 import re
 from sqlalchemy import exc
 import traceback
-import uuid
 
 from slack_bolt import App
-from slack_bolt.oauth import OAuthFlow
 from slack_bolt.oauth.oauth_settings import OAuthSettings
 from slack_bolt.adapter.flask import SlackRequestHandler
+from slack_sdk import WebClient
 
+import common
+from common import home_pusher, share_dispatcher
 import database
+import metrics
+import search
 import views
-import utilities
 
 from pprint import pprint
 
-app = App(
+# Setup and handler logic shared with async_app.py is in common.py
+
+def before_authorize(body, context, next):
+    return common.drop_duplicate(body, context) or next()
+
+class InstrumentedApp(App):
+    def dispatch(self, req):
+        with common.timed_dispatch(req):
+            return super().dispatch(req)
+
+app = InstrumentedApp(
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
-    oauth_settings=OAuthSettings(
-        client_id=os.environ["SLACK_CLIENT_ID"],
-        client_secret=os.environ["SLACK_CLIENT_SECRET"],
-        scopes=os.environ["SLACK_SCOPES"].split(",")
-    ),
-    oauth_flow=OAuthFlow.sqlite3(
-        database=os.environ["OAUTH_DATABASE_STR"],
-        token_rotation_expiration_minutes=60 * 24
-    ),
+    oauth_settings=OAuthSettings(**common.oauth_settings_args()),
+    before_authorize=before_authorize,
+    # Overridable so the app can be run against a stub Slack API, see loadtest.py
+    client=WebClient(base_url=os.environ.get("SLACK_API_URL", WebClient.BASE_URL)),
+    # Listener threads inherit the request being handled for metrics
+    listener_executor=metrics.ContextThreadPoolExecutor(max_workers=int(os.environ.get("LISTENER_WORKERS", 5))),
 )
-# Have to do this manually because it's not supported by the interfaces
-app.oauth_flow.settings.install_page_rendering_enabled = False
 
-# Logging setup
-logging.basicConfig(level=logging.INFO)
+# Remove installations on app_uninstalled and tokens_revoked, dropping them from the cache
+app.enable_token_revocation_listeners()
+
+# Authorize otherwise calls auth.test for every request, results are kept per token
+# Have to do this manually because it's not supported by the interfaces
+app.oauth_flow.settings.authorize.cache_enabled = True
 
 @app.middleware  # or app.use(log_request)
 def log_request(logger, body, next):
     logger.debug(body)
     return next()
 
+@app.middleware
+def record_authorize_latency(body, context, next):
+    common.record_authorize_latency(body, context)
+    return next()
+
+@app.middleware
+def instrument_client(context, next):
+    # Slack calls made by this request's listeners are counted against it
+    context["client"] = metrics.instrumentClient(context.client)
+    return next()
+
 # Flask setup
 from flask import Flask, request
 
 flask_app = Flask(__name__)
 handler = SlackRequestHandler(app)
 
+@flask_app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events():
     return handler.handle(request)
@@ -64,513 +85,285 @@ def install():
 def oauth_redirect():
     return handler.handle(request)
 
-# Preload templates
-delete_enviroment_template = json.load(open("templates/deleteEnvironment.json", "r"))
-modify_enviroment_template = json.load(open("templates/modifyEnvironment.json", "r"))
-error_template = json.load(open("templates/errorPage.json", "r"))
+common.start_schedulers()
 
-jinja_env = jinja2.Environment(
-    loader=jinja2.FileSystemLoader("templates"), autoescape=jinja2.select_autoescape()
-)
-jinja_env.tests['userHasbooking'] = utilities.userHasBooking
-jinja_env.tests['numberBookingsRemaining'] = utilities.numberBookingsRemaining
-jinja_env.globals.update({
-    "getCurrentTime" : utilities.getCurrentTime()
-})
-
-home_template = jinja_env.get_template("home.json")
-add_env_template = jinja_env.get_template("addEnvironment.json")
-share_env_template = jinja_env.get_template("shareEnvironment.json")
-booking_share_env_template = jinja_env.get_template("bookingShareMessage.json")
-manage_settings_template = jinja_env.get_template("manageSettings.json")
-book_env_template = jinja_env.get_template("bookEnvironment.json")
-add_resource_type_template = jinja_env.get_template("addResourceType.json")
-modify_resource_type_template = jinja_env.get_template("modifyResourceType.json")
-delete_resource_type_template = jinja_env.get_template("deleteResourceType.json")
-
-def refresh_home_template(organisationId, userId, client, resourceTypeId: int = None, timeZoneName: str = None):
-    resourceTypesData = list(database.getResourceTypes(organisationId))
-
-    # If no resources have been defined yet
-    if len(resourceTypesData) == 0:
-        result = home_template.render(
-            data={
-                "resourceTypesData": []
-            }
-        )
-        client.views_publish(user_id=userId, view=result)
-    
-    else:
+def getUserTimeZone(client, teamId, userId):
+    return common.cachedUserTimeZone(teamId, userId) or common.cacheUserTimeZone(teamId, userId, client.users_info(user = userId))
 
-        if resourceTypeId is None:
-            resourceTypeId = resourceTypesData[0][0]
-
-        resourceTypeData = next(
-            (
-                resourceType
-                for resourceType in resourceTypesData
-                if resourceType[0] == int(resourceTypeId)
-            ),
-            None,
-        )
-        environments = list(database.getEnvironments(organisationId, resourceTypeId, timeZoneName))
-
-        # If no environments have been defined yet
-        if len(environments) == 0:
-            result = home_template.render(
-                data={
-                    "resourceTypesData": resourceTypesData,
-                    "resourceTypeId": resourceTypeId,
-                    "resourceTypeName": resourceTypeData[1],
-                    "resourceTypeDescription": resourceTypeData[2],
-                    "userId": userId
-                },
-                isAdmin = userId in resourceTypeData[3]
-            )
-            client.views_publish(user_id=userId, view=result)
-        
-        else:
-            for index, environment in enumerate(environments):
-                # Get the bookings for each environment, and append them to the object
-                bookings = database.getBookings(organisationId, environment[0], resourceTypeId, timeZoneName=timeZoneName)
-                bookings = utilities.databaseResultToDict(bookings, 1)
-                validBookingKeys = utilities.getValidBookings(environment[3], environment[4], timeZoneName)
-                environments[index] = tuple(environment) + (bookings, validBookingKeys)
-
-            result = home_template.render(
-                data={
-                    "resourceTypesData": resourceTypesData,
-                    "resourceTypeId": resourceTypeId,
-                    "resourceTypeName": resourceTypeData[1],
-                    "resourceTypeDescription": resourceTypeData[2],
-                    "environments": environments,
-                    "validDates": None,
-                },
-                isAdmin = userId in resourceTypeData[3]
-            )
-
-            client.views_publish(user_id=userId, view=result)
+def getOrganisationId(client, teamId):
+    return common.cachedOrganisationId(teamId) or common.cacheOrganisationId(teamId, client.team_info())
+
+def refresh_home_template(organisationId, userId, client, resourceTypeId: int = None, timeZoneName: str = None, page: int = 0, environmentId: int = None):
+    result, environmentBookings, resourceTypeId = common.get_home_view(organisationId, userId, resourceTypeId, timeZoneName, page, environmentId)
+    client.views_publish(user_id=userId, view=result)
+    home_pusher.viewed(organisationId, userId, resourceTypeId, timeZoneName, page, environmentId)
+    return environmentBookings
+
+# Listeners ack first, rendering and Slack Web API calls then run as lazy listeners
+# Modal submissions that can return validation errors ack as soon as they're validated
+def acknowledge(ack):
+    ack()
+
+def acknowledge_clear(ack):
+    ack(response_action="clear")
+
+def refresh_home_from_view(body, client):
+    # Re-generate the home page for the resource type a modal was opened from
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    timeZoneName = getUserTimeZone(client, organisationId, userId)
+    return refresh_home_template(organisationId, userId, client, common.view_resource_type_id(body), timeZoneName)
+
+def publish_manage_settings(body, client):
+    result = common.manage_settings_view(database.getResourceTypes(body["team"]["id"]))
+    client.views_publish(user_id=body["user"]["id"], view=result)
+    home_pusher.left(body["team"]["id"], body["user"]["id"])
 
 @app.event("app_home_opened")
-def update_home_tab(client, event, logger):
+def update_home_tab(client, event, context, logger):
     try:
         # Try and get userId first as it's needed to display error
         userId = event["user"]
 
-        timeZoneName = client.users_info(user = userId).data
-        timeZoneName = timeZoneName['user']['tz']
-        teamData = client.team_info().data
-        organisationId = teamData["team"]["id"]
+        timeZoneName = getUserTimeZone(client, context.team_id, userId)
+        organisationId = getOrganisationId(client, context.team_id)
         refresh_home_template(organisationId, userId, client, timeZoneName=timeZoneName)
     except Exception as e:
         logging.error(e)
         print(traceback.format_exc())
-        error_template["blocks"][1]["text"]["text"] = str(e)
-        client.views_publish(user_id=userId, view=error_template)
-
+        client.views_publish(user_id=userId, view=common.error_view(e))
 
-@app.action(re.compile("button-book-clicked|message-button-book-clicked"))
-def handle_book_clicked(ack, body, client):
-    organisationId = body["team"]["id"]
-    userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    actionId = body['actions'][0]['action_id']
 
-    environmentId = None
+@app.event("user_change")
+def handle_user_change(event):
+    common.user_changed(event)
 
-    if actionId == 'message-button-book-clicked':
-        # Find the environmentId
-        environmentId = int(next(filter(lambda x: x['block_id'] == 'env_id', body["message"]["blocks"]), None)["accessory"]["value"])
-    elif actionId == 'button-book-clicked':
-        environmentId = body["actions"][0]["value"]
 
-    environment = database.getEnvironment(environmentId)
-    resourceTypeId = environment[3]
-
-    bookings = database.getBookings(organisationId, environmentId, resourceTypeId, timeZoneName=timeZoneName)
-    bookings = utilities.databaseResultToDict(bookings, 1)
-    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName)
-    environment = tuple(environment) + (bookings, validBookingKeys)
+def handle_book_clicked(body, client):
+    userId = body["user"]["id"]
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
 
-    result = book_env_template.render(
-        environment=environment,
-        resourceTypeId=resourceTypeId,
-        userId=userId
-    )
+    environment = views.get_environment_with_bookings(common.clicked_environment_id(body), timeZoneName)
+    client.views_open(trigger_id=body["trigger_id"], view=common.booking_modal(environment, userId))
 
-    client.views_open(trigger_id=body["trigger_id"], view=result)
-    ack()
+app.action(re.compile("button-book-clicked|message-button-book-clicked"))(ack=acknowledge, lazy=[handle_book_clicked])
 
 
-@app.action("create-booking")
-def handle_create_booking(ack, body, client):
+def handle_create_booking(body, client):
     organisationId = body["team"]["id"]
     environmentId = body["actions"][0]["value"]
-    environment = database.getEnvironment(environmentId)
-    resourceTypeId = environment[3]
     bookingKey = body["actions"][0]["block_id"]
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    database.addBooking(
-        environmentId, bookingKey, userId
-    )
-    print(f"Added booking - {environmentId}, {bookingKey}, {userId}")
-
-    bookings = database.getBookings(organisationId, environmentId, resourceTypeId, timeZoneName=timeZoneName)
-    bookings = utilities.databaseResultToDict(bookings, 1)
-    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName)
-    environment = tuple(environment) + (bookings, validBookingKeys)
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
+    result = database.addBooking(environmentId, bookingKey, userId)
+    if result == database.BOOKING_ADDED:
+        print(f"Added booking - {environmentId}, {bookingKey}, {userId}")
+    elif result == database.BOOKING_EXISTS:
+        # A repeated submit, the refreshed modal shows the booking
+        print(f"Already booked - {environmentId}, {bookingKey}, {userId}")
+    else:
+        # Someone else took the last place, the refreshed modal shows it as full
+        print(f"Booking full - {environmentId}, {bookingKey}, {userId}")
 
-    result = book_env_template.render(
-        environment=environment,
-        resourceTypeId=resourceTypeId,
-        userId=userId
-    )
+    environment = views.get_environment_with_bookings(environmentId, timeZoneName)
+    home_pusher.submit(organisationId, environment[3], client)
+    client.views_update(view_id=body["view"]["id"], view=common.booking_modal(environment, userId))
 
-    client.views_update(view_id=body["view"]["id"], view=result)
-    ack()
+app.action("create-booking")(ack=acknowledge, lazy=[handle_create_booking])
 
 
-@app.action("button-modify-environment")
-def action_modify_environment(ack, body, client):
-    organisationId = body["team"]["id"]
-    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
-    userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-
-    generated_template = copy.deepcopy(modify_enviroment_template)
-    generated_template["blocks"][0]["elements"][0][
-        "options"
-    ] = views.generate_environment_options(
-        database.getEnvironments(organisationId, resourceTypeId, timeZoneName)
-    )
-    titleStr = utilities.truncateString(f"Modify {resourceTypeName}")
-    generated_template["title"]["text"] = titleStr
-    generated_template["private_metadata"] = str(resourceTypeId)
+def action_modify_environment(body, client):
+    client.views_open(trigger_id=body["trigger_id"], view=common.modify_environment_modal(body))
 
-    client.views_open(trigger_id=body["trigger_id"], view=generated_template)
-    ack()
+app.action("button-modify-environment")(ack=acknowledge, lazy=[action_modify_environment])
 
-@app.action("button-share-environment")
-def action_handle_share_environment(ack, body, client):
-    organisationId = body["team"]["id"]
-    userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
-    environments = database.getEnvironments(organisationId, resourceTypeId, timeZoneName)
-
-    result = share_env_template.render(
-        environments = environments,
-        resourceTypeName = resourceTypeName
-    )
 
-    client.views_open(trigger_id=body["trigger_id"], view=result)
-    ack()
+def action_handle_share_environment(body, client):
+    client.views_open(trigger_id=body["trigger_id"], view=common.share_environment_modal(body))
 
+app.action("button-share-environment")(ack=acknowledge, lazy=[action_handle_share_environment])
 
 
 # This is the one from the home page
-@app.action("modify-resourcetype-select")
-def handle_resourcetype_select(ack, body, client):
+def handle_resourcetype_select(body, client):
     organisationId = body["team"]["id"]
     userId = body["user"]["id"]
     resourceTypeId = body["actions"][0]["selected_option"]["value"]
 
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
 
     print(f"Switching to resourceTypeId: {resourceTypeId}")
 
     # Re-generate the home page
     refresh_home_template(organisationId, userId, client, resourceTypeId, timeZoneName=timeZoneName)
 
-    ack()
+app.action("modify-resourcetype-select")(ack=acknowledge, lazy=[handle_resourcetype_select])
 
 
-@app.action(re.compile("environment-custom-add-more|environment-custom-remove-last|environment-custom-timepicker-change|booking-type-changed"))
-def handle_environment_custom_add_more(ack, body, client):
-    bookingType = body["view"]["state"]["values"]["env_booking_type"]["booking-type-changed"]["selected_option"]["value"]
-    resourceTypeId = int(body["view"]["private_metadata"])
-    resourceTypeName = body["view"]["title"]["text"]
-    
-    # Timepicker handling
-    actionId = body['actions'][0]['action_id']
-    bookingTimes = getEnvironmentTimes(body["view"]["state"]["values"])
-    if actionId == 'environment-custom-add-more':
-        if len(bookingTimes) < 23:
-            bookingTimes.append("00:00")
-    elif actionId == 'environment-custom-remove-last':
-        with contextlib.suppress(IndexError):
-            bookingTimes.pop()
-
-    result = add_env_template.render(
-        data={
-            "resourceTypeId": resourceTypeId,
-            "resourceTypeName": resourceTypeName,
-            "bookingType": bookingType,
-        },
-        bookingTimes=bookingTimes
-    )
-    client.views_update(view_id=body["view"]["id"], view=result)
-    ack()
+def handle_home_page(body, client):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    resourceTypeId, page = body["actions"][0]["value"].split(",")
 
-def getEnvironmentTimes(bodyState):
-    bookingTimes = []
-    for envKey in bodyState.keys():
-        if "env_custom_time" in envKey:
-            newTime = bodyState[envKey]['environment-custom-timepicker-change']['selected_time']
-            bookingTimes.append(newTime)
-    return bookingTimes
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
 
+    refresh_home_template(organisationId, userId, client, int(resourceTypeId), timeZoneName, page=int(page))
+
+app.action(re.compile("home-page-previous|home-page-next"))(ack=acknowledge, lazy=[handle_home_page])
 
-@app.action("modify-environment-select")
-def handle_modify_environment_select(ack, body, client):
-    resourceTypeId = int(body["view"]["private_metadata"])
-    organisationId = body["team"]["id"]
 
+# Type-ahead for the environment and resource type selects, answered from in-memory indexes
+# Options have to be returned in the ack so these aren't lazy
+@app.options(re.compile("modify-environment-select|delete-environment-select|modify-environment-share"))
+def handle_environment_options(ack, body, client):
+    organisationId = body["team"]["id"]
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
+    resourceTypeId = int(body["view"]["private_metadata"])
+    environments = search.searchEnvironments(organisationId, resourceTypeId, body["value"], timeZoneName)
+    ack(options=views.generate_select_options(environments))
+
+@app.options(re.compile("modify-modal-resourcetype-select|delete-resourcetype-select"))
+def handle_resourcetype_options(ack, body):
+    resourceTypes = search.searchResourceTypes(body["team"]["id"], body["value"])
+    ack(options=views.generate_select_options(resourceTypes))
+
 
+def handle_environment_custom_add_more(body, client):
+    client.views_update(view_id=body["view"]["id"], view=common.add_environment_times_modal(body))
+
+app.action(re.compile("environment-custom-add-more|environment-custom-remove-last|environment-custom-timepicker-change|booking-type-changed"))(ack=acknowledge, lazy=[handle_environment_custom_add_more])
+
+
+def handle_modify_environment_select(body, client):
     environmentId = body["actions"][0]["selected_option"]["value"]
     environmentName = body["actions"][0]["selected_option"]["text"]["text"]
 
     logging.info(f"Modifying environment {environmentId}:{environmentName}")
 
-    generated_template = copy.deepcopy(modify_enviroment_template)
-    generated_template["title"]["text"] = body["view"]["title"]["text"]
-    generated_template["private_metadata"] = str(resourceTypeId)
-    generated_template["blocks"][0]["elements"][0]["initial_option"] = body["actions"][
-        0
-    ]["selected_option"]
-    generated_template["blocks"][0]["elements"][0][
-        "options"
-    ] = views.generate_environment_options(
-        database.getEnvironments(organisationId, resourceTypeId, timeZoneName)
-    )
-    generated_template["blocks"] += views.generateModifyEnvironment(
-        database.getEnvironment(environmentId)
-    )
+    result = common.modify_environment_select_modal(body, database.getEnvironment(environmentId))
+    client.views_update(view_id=body["view"]["id"], view=result)
 
-    client.views_update(view_id=body["view"]["id"], view=generated_template)
-    ack()
+app.action("modify-environment-select")(ack=acknowledge, lazy=[handle_modify_environment_select])
 
 
-@app.action("remove-booking")
-def handle_remove_booking(ack, body, client):
+def handle_remove_booking(body, client):
     organisationId = body["team"]["id"]
     environmentId = body["actions"][0]["value"]
-    environment = database.getEnvironment(environmentId)
-    resourceTypeId = environment[3]
     bookingKey = body["actions"][0]["block_id"]
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
     database.removeBooking(
         environmentId, bookingKey, userId
     )
     print(f"Removed booking - {environmentId}, {bookingKey}, {userId}")
 
-    bookings = database.getBookings(organisationId, environmentId, resourceTypeId, timeZoneName=timeZoneName)
-    bookings = utilities.databaseResultToDict(bookings, 1)
-    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName)
-    environment = tuple(environment) + (bookings, validBookingKeys)
+    environment = views.get_environment_with_bookings(environmentId, timeZoneName)
+    home_pusher.submit(organisationId, environment[3], client)
+    client.views_update(view_id=body["view"]["id"], view=common.booking_modal(environment, userId))
 
-    result = book_env_template.render(
-        environment=environment,
-        resourceTypeId=resourceTypeId,
-        userId=userId
-    )
+app.action("remove-booking")(ack=acknowledge, lazy=[handle_remove_booking])
 
-    client.views_update(view_id=body["view"]["id"], view=result)
-    ack()
 
+def handle_my_bookings_clicked(body, client):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    timeZoneName = getUserTimeZone(client, organisationId, userId)
 
-@app.action("button-add-environment")
-def handle_add_env_clicked(ack, body, client):
-    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
-    result = add_env_template.render(
-        data={
-            "resourceTypeId": resourceTypeId,
-            "resourceTypeName": resourceTypeName,
-            "bookingType": "DAILY",
-        }
-    )
-    client.views_open(trigger_id=body["trigger_id"], view=result)
-    ack()
+    bookings = views.get_my_bookings(organisationId, userId, timeZoneName)
+    client.views_open(trigger_id=body["trigger_id"], view=common.my_bookings_modal(bookings))
 
+app.action("button-my-bookings")(ack=acknowledge, lazy=[handle_my_bookings_clicked])
 
-@app.action("button-delete-environment")
-def handle_delete_env_clicked(ack, body, client):
+
+def handle_my_bookings_cancel(body, client):
+    # Cancelled from the My bookings modal, only the modal is re-rendered
     organisationId = body["team"]["id"]
-    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
-    
+    resourceTypeId, environmentId, bookingKey = body["actions"][0]["value"].split(",", 2)
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-
-    generated_template = copy.deepcopy(delete_enviroment_template)
-    generated_template["private_metadata"] = str(resourceTypeId)
-    titleStr = utilities.truncateString(f"Delete {resourceTypeName}")
-    generated_template["title"]["text"] = titleStr
-    generated_template["blocks"][0]["element"][
-        "options"
-    ] = views.generate_environment_options(
-        database.getEnvironments(organisationId, resourceTypeId, timeZoneName)
-    )
-    client.views_open(trigger_id=body["trigger_id"], view=generated_template)
-    ack()
+    timeZoneName = getUserTimeZone(client, organisationId, userId)
+    try:
+        database.removeBooking(environmentId, bookingKey, userId)
+        print(f"Removed booking - {environmentId}, {bookingKey}, {userId}")
+        home_pusher.submit(organisationId, int(resourceTypeId), client)
+    except exc.NoResultFound:
+        # Already cancelled, by a double click or elsewhere while this process's cache was stale
+        print(f"Booking already removed - {environmentId}, {bookingKey}, {userId}")
+
+    # Read from the database so the modal drops bookings cancelled elsewhere
+    bookings = views.get_my_bookings(organisationId, userId, timeZoneName, fresh=True)
+    client.views_update(view_id=body["view"]["id"], view=common.my_bookings_modal(bookings))
+
+app.action("my-bookings-cancel")(ack=acknowledge, lazy=[handle_my_bookings_cancel])
+
+
+def handle_add_env_clicked(body, client):
+    client.views_open(trigger_id=body["trigger_id"], view=common.add_environment_modal(body))
+
+app.action("button-add-environment")(ack=acknowledge, lazy=[handle_add_env_clicked])
+
 
+def handle_delete_env_clicked(body, client):
+    client.views_open(trigger_id=body["trigger_id"], view=common.delete_environment_modal(body))
 
-@app.action("button-back")
-def handle_back_clicked(ack, body, client):
+app.action("button-delete-environment")(ack=acknowledge, lazy=[handle_delete_env_clicked])
+
+
+def handle_back_clicked(body, client):
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    teamData = client.team_info().data
-    organisationId = teamData["team"]["id"]
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
+    organisationId = getOrganisationId(client, body["team"]["id"])
     refresh_home_template(organisationId, userId, client, timeZoneName=timeZoneName)
-    ack()
 
+app.action("button-back")(ack=acknowledge, lazy=[handle_back_clicked])
 
-@app.action("button-manage-settings")
-def handle_settings_clicked(ack, body, client):
+
+def handle_settings_clicked(body, client):
     organisationId = body["team"]["id"]
-    resourceTypes = list(database.getResourceTypes(organisationId))
-    result = manage_settings_template.render(
-        data={"resourceTypes": resourceTypes},
-        modifyDeleteEnabled = False
-    )
+    result = common.manage_settings_view(database.getResourceTypes(organisationId), modifyDeleteEnabled = False)
     client.views_update(view_id=body["view"]["id"], view=result)
-    ack()
+    home_pusher.left(organisationId, body["user"]["id"])
 
+app.action("button-manage-settings")(ack=acknowledge, lazy=[handle_settings_clicked])
 
-@app.action("button-add-resourcetype")
-def handle_add_resourcetype_clicked(ack, body, client):
-    userId = body["user"]["id"]
-    result = add_resource_type_template.render(
-        userId=userId
-    )
-    client.views_open(trigger_id=body["trigger_id"], view=result)
-    ack()
 
-@app.action(re.compile("button-modify-resourcetype|modify-modal-resourcetype-select"))
-def handle_modify_resourcetype_clicked(ack, body, client):
+def handle_add_resourcetype_clicked(body, client):
+    client.views_open(trigger_id=body["trigger_id"], view=common.add_resource_type_modal(body))
+
+app.action("button-add-resourcetype")(ack=acknowledge, lazy=[handle_add_resourcetype_clicked])
+
+
+def handle_modify_resourcetype_clicked(body, client):
     actionId = body['actions'][0]['action_id']
-    pprint(f"Processing {actionId}")
-    userId = body["user"]["id"]
-    organisationId = body["team"]["id"]
-    resourceTypes = list(database.getResourceTypes(organisationId))
-
-    currentResourceType = None
-    blockIdSuffix = None
-    if actionId == "modify-modal-resourcetype-select":
-        resourceTypeId = int(body["view"]["state"]["values"]["resourcetype_id"]["modify-modal-resourcetype-select"]["selected_option"]["value"])
-        currentResourceType = next(
-            (
-                resourceType
-                for resourceType in resourceTypes
-                if resourceType[0] == resourceTypeId
-            ),
-            None,
-        )
-        blockIdSuffix = str(uuid.uuid4()) # Randomise block_ids to get around slack re-rendering bug
-        print(f"Switching to {currentResourceType[1]}")
-    elif actionId == "button-modify-resourcetype":
-        currentResourceType = resourceTypes[0] # Default to first element
-
-    # Check if user can modify the resource
-    canModifyResource = userId in currentResourceType[3]
-
-    result = modify_resource_type_template.render(
-        resourceTypes=resourceTypes,
-        currentResourceType=currentResourceType,
-        canModifyResource=canModifyResource,
-        blockIdSuffix = blockIdSuffix
-    )
+    result = common.modify_resource_type_modal(body, list(database.getResourceTypes(body["team"]["id"])))
 
     if actionId == "button-modify-resourcetype":
         client.views_open(trigger_id=body["trigger_id"], view=result)
     elif actionId == "modify-modal-resourcetype-select":
         client.views_update(view_id=body["view"]["id"], view=result)
-    ack()
 
-@app.action("button-delete-resourcetype")
-def handle_delete_resourcetype_clicked(ack, body, client):
-    organisationId = body["team"]["id"]
-    resourceTypes = list(database.getResourceTypes(organisationId))
-    result = delete_resource_type_template.render(
-        resourceTypes=resourceTypes,
-        currentResourceType=resourceTypes[0] # Default to first element
-    )
+app.action(re.compile("button-modify-resourcetype|modify-modal-resourcetype-select"))(ack=acknowledge, lazy=[handle_modify_resourcetype_clicked])
+
+
+def handle_delete_resourcetype_clicked(body, client):
+    result = common.delete_resource_type_modal(list(database.getResourceTypes(body["team"]["id"])))
     client.views_open(trigger_id=body["trigger_id"], view=result)
-    ack()
+
+app.action("button-delete-resourcetype")(ack=acknowledge, lazy=[handle_delete_resourcetype_clicked])
+
 
 @app.view("add-environment")
-def handle_add_environment(ack, body, client, view, logger):
-    resourceTypeId = int(body["view"]["private_metadata"])
+def handle_add_environment(ack, body, client):
     organisationId = body["team"]["id"]
-    userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    stateData = body["view"]["state"]["values"]
-    newEnvironment = stateData["env_name"]["plain_text_input-action"]["value"]
-    description = stateData["env_desc"]["plain_text_input-action"]["value"]
-    bookingType = stateData["env_booking_type"]["booking-type-changed"][
-        "selected_option"
-    ]["value"]
-    numberUsers = int(stateData["env_num_users"]["number_input-action"]["value"])
-
-    booking_settings = {}
-    if bookingType == "DAILY":
-        booking_settings = {
-            "numberDaysAdvance": int(
-                stateData["env_num_days"]["number_input-action"]["value"]
-            )
-        }
-    elif bookingType == "ONE-OFF":
-        # Check booking date isn't in the past
-        oneOffDate = stateData["env_oneoff_date"]["datepicker-action"]["selected_date_time"]
-        oneOffDateTime = datetime.fromtimestamp(oneOffDate)
-        currentDateTime = datetime.now()
-        if oneOffDateTime <= currentDateTime:
-            print(f"ONE-OFF booking is in the past {oneOffDateTime}")
-            errors = {
-                "env_oneoff_date":  "Cannot create bookings in the past"
-            }
-            ack(response_action="errors", errors=errors)
-            return
-        
-        booking_settings = {
-            "date": stateData["env_oneoff_date"]["datepicker-action"]["selected_date_time"]
-        }
-    elif bookingType == "CUSTOM":
-        # Timepicker handling
-        bookingTimes = getEnvironmentTimes(stateData)
-        # Raise an error if any bookingTimes have duplicates
-        if len(bookingTimes) != len(set(bookingTimes)):
-            # TODO: Work out a way to display these errors on the home screen
-            # Got a problem with inputs currently
-            print("Duplicates found")
-            errors = {
-                "env_custom_time_1":  "Duplicate times are not allowed"
-            }
-            ack(response_action="errors", errors=errors)
-            return
-        # 
-        booking_settings = {
-            "bookingTimes": bookingTimes,
-            "numberDaysAdvance": int(
-                stateData["env_num_days"]["number_input-action"]["value"]
-            )
-        }
-    
+    resourceTypeId = int(body["view"]["private_metadata"])
+    fields, errors = common.read_add_environment(body)
+    if errors:
+        ack(response_action="errors", errors=errors)
+        return
+
+    newEnvironment, description, bookingType, booking_settings, numberUsers = fields
     try:
-        database.addEnvironment(
+        environmentId = database.addEnvironment(
             newEnvironment,
             resourceTypeId,
             bookingType,
@@ -580,208 +373,121 @@ def handle_add_environment(ack, body, client, view, logger):
         )
     except Exception as e:
         pprint(e)
-        errors = {
-            "env_name": f"Environment {newEnvironment} already exists"
-        }
-        ack(response_action="errors", errors=errors)
-
-    # Re-generate the home page
-    refresh_home_template(organisationId, userId, client, resourceTypeId, timeZoneName=timeZoneName)
+        ack(response_action="errors", errors=common.environment_exists_errors(newEnvironment))
+        return
+    search.environmentAdded(organisationId, resourceTypeId, (environmentId,) + fields)
+    home_pusher.submit(organisationId, resourceTypeId, client)
 
+    # Validation needs a synchronous ack, the ack is sent before the home page refresh
     ack(response_action="clear")
+    refresh_home_from_view(body, client)
 
 
-@app.view("delete-environment")
-def handle_delete_environment(ack, body, client, view, logger):
-    organisationId = body["team"]["id"]
-    userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    resourceTypeId = int(body["view"]["private_metadata"])
-
-    delEnvironment = body["view"]["state"]["values"]["env_name"][
-        "static_select-action"
-    ]["selected_option"]["value"]
+def handle_delete_environment(body, client):
+    delEnvironment = common.read_delete_environment(body)
     logging.info(f"Trying to delete environment {delEnvironment}")
     database.deleteEnvironment(delEnvironment)
+    search.environmentDeleted(body["team"]["id"], body["view"]["private_metadata"], delEnvironment)
+    home_pusher.submit(body["team"]["id"], body["view"]["private_metadata"], client)
 
     # Re-generate the home page
-    refresh_home_template(organisationId, userId, client, resourceTypeId, timeZoneName)
+    refresh_home_from_view(body, client)
 
-    ack(response_action="clear")
+app.view("delete-environment")(ack=acknowledge_clear, lazy=[handle_delete_environment])
 
 
-@app.view("add-booking")
-def handle_add_booking(ack, body, client, view, logger):
+def handle_add_booking(body, client):
     organisationId = body["team"]["id"]
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
     resourceTypeId, environmentId = body["view"]["private_metadata"].split(",")
     resourceTypeId = int(resourceTypeId)
     environmentId = int(environmentId)
 
-    # Re-generate the home page
-    refresh_home_template(organisationId, userId, client, resourceTypeId, timeZoneName)
-
-    ack(response_action="clear")
-
-    # Get environment data and join bookings data onto it
-    environment = database.getEnvironment(environmentId)
-    bookings = database.getBookings(organisationId, environmentId, resourceTypeId, timeZoneName=timeZoneName)
-    bookings = utilities.databaseResultToDict(bookings, 1)
-    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName)
-    environment = tuple(environment) + (bookings, validBookingKeys)
-
-    result = booking_share_env_template.render(
-        environment = environment
+    # Re-generate the home page, on the page with the environment
+    environmentBookings = refresh_home_template(
+        organisationId, userId, client, resourceTypeId, timeZoneName, environmentId=environmentId
     )
 
-    # Find all references to shares to update them
+    environment = common.share_message_environment(database.getEnvironment(environmentId), environmentBookings, timeZoneName)
+    blocks = views.generate_booking_share_message(environment)
+
+    # Find all references to shares and queue updates for them
     for share in database.getShares(environmentId=environmentId):
         print(f"Updating channel {share[0]} {share[1]}")
-        try:
-            requestResult = client.chat_update(channel=share[0], ts=share[1], blocks=json.loads(result))
-        except Exception as e:
-            pprint(e)
-            print(f"Error updating channel {share[0]} {share[1]}")
-            
+        share_dispatcher.submit(organisationId, client, environmentId, share[0], share[1], blocks)
 
+app.view("add-booking")(ack=acknowledge_clear, lazy=[handle_add_booking])
 
-@app.view("modify-environment")
-def handle_modify_environment(ack, body, client, view, logger):
-    organisationId = body["team"]["id"]
-    userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
 
-    resourceTypeId = int(body["view"]["private_metadata"])
-
-    # Extract name and description keys
-    filtered_env_name = filter(
-        lambda x: "env_name_" in x, body["view"]["state"]["values"].keys()
-    )
-    env_name_key = list(filtered_env_name)[0]
-    filtered_env_description = filter(
-        lambda x: "env_description_" in x, body["view"]["state"]["values"].keys()
-    )
-    env_description_key = list(filtered_env_description)[0]
-
-    environmentId = body["view"]["state"]["values"]["env_id"][
-        "modify-environment-select"
-    ]["selected_option"]["value"]
-    environmentName = body["view"]["state"]["values"][env_name_key][
-        "plain_text_input-action"
-    ]["value"]
-    environmentDescription = body["view"]["state"]["values"][env_description_key][
-        "plain_text_input-action"
-    ]["value"]
+def handle_modify_environment(body, client):
+    environmentId, environmentName, environmentDescription = common.read_modify_environment(body)
 
     database.modifyEnvironment(environmentId, environmentName, environmentDescription)
+    search.environmentModified(body["team"]["id"], body["view"]["private_metadata"], environmentId, environmentName, environmentDescription)
+    home_pusher.submit(body["team"]["id"], body["view"]["private_metadata"], client)
 
     # Re-generate the home page
-    refresh_home_template(organisationId, userId, client, resourceTypeId, timeZoneName)
+    refresh_home_from_view(body, client)
 
-    ack(response_action="clear")
+app.view("modify-environment")(ack=acknowledge_clear, lazy=[handle_modify_environment])
 
 
 @app.view(re.compile("add-resource-type|modify-resource-type"))
-def handle_add_resource_type(ack, body, client, view, logger):
-    userId = body["user"]["id"]
+def handle_add_resource_type(ack, body, client):
     organisationId = body["team"]["id"]
-    actionId = body['view']['callback_id']
-
-    stateData = body["view"]["state"]["values"]
-
-    block_id = ""
-    if actionId == "modify-resource-type":
-         # Extract the random block id
-        block_id = utilities.extractBlockIdString(stateData, "resourcetype_name")
-        resourceTypeId = int(body["view"]["private_metadata"])
-    resourceTypeName = stateData[f"resourcetype_name{block_id}"]["plain_text_input-action"]["value"]
-    resourceTypeDesc = stateData[f"resourcetype_desc{block_id}"]["plain_text_input-action"]["value"]
-    resourceTypeAdministrators = stateData[f"resourcetype_admins{block_id}"]["multi_users_select-action"]["selected_users"]
-    
-    if len(resourceTypeAdministrators) == 0:
-        print("Adding current user as default administrator")
-        resourceTypeAdministrators.append(userId)
-    
+    block_id, resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators = common.read_resource_type(body)
+
     # Handle errors, most likely duplicate resource name
     try:
-        if actionId == "add-resource-type":
-            database.addResourceType(resourceTypeName, organisationId, resourceTypeDesc, resourceTypeAdministrators)
+        if resourceTypeId is None:
+            resourceTypeId = database.addResourceType(resourceTypeName, organisationId, resourceTypeDesc, resourceTypeAdministrators)
             print(f"Added resourceType {resourceTypeName}")
         else:
             database.modifyResourceType(resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators)
             print(f"Modified resourceType {resourceTypeId}")
     except exc.IntegrityError as e:
         print(f"Attempted to create duplicate resource type")
-        errors = {
-            f"resourcetype_name{block_id}": f"There's already a resource named {resourceTypeName}"
-        }
-        ack(response_action="errors", errors=errors)
+        ack(response_action="errors", errors=common.resource_type_exists_errors(block_id, resourceTypeName))
         return
+    search.resourceTypeSaved(organisationId, (resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators))
 
-    resourceTypes = list(database.getResourceTypes(organisationId))
-    result = manage_settings_template.render(data={"resourceTypes": resourceTypes})
-
-    client.views_publish(user_id=userId, view=result)
     ack(response_action="clear")
+    publish_manage_settings(body, client)
 
 @app.view("delete-resource-type")
-def handle_delete_resource_type(ack, body, client, view, logger):
+def handle_delete_resource_type(ack, body, client):
     userId = body["user"]["id"]
-    organisationId = body["team"]["id"]
-    stateData = body["view"]["state"]["values"]
-    resourceTypeId = int(stateData["resourcetype_name"]["static_select-action"]["selected_option"]["value"])
+    resourceTypeId = common.read_delete_resource_type(body)
     # Check if the user has access to delete this resource
     currentResourceType = database.getResourceType(resourceTypeId)
     print(f"resourceTypeId:{resourceTypeId}, {currentResourceType}")
     if userId in currentResourceType[3]:
         database.deleteResourceType(resourceTypeId)
+        search.resourceTypeDeleted(body["team"]["id"], resourceTypeId)
         print(f"Deleted resourceType {resourceTypeId}")
-        resourceTypes = list(database.getResourceTypes(organisationId))
-        result = manage_settings_template.render(data={"resourceTypes": resourceTypes})
-        userId = body["user"]["id"]
-        client.views_publish(user_id=userId, view=result)
         ack(response_action="clear")
+        publish_manage_settings(body, client)
     else:
-        errors = {
-            "resourcetype_name": "You don't have access to delete this"
-        }
-        ack(response_action="errors", errors=errors)
+        ack(response_action="errors", errors=common.DELETE_RESOURCE_TYPE_ERRORS)
         return
 
-@app.view("share-environment")
-def handle_share_environment(ack, body, client, view, logger):
-    stateData = body["view"]["state"]["values"]
-
-    selectedChannel = stateData["selected_channel"]["modify-channel-share"]["selected_channel"]
-    selectedEnv = int(stateData["selected_env"]["modify-environment-share"]["selected_option"]["value"])
-    
-    organisationId = body["team"]["id"]
+def handle_share_environment(body, client, logger):
+    selectedChannel, environmentId = common.read_share_environment(body)
     userId = body["user"]["id"]
-    timeZoneName = client.users_info(user = userId).data
-    timeZoneName = timeZoneName['user']['tz']
-    environmentId = stateData["selected_env"]["modify-environment-share"]["selected_option"]["value"]
+    timeZoneName = getUserTimeZone(client, body["team"]["id"], userId)
 
     # Get environment data and join bookings data onto it
-    environment = database.getEnvironment(environmentId)
-    bookings = database.getBookings(organisationId, environmentId, None, timeZoneName=timeZoneName)
-    bookings = utilities.databaseResultToDict(bookings, 1)
-    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName)
-    environment = tuple(environment) + (bookings, validBookingKeys)
+    environment = views.get_environment_with_bookings(environmentId, timeZoneName)
 
     pprint(environment)
 
-    result = booking_share_env_template.render(
-        environment = environment
-    )
+    blocks = views.generate_booking_share_message(environment)
 
-    print(f"Sharing {selectedEnv} to #{selectedChannel}")
+    print(f"Sharing {environmentId} to #{selectedChannel}")
     
     try:
-        result = client.chat_postMessage(channel=selectedChannel, blocks=json.loads(result))
+        result = client.chat_postMessage(channel=selectedChannel, blocks=blocks)
         database.addShare(
             environmentId=environment[0],
             channelId=result["channel"],
@@ -789,11 +495,11 @@ def handle_share_environment(ack, body, client, view, logger):
         )
     except Exception as e:
         logger.exception(f"Failed to post a message {e}")
-    
-    ack(response_action="clear")
+
+app.view("share-environment")(ack=acknowledge_clear, lazy=[handle_share_environment])
 
 # Start your app
 if __name__ == "__main__":
     app.start(3000)
     # from slack_bolt.adapter.socket_mode import SocketModeHandler
-    # SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
\ No newline at end of file
+    # SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
@@ -0,0 +1,544 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from sqlalchemy import exc
+import traceback
+
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
+from slack_bolt.adapter.asgi.async_handler import AsyncSlackRequestHandler
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk import WebClient
+
+import async_database
+import common
+from common import home_pusher, share_dispatcher
+import metrics
+import search
+import views
+
+# Async alternative to app.py, served over ASGI
+# uvicorn async_app:api --port 3000
+# Setup and handler logic shared with app.py is in common.py
+
+async def before_authorize(body, context, next):
+    return common.drop_duplicate(body, context) or await next()
+
+def track_request_tasks(loop, coro, **kwargs):
+    # Tasks started while handling a request are tracked against it, so its total
+    # duration covers listeners that carry on after ack() and lazy listeners
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    stats = metrics.current_request.get()
+    if stats is not None:
+        stats.begin()
+        task.add_done_callback(lambda task: stats.end())
+    return task
+
+class InstrumentedAsyncApp(AsyncApp):
+    async def async_dispatch(self, req):
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() is None:
+            loop.set_task_factory(track_request_tasks)
+        with common.timed_dispatch(req):
+            return await super().async_dispatch(req)
+
+app = InstrumentedAsyncApp(
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    oauth_settings=AsyncOAuthSettings(**common.oauth_settings_args()),
+    before_authorize=before_authorize,
+    # Overridable so the app can be run against a stub Slack API, see loadtest.py
+    client=AsyncWebClient(base_url=os.environ.get("SLACK_API_URL", AsyncWebClient.BASE_URL)),
+)
+
+# Remove installations on app_uninstalled and tokens_revoked, dropping them from the cache
+app.enable_token_revocation_listeners()
+
+# Authorize otherwise calls auth.test for every request, results are kept per token
+# Have to do this manually because it's not supported by the interfaces
+app.oauth_flow.settings.authorize.cache_enabled = True
+
+class InstrumentedAsyncWebClient(AsyncWebClient):
+    # Every Web API method goes through api_call
+    async def api_call(self, *args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return await super().api_call(*args, **kwargs)
+        finally:
+            metrics.recordSlackCall(time.perf_counter() - startTime)
+
+@app.middleware
+async def log_request(logger, body, next):
+    logger.debug(body)
+    return await next()
+
+@app.middleware
+async def record_authorize_latency(body, context, next):
+    common.record_authorize_latency(body, context)
+    return await next()
+
+@app.middleware
+async def instrument_client(context, next):
+    # Slack calls made by this request's listeners are counted against it
+    context["client"] = metrics.instrumentClient(context.client, InstrumentedAsyncWebClient)
+    return await next()
+
+# ASGI setup
+slack_handler = AsyncSlackRequestHandler(app)
+
+async def api(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == "/metrics":
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", metrics.CONTENT_TYPE.encode())],
+        })
+        await send({"type": "http.response.body", "body": metrics.render().encode()})
+        return
+    await slack_handler(scope, receive, send)
+
+common.start_schedulers()
+
+async def getUserTimeZone(client, teamId, userId):
+    return common.cachedUserTimeZone(teamId, userId) or common.cacheUserTimeZone(teamId, userId, await client.users_info(user = userId))
+
+async def getOrganisationId(client, teamId):
+    return common.cachedOrganisationId(teamId) or common.cacheOrganisationId(teamId, await client.team_info())
+
+async def refresh_home_template(organisationId, userId, client, resourceTypeId: int = None, timeZoneName: str = None, page: int = 0, environmentId: int = None):
+    # Rendering is database and CPU work, so it's kept off the event loop
+    result, environmentBookings, resourceTypeId = await async_database.runInThread(
+        common.get_home_view, organisationId, userId, resourceTypeId, timeZoneName, page, environmentId
+    )
+    await client.views_publish(user_id=userId, view=result)
+    home_pusher.viewed(organisationId, userId, resourceTypeId, timeZoneName, page, environmentId)
+    return environmentBookings
+
+def push_home_tabs(organisationId, resourceTypeId, client, context):
+    # The pusher runs on threads so is given a synchronous client
+    if home_pusher.enabled:
+        home_pusher.submit(organisationId, resourceTypeId, WebClient(token=context.bot_token, base_url=client.base_url))
+
+# Listeners ack first, rendering and Slack Web API calls then run as lazy listeners
+# Modal submissions that can return validation errors ack as soon as they're validated
+async def acknowledge(ack):
+    await ack()
+
+async def acknowledge_clear(ack):
+    await ack(response_action="clear")
+
+async def refresh_home_from_view(body, client):
+    # Re-generate the home page for the resource type a modal was opened from
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    timeZoneName = await getUserTimeZone(client, organisationId, userId)
+    return await refresh_home_template(organisationId, userId, client, common.view_resource_type_id(body), timeZoneName)
+
+async def publish_manage_settings(body, client):
+    result = common.manage_settings_view(await async_database.getResourceTypes(body["team"]["id"]))
+    await client.views_publish(user_id=body["user"]["id"], view=result)
+    home_pusher.left(body["team"]["id"], body["user"]["id"])
+
+@app.event("app_home_opened")
+async def update_home_tab(client, event, context, logger):
+    try:
+        # Try and get userId first as it's needed to display error
+        userId = event["user"]
+
+        timeZoneName, organisationId = await asyncio.gather(
+            getUserTimeZone(client, context.team_id, userId),
+            getOrganisationId(client, context.team_id)
+        )
+        await refresh_home_template(organisationId, userId, client, timeZoneName=timeZoneName)
+    except Exception as e:
+        logging.error(e)
+        print(traceback.format_exc())
+        await client.views_publish(user_id=userId, view=common.error_view(e))
+
+
+@app.event("user_change")
+async def handle_user_change(event):
+    common.user_changed(event)
+
+
+async def handle_book_clicked(body, client):
+    userId = body["user"]["id"]
+    timeZoneName = await getUserTimeZone(client, body["team"]["id"], userId)
+
+    environment = await async_database.runInThread(views.get_environment_with_bookings, common.clicked_environment_id(body), timeZoneName)
+    await client.views_open(trigger_id=body["trigger_id"], view=common.booking_modal(environment, userId))
+
+app.action(re.compile("button-book-clicked|message-button-book-clicked"))(ack=acknowledge, lazy=[handle_book_clicked])
+
+
+async def handle_create_booking(body, client, context):
+    environmentId = body["actions"][0]["value"]
+    bookingKey = body["actions"][0]["block_id"]
+    userId = body["user"]["id"]
+    # The timezone lookup and the insert don't depend on each other
+    timeZoneName, result = await asyncio.gather(
+        getUserTimeZone(client, body["team"]["id"], userId),
+        async_database.addBooking(environmentId, bookingKey, userId)
+    )
+    if result == async_database.BOOKING_ADDED:
+        print(f"Added booking - {environmentId}, {bookingKey}, {userId}")
+    elif result == async_database.BOOKING_EXISTS:
+        # A repeated submit, the refreshed modal shows the booking
+        print(f"Already booked - {environmentId}, {bookingKey}, {userId}")
+    else:
+        # Someone else took the last place, the refreshed modal shows it as full
+        print(f"Booking full - {environmentId}, {bookingKey}, {userId}")
+
+    environment = await async_database.runInThread(views.get_environment_with_bookings, environmentId, timeZoneName)
+    push_home_tabs(body["team"]["id"], environment[3], client, context)
+    await client.views_update(view_id=body["view"]["id"], view=common.booking_modal(environment, userId))
+
+app.action("create-booking")(ack=acknowledge, lazy=[handle_create_booking])
+
+
+async def action_modify_environment(body, client):
+    await client.views_open(trigger_id=body["trigger_id"], view=common.modify_environment_modal(body))
+
+app.action("button-modify-environment")(ack=acknowledge, lazy=[action_modify_environment])
+
+
+async def action_handle_share_environment(body, client):
+    await client.views_open(trigger_id=body["trigger_id"], view=common.share_environment_modal(body))
+
+app.action("button-share-environment")(ack=acknowledge, lazy=[action_handle_share_environment])
+
+
+# This is the one from the home page
+async def handle_resourcetype_select(body, client):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    resourceTypeId = body["actions"][0]["selected_option"]["value"]
+
+    timeZoneName = await getUserTimeZone(client, body["team"]["id"], userId)
+
+    print(f"Switching to resourceTypeId: {resourceTypeId}")
+
+    # Re-generate the home page
+    await refresh_home_template(organisationId, userId, client, resourceTypeId, timeZoneName=timeZoneName)
+
+app.action("modify-resourcetype-select")(ack=acknowledge, lazy=[handle_resourcetype_select])
+
+
+async def handle_home_page(body, client):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    resourceTypeId, page = body["actions"][0]["value"].split(",")
+
+    timeZoneName = await getUserTimeZone(client, body["team"]["id"], userId)
+
+    await refresh_home_template(organisationId, userId, client, int(resourceTypeId), timeZoneName, page=int(page))
+
+app.action(re.compile("home-page-previous|home-page-next"))(ack=acknowledge, lazy=[handle_home_page])
+
+
+# Type-ahead for the environment and resource type selects, answered from in-memory indexes
+# Options have to be returned in the ack so these aren't lazy
+@app.options(re.compile("modify-environment-select|delete-environment-select|modify-environment-share"))
+async def handle_environment_options(ack, body, client):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    timeZoneName = await getUserTimeZone(client, body["team"]["id"], userId)
+    resourceTypeId = int(body["view"]["private_metadata"])
+    # Indexes are loaded from the database on first use
+    environments = await async_database.runInThread(
+        search.searchEnvironments, organisationId, resourceTypeId, body["value"], timeZoneName
+    )
+    await ack(options=views.generate_select_options(environments))
+
+@app.options(re.compile("modify-modal-resourcetype-select|delete-resourcetype-select"))
+async def handle_resourcetype_options(ack, body):
+    resourceTypes = await async_database.runInThread(search.searchResourceTypes, body["team"]["id"], body["value"])
+    await ack(options=views.generate_select_options(resourceTypes))
+
+
+async def handle_environment_custom_add_more(body, client):
+    await client.views_update(view_id=body["view"]["id"], view=common.add_environment_times_modal(body))
+
+app.action(re.compile("environment-custom-add-more|environment-custom-remove-last|environment-custom-timepicker-change|booking-type-changed"))(ack=acknowledge, lazy=[handle_environment_custom_add_more])
+
+
+async def handle_modify_environment_select(body, client):
+    environmentId = body["actions"][0]["selected_option"]["value"]
+    environmentName = body["actions"][0]["selected_option"]["text"]["text"]
+
+    logging.info(f"Modifying environment {environmentId}:{environmentName}")
+
+    result = common.modify_environment_select_modal(body, await async_database.getEnvironment(environmentId))
+    await client.views_update(view_id=body["view"]["id"], view=result)
+
+app.action("modify-environment-select")(ack=acknowledge, lazy=[handle_modify_environment_select])
+
+
+async def handle_remove_booking(body, client, context):
+    environmentId = body["actions"][0]["value"]
+    bookingKey = body["actions"][0]["block_id"]
+    userId = body["user"]["id"]
+    # The timezone lookup and the delete don't depend on each other
+    timeZoneName, _ = await asyncio.gather(
+        getUserTimeZone(client, body["team"]["id"], userId),
+        async_database.removeBooking(environmentId, bookingKey, userId)
+    )
+    print(f"Removed booking - {environmentId}, {bookingKey}, {userId}")
+
+    environment = await async_database.runInThread(views.get_environment_with_bookings, environmentId, timeZoneName)
+    push_home_tabs(body["team"]["id"], environment[3], client, context)
+    await client.views_update(view_id=body["view"]["id"], view=common.booking_modal(environment, userId))
+
+app.action("remove-booking")(ack=acknowledge, lazy=[handle_remove_booking])
+
+
+async def handle_my_bookings_clicked(body, client):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    timeZoneName = await getUserTimeZone(client, organisationId, userId)
+
+    bookings = await async_database.runInThread(views.get_my_bookings, organisationId, userId, timeZoneName)
+    await client.views_open(trigger_id=body["trigger_id"], view=common.my_bookings_modal(bookings))
+
+app.action("button-my-bookings")(ack=acknowledge, lazy=[handle_my_bookings_clicked])
+
+
+async def handle_my_bookings_cancel(body, client, context):
+    # Cancelled from the My bookings modal, only the modal is re-rendered
+    organisationId = body["team"]["id"]
+    resourceTypeId, environmentId, bookingKey = body["actions"][0]["value"].split(",", 2)
+    userId = body["user"]["id"]
+    # The timezone lookup and the delete don't depend on each other
+    timeZoneName, removed = await asyncio.gather(
+        getUserTimeZone(client, organisationId, userId),
+        async_database.removeBooking(environmentId, bookingKey, userId),
+        return_exceptions=True
+    )
+    if isinstance(timeZoneName, BaseException):
+        raise timeZoneName
+    if isinstance(removed, exc.NoResultFound):
+        # Already cancelled, by a double click or elsewhere while this process's cache was stale
+        print(f"Booking already removed - {environmentId}, {bookingKey}, {userId}")
+    elif isinstance(removed, BaseException):
+        raise removed
+    else:
+        print(f"Removed booking - {environmentId}, {bookingKey}, {userId}")
+        push_home_tabs(organisationId, int(resourceTypeId), client, context)
+
+    # Read from the database so the modal drops bookings cancelled elsewhere
+    bookings = await async_database.runInThread(views.get_my_bookings, organisationId, userId, timeZoneName, fresh=True)
+    await client.views_update(view_id=body["view"]["id"], view=common.my_bookings_modal(bookings))
+
+app.action("my-bookings-cancel")(ack=acknowledge, lazy=[handle_my_bookings_cancel])
+
+
+async def handle_add_env_clicked(body, client):
+    await client.views_open(trigger_id=body["trigger_id"], view=common.add_environment_modal(body))
+
+app.action("button-add-environment")(ack=acknowledge, lazy=[handle_add_env_clicked])
+
+
+async def handle_delete_env_clicked(body, client):
+    await client.views_open(trigger_id=body["trigger_id"], view=common.delete_environment_modal(body))
+
+app.action("button-delete-environment")(ack=acknowledge, lazy=[handle_delete_env_clicked])
+
+
+async def handle_back_clicked(body, client):
+    userId = body["user"]["id"]
+    timeZoneName, organisationId = await asyncio.gather(
+        getUserTimeZone(client, body["team"]["id"], userId),
+        getOrganisationId(client, body["team"]["id"])
+    )
+    await refresh_home_template(organisationId, userId, client, timeZoneName=timeZoneName)
+
+app.action("button-back")(ack=acknowledge, lazy=[handle_back_clicked])
+
+
+async def handle_settings_clicked(body, client):
+    organisationId = body["team"]["id"]
+    result = common.manage_settings_view(await async_database.getResourceTypes(organisationId), modifyDeleteEnabled = False)
+    await client.views_update(view_id=body["view"]["id"], view=result)
+    home_pusher.left(organisationId, body["user"]["id"])
+
+app.action("button-manage-settings")(ack=acknowledge, lazy=[handle_settings_clicked])
+
+
+async def handle_add_resourcetype_clicked(body, client):
+    await client.views_open(trigger_id=body["trigger_id"], view=common.add_resource_type_modal(body))
+
+app.action("button-add-resourcetype")(ack=acknowledge, lazy=[handle_add_resourcetype_clicked])
+
+
+async def handle_modify_resourcetype_clicked(body, client):
+    actionId = body['actions'][0]['action_id']
+    result = common.modify_resource_type_modal(body, list(await async_database.getResourceTypes(body["team"]["id"])))
+
+    if actionId == "button-modify-resourcetype":
+        await client.views_open(trigger_id=body["trigger_id"], view=result)
+    elif actionId == "modify-modal-resourcetype-select":
+        await client.views_update(view_id=body["view"]["id"], view=result)
+
+app.action(re.compile("button-modify-resourcetype|modify-modal-resourcetype-select"))(ack=acknowledge, lazy=[handle_modify_resourcetype_clicked])
+
+
+async def handle_delete_resourcetype_clicked(body, client):
+    result = common.delete_resource_type_modal(list(await async_database.getResourceTypes(body["team"]["id"])))
+    await client.views_open(trigger_id=body["trigger_id"], view=result)
+
+app.action("button-delete-resourcetype")(ack=acknowledge, lazy=[handle_delete_resourcetype_clicked])
+
+
+@app.view("add-environment")
+async def handle_add_environment(ack, body, client, context):
+    organisationId = body["team"]["id"]
+    resourceTypeId = int(body["view"]["private_metadata"])
+    fields, errors = common.read_add_environment(body)
+    if errors:
+        await ack(response_action="errors", errors=errors)
+        return
+
+    newEnvironment, description, bookingType, booking_settings, numberUsers = fields
+    try:
+        environmentId = await async_database.addEnvironment(
+            newEnvironment,
+            resourceTypeId,
+            bookingType,
+            booking_settings,
+            numberUsers,
+            description=description,
+        )
+    except Exception as e:
+        print(e)
+        await ack(response_action="errors", errors=common.environment_exists_errors(newEnvironment))
+        return
+    search.environmentAdded(organisationId, resourceTypeId, (environmentId,) + fields)
+    push_home_tabs(organisationId, resourceTypeId, client, context)
+
+    # Validation needs a synchronous ack, the ack is sent before the home page refresh
+    await ack(response_action="clear")
+    await refresh_home_from_view(body, client)
+
+
+async def handle_delete_environment(body, client, context):
+    delEnvironment = common.read_delete_environment(body)
+    logging.info(f"Trying to delete environment {delEnvironment}")
+    await async_database.deleteEnvironment(delEnvironment)
+    search.environmentDeleted(body["team"]["id"], body["view"]["private_metadata"], delEnvironment)
+    push_home_tabs(body["team"]["id"], body["view"]["private_metadata"], client, context)
+
+    # Re-generate the home page
+    await refresh_home_from_view(body, client)
+
+app.view("delete-environment")(ack=acknowledge_clear, lazy=[handle_delete_environment])
+
+
+async def handle_add_booking(body, client, context):
+    organisationId = body["team"]["id"]
+    userId = body["user"]["id"]
+    resourceTypeId, environmentId = body["view"]["private_metadata"].split(",")
+    resourceTypeId = int(resourceTypeId)
+    environmentId = int(environmentId)
+    timeZoneName, environment, shares = await asyncio.gather(
+        getUserTimeZone(client, organisationId, userId),
+        async_database.getEnvironment(environmentId),
+        async_database.getShares(environmentId=environmentId)
+    )
+
+    # Re-generate the home page, on the page with the environment
+    environmentBookings = await refresh_home_template(
+        organisationId, userId, client, resourceTypeId, timeZoneName, environmentId=environmentId
+    )
+
+    environment = await async_database.runInThread(common.share_message_environment, environment, environmentBookings, timeZoneName)
+    blocks = views.generate_booking_share_message(environment)
+
+    # Queue updates for all references to shares
+    shareClient = WebClient(token=context.bot_token, base_url=client.base_url)
+    for share in shares:
+        print(f"Updating channel {share[0]} {share[1]}")
+        share_dispatcher.submit(organisationId, shareClient, environmentId, share[0], share[1], blocks)
+
+app.view("add-booking")(ack=acknowledge_clear, lazy=[handle_add_booking])
+
+
+async def handle_modify_environment(body, client, context):
+    environmentId, environmentName, environmentDescription = common.read_modify_environment(body)
+
+    await async_database.modifyEnvironment(environmentId, environmentName, environmentDescription)
+    search.environmentModified(body["team"]["id"], body["view"]["private_metadata"], environmentId, environmentName, environmentDescription)
+    push_home_tabs(body["team"]["id"], body["view"]["private_metadata"], client, context)
+
+    # Re-generate the home page
+    await refresh_home_from_view(body, client)
+
+app.view("modify-environment")(ack=acknowledge_clear, lazy=[handle_modify_environment])
+
+
+@app.view(re.compile("add-resource-type|modify-resource-type"))
+async def handle_add_resource_type(ack, body, client):
+    organisationId = body["team"]["id"]
+    block_id, resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators = common.read_resource_type(body)
+
+    # Handle errors, most likely duplicate resource name
+    try:
+        if resourceTypeId is None:
+            resourceTypeId = await async_database.addResourceType(resourceTypeName, organisationId, resourceTypeDesc, resourceTypeAdministrators)
+            print(f"Added resourceType {resourceTypeName}")
+        else:
+            await async_database.modifyResourceType(resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators)
+            print(f"Modified resourceType {resourceTypeId}")
+    except exc.IntegrityError as e:
+        print(f"Attempted to create duplicate resource type")
+        await ack(response_action="errors", errors=common.resource_type_exists_errors(block_id, resourceTypeName))
+        return
+    search.resourceTypeSaved(organisationId, (resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators))
+
+    await ack(response_action="clear")
+    await publish_manage_settings(body, client)
+
+@app.view("delete-resource-type")
+async def handle_delete_resource_type(ack, body, client):
+    userId = body["user"]["id"]
+    resourceTypeId = common.read_delete_resource_type(body)
+    # Check if the user has access to delete this resource
+    currentResourceType = await async_database.getResourceType(resourceTypeId)
+    print(f"resourceTypeId:{resourceTypeId}, {currentResourceType}")
+    if userId in currentResourceType[3]:
+        await async_database.deleteResourceType(resourceTypeId)
+        search.resourceTypeDeleted(body["team"]["id"], resourceTypeId)
+        print(f"Deleted resourceType {resourceTypeId}")
+        await ack(response_action="clear")
+        await publish_manage_settings(body, client)
+    else:
+        await ack(response_action="errors", errors=common.DELETE_RESOURCE_TYPE_ERRORS)
+        return
+
+async def handle_share_environment(body, client, logger):
+    selectedChannel, environmentId = common.read_share_environment(body)
+    userId = body["user"]["id"]
+    timeZoneName = await getUserTimeZone(client, body["team"]["id"], userId)
+
+    # Get environment data and join bookings data onto it
+    environment = await async_database.runInThread(views.get_environment_with_bookings, environmentId, timeZoneName)
+
+    blocks = views.generate_booking_share_message(environment)
+
+    print(f"Sharing {environmentId} to #{selectedChannel}")
+
+    try:
+        result = await client.chat_postMessage(channel=selectedChannel, blocks=blocks)
+        await async_database.addShare(
+            environmentId=environment[0],
+            channelId=result["channel"],
+            timestamp=result["ts"]
+        )
+    except Exception as e:
+        logger.exception(f"Failed to post a message {e}")
+
+app.view("share-environment")(ack=acknowledge_clear, lazy=[handle_share_environment])
+
+# Start your app
+if __name__ == "__main__":
+    app.start(3000)
@@ -0,0 +1,52 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import os
+
+import database
+
+# Async access to database.py for the ASGI entry point
+# Queries run on a thread pool no larger than the connection pool, so the
+# event loop never blocks on the database and threads never wait for a connection
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DATABASE_POOL_SIZE", 5)),
+    thread_name_prefix="database"
+)
+
+def runInThread(function, *args, **kwargs):
+    # Run in the caller's context so queries are counted against its request
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return loop.run_in_executor(executor, functools.partial(context.run, function, *args, **kwargs))
+
+def _asyncVersion(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await runInThread(function, *args, **kwargs)
+    return wrapper
+
+
+getResourceTypeVersion = _asyncVersion(database.getResourceTypeVersion)
+
+addResourceType = _asyncVersion(database.addResourceType)
+getResourceType = _asyncVersion(database.getResourceType)
+getResourceTypes = _asyncVersion(database.getResourceTypes)
+modifyResourceType = _asyncVersion(database.modifyResourceType)
+deleteResourceType = _asyncVersion(database.deleteResourceType)
+
+getEnvironment = _asyncVersion(database.getEnvironment)
+addEnvironment = _asyncVersion(database.addEnvironment)
+modifyEnvironment = _asyncVersion(database.modifyEnvironment)
+deleteEnvironment = _asyncVersion(database.deleteEnvironment)
+getEnvironments = _asyncVersion(database.getEnvironments)
+
+from database import BOOKING_ADDED, BOOKING_EXISTS, BOOKING_FULL
+addBooking = _asyncVersion(database.addBooking)
+removeBooking = _asyncVersion(database.removeBooking)
+getEnvironmentBookings = _asyncVersion(database.getEnvironmentBookings)
+getUserBookings = _asyncVersion(database.getUserBookings)
+
+addShare = _asyncVersion(database.addShare)
+getShares = _asyncVersion(database.getShares)
+deleteShare = _asyncVersion(database.deleteShare)
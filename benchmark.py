@@ -0,0 +1,674 @@
+# Benchmarks for the database and view code paths
+# Runs against its own temporary SQLite database, nothing is sent to Slack
+# python benchmark.py home-queries --environments 10,40,160
+import argparse
+import contextlib
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = {}
+TIME_ZONE = "Europe/London"
+CUSTOM_SETTINGS = {"numberDaysAdvance": 30, "bookingTimes": ["09:00", "13:00", "16:00"]}
+
+
+def benchmark(name: str):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def configureEnvironment(directory: str):
+    # database.py connects on import
+    os.environ.update({
+        "DATABASE_STR": f"sqlite:///{os.path.join(directory, 'bookings.db')}",
+    })
+
+
+def timeCall(function, repeat: int = 5) -> float:
+    # Median milliseconds per call
+    timings = []
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - startTime)
+    return statistics.median(timings) * 1000
+
+
+@contextlib.contextmanager
+def countQueries():
+    # Statements and bound parameters sent to the database inside the block
+    from sqlalchemy import event
+
+    import database
+
+    counts = {"queries": 0, "parameters": 0}
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        counts["queries"] += 1
+        counts["parameters"] += len(parameters or ())
+
+    event.listen(database.engine, "before_cursor_execute", count)
+    try:
+        yield counts
+    finally:
+        event.remove(database.engine, "before_cursor_execute", count)
+
+
+def seedResourceType(organisationId: str, environments: int, bookingsPerEnvironment: int, bookingType: str = "CUSTOM",
+                     bookingSettings: dict = None, capacity: int = 5) -> tuple:
+    # Returns the resource type id and its environment ids
+    import database
+    import utilities
+
+    bookingSettings = bookingSettings or CUSTOM_SETTINGS
+    resourceTypeId = database.addResourceType(f"Benchmark {organisationId}", organisationId, "Seeded by benchmark.py", [])
+    environmentIds = [
+        database.addEnvironment(f"Environment {index}", resourceTypeId, bookingType, bookingSettings, capacity)
+        for index in range(environments)
+    ]
+    bookingKeys = list(utilities.getValidBookings(bookingType, bookingSettings, TIME_ZONE))
+    for environmentId in environmentIds:
+        for index in range(bookingsPerEnvironment):
+            with contextlib.suppress(Exception):
+                database.addBooking(environmentId, random.choice(bookingKeys), f"U0BENCH{index}")
+    return resourceTypeId, environmentIds
+
+
+def printTable(header: tuple, rows: list):
+    widths = [max(len(str(value)) for value in column) + 2 for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("".join(f"{value:>{width}}" if index else f"{value:<{width}}" for index, (value, width) in enumerate(zip(row, widths))))
+
+
+# Benchmarks
+# -----------------------------------
+
+@benchmark("home-queries")
+def benchmarkHomeQueries(args):
+    # Bookings for every environment of a resource type in one query, against a
+    # getEnvironment and bookings query per environment as the home tab used to do
+    import database
+    import utilities
+
+    rows = []
+    for environments in args.environments:
+        organisationId = f"T0HOME{environments}"
+        resourceTypeId, environmentIds = seedResourceType(organisationId, environments, args.bookings)
+        validBookingKeys = {
+            environment[0]: utilities.getValidBookings(environment[3], environment[4], TIME_ZONE, environment[0])
+            for environment in database.getEnvironments(organisationId, resourceTypeId, TIME_ZONE)
+        }
+
+        def perEnvironment():
+            for environmentId, bookingKeys in validBookingKeys.items():
+                database.getEnvironment(environmentId)
+                database.getEnvironmentBookings({environmentId: bookingKeys})
+
+        def batched():
+            database.getEnvironmentBookings(validBookingKeys)
+
+        for name, function in (("per environment", perEnvironment), ("batched", batched)):
+            with countQueries() as counts:
+                function()
+            rows.append((environments, name, counts["queries"], f"{timeCall(function, args.repeat):.2f}"))
+    printTable(("environments", "path", "queries", "ms"), rows)
+
+
+@benchmark("sessions")
+def benchmarkSessions(args):
+    # Stress test of the session per call layer, threads adding and removing bookings
+    # on the same environment, fails if any call errors
+    import database
+    import utilities
+
+    _, environmentIds = seedResourceType("T0SESSIONS", 1, 0, capacity=max(args.threads) * args.operations)
+    bookingKey = next(iter(utilities.getValidBookings("CUSTOM", CUSTOM_SETTINGS, TIME_ZONE)))
+    rows = []
+    failed = False
+    for threads in args.threads:
+        errors = []
+
+        def worker(workerIndex):
+            for index in range(args.operations):
+                userId = f"U0SESSION{threads}.{workerIndex}.{index}"
+                try:
+                    database.addBooking(environmentIds[0], bookingKey, userId)
+                    database.removeBooking(environmentIds[0], bookingKey, userId)
+                except Exception as error:
+                    errors.append(error)
+
+        workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        startTime = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - startTime
+        rows.append((threads, threads * args.operations * 2, len(errors), f"{threads * args.operations * 2 / elapsed:.0f}"))
+        for error in errors[:3]:
+            print(f"  {type(error).__name__}: {error}")
+        failed = failed or len(errors) > 0
+    printTable(("threads", "calls", "errors", "calls/s"), rows)
+    return failed
+
+
+@benchmark("capacity")
+def benchmarkCapacity(args):
+    # Threads booking the last places of the same slots at once, fails if any slot ends
+    # up with more bookings than the environment's capacity. The same user submitting
+    # from every thread, as a double click does, must book each slot once without errors
+    import database
+    import utilities
+
+    capacity = 3
+    bookingKey = next(iter(utilities.getValidBookings("CUSTOM", CUSTOM_SETTINGS, TIME_ZONE)))
+    cases = (
+        ("different users", capacity, lambda workerIndex, index: f"U0CAPACITY{workerIndex}.{index}"),
+        ("same user", 1, lambda workerIndex, index: "U0CAPACITY"),
+    )
+    rows = []
+    failed = False
+    for case, maximumPerSlot, getUserId in cases:
+        for threads in args.threads:
+            _, environmentIds = seedResourceType(f"T0CAPACITY{case}{threads}", 4, 0, capacity=capacity)
+            results = []
+            errors = []
+            barrier = threading.Barrier(threads)
+
+            def worker(workerIndex):
+                barrier.wait()
+                for index in range(args.operations):
+                    try:
+                        userId = getUserId(workerIndex, index)
+                        results.append(database.addBooking(environmentIds[index % len(environmentIds)], bookingKey, userId))
+                    except Exception as error:
+                        errors.append(error)
+
+            workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+            startTime = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - startTime
+
+            booked = database.getEnvironmentBookings({environmentId: [bookingKey] for environmentId in environmentIds})
+            counts = [len(booked[environmentId].get(bookingKey, [])) for environmentId in environmentIds]
+            added = results.count(database.BOOKING_ADDED)
+            rows.append((case, threads, len(results) + len(errors), added, results.count(database.BOOKING_EXISTS), max(counts), len(errors), f"{elapsed * 1000:.0f}"))
+            for error in errors[:3]:
+                print(f"  {type(error).__name__}: {error}")
+            failed = failed or len(errors) > 0 or max(counts) > maximumPerSlot or added != sum(counts)
+    printTable(("case", "threads", "attempts", "booked", "already booked", f"max per slot (capacity {capacity})", "errors", "ms"), rows)
+    return failed
+
+
+@benchmark("query-plans")
+def benchmarkQueryPlans(args):
+    # EXPLAIN QUERY PLAN for every statement database.py sends, fails if any of them scans
+    # a table instead of searching an index. Paths that read every row of a table on purpose
+    # list it and are only allowed to scan that table
+    import datetime
+    import re
+    from sqlalchemy import event
+
+    import database
+    import utilities
+
+    if database.engine.dialect.name != "sqlite":
+        print(f"Skipped, plans are only checked on SQLite not {database.engine.dialect.name}")
+        return False
+
+    organisationId = "T0PLANS"
+    resourceTypeId, environmentIds = seedResourceType(organisationId, max(args.environments), args.bookings)
+    fullEnvironmentId = database.addEnvironment("Full", resourceTypeId, "CUSTOM", CUSTOM_SETTINGS, 1)
+    bookingKey = next(iter(utilities.getValidBookings("CUSTOM", CUSTOM_SETTINGS, TIME_ZONE)))
+    database.addBooking(fullEnvironmentId, bookingKey, "U0PLANSFULL")
+    for index in range(args.bookings):
+        database.addShare(environmentIds[index % len(environmentIds)], f"C0PLANS{index}", f"{index}.000100")
+    validBookingKeys = {
+        environment[0]: utilities.getValidBookings(environment[3], environment[4], TIME_ZONE, environment[0])
+        for environment in database.getEnvironments(organisationId, resourceTypeId, TIME_ZONE)
+    }
+    now = datetime.datetime.utcnow()
+    # Archives nothing, so later runs still have bookings to plan against
+    archiveBefore = now - datetime.timedelta(days=365)
+    # Another resource type to modify and delete, so the seeded one is left for the other paths
+    def deleteResourceType():
+        otherResourceTypeId, otherEnvironmentIds = seedResourceType(f"{organisationId}DELETE", 2, 2)
+        database.deleteEnvironment(otherEnvironmentIds[0])
+        database.deleteResourceType(otherResourceTypeId)
+
+    paths = (
+        ("startup", lambda: (database._addMissingResourceTypeVersions(), database._backfillBookingSlots()), {"resource_types"}),
+        ("getResourceTypeVersion", lambda: database.getResourceTypeVersion(organisationId), set()),
+        ("getResourceTypeVersion by id", lambda: database.getResourceTypeVersion(organisationId, resourceTypeId), set()),
+        ("getResourceType", lambda: database.getResourceType(resourceTypeId), set()),
+        ("getResourceTypes", lambda: database.getResourceTypes(organisationId), set()),
+        ("modifyResourceType", lambda: database.modifyResourceType(resourceTypeId, f"Benchmark {organisationId}", "Seeded by benchmark.py", []), set()),
+        ("addResourceType, addEnvironment, deleteEnvironment, deleteResourceType", deleteResourceType, set()),
+        ("getEnvironment", lambda: database.getEnvironment(environmentIds[0]), set()),
+        ("modifyEnvironment", lambda: database.modifyEnvironment(environmentIds[0], "Environment 0"), set()),
+        ("getEnvironments", lambda: database.getEnvironments(organisationId, resourceTypeId, TIME_ZONE), set()),
+        ("getAllEnvironments", lambda: database.getAllEnvironments(organisationId, resourceTypeId), set()),
+        ("getBookingSchedules", database.getBookingSchedules, {"environments"}),
+        ("getOneOffEnvironments", database.getOneOffEnvironments, set()),
+        ("bumpResourceTypeVersions", lambda: database.bumpResourceTypeVersions([resourceTypeId]), set()),
+        ("getEnvironmentBookings", lambda: database.getEnvironmentBookings(validBookingKeys), set()),
+        ("getUserBookings", lambda: database.getUserBookings(organisationId, "U0BENCH1"), set()),
+        ("addBooking", lambda: database.addBooking(environmentIds[0], bookingKey, "U0PLANS"), set()),
+        ("addBooking already booked", lambda: database.addBooking(environmentIds[0], bookingKey, "U0PLANS"), set()),
+        ("addBooking full", lambda: database.addBooking(fullEnvironmentId, bookingKey, "U0PLANS"), set()),
+        ("removeBooking", lambda: database.removeBooking(environmentIds[0], bookingKey, "U0PLANS"), set()),
+        ("archiveBookings", lambda: database.archiveBookings(archiveBefore), set()),
+        ("claimJobRun", lambda: database.claimJobRun("plans", now, now), set()),
+        ("addShare", lambda: database.addShare(environmentIds[0], "C0PLANS", "0.000100"), set()),
+        ("getShares", lambda: database.getShares(environmentIds[0]), set()),
+        ("deleteShare", lambda: database.deleteShare("C0PLANS1", "1.000100"), set()),
+        ("deleteStaleShares", lambda: database.deleteStaleShares(now), set()),
+    )
+    # SCAN CONSTANT ROW is a SELECT without a FROM, e.g. of an EXISTS
+    tableScan = re.compile(r"\bSCAN (?:TABLE )?(?!CONSTANT ROW)(\w+)")
+
+    failed = False
+    for name, function, wholeTables in paths:
+        statements = []
+
+        def capture(connection, cursor, statement, parameters, context, executemany):
+            if re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE)\b", statement) and not executemany:
+                statements.append((statement, parameters))
+
+        event.listen(database.engine, "before_cursor_execute", capture)
+        try:
+            database.user_bookings_cache.clear()
+            function()
+        finally:
+            event.remove(database.engine, "before_cursor_execute", capture)
+
+        print(name)
+        with database.engine.connect() as connection:
+            for statement, parameters in statements:
+                plan = [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+                scans = [detail for detail in plan if any(table not in wholeTables for table in tableScan.findall(detail))]
+                failed = failed or len(scans) > 0
+                print(f"  {'SCAN' if scans else 'ok'}: {' | '.join(plan) or statement.split()[0]}")
+    return failed
+
+
+@benchmark("slot-range")
+def benchmarkSlotRange(args):
+    # Bookings fetched as slot ranges per window, against the booking key IN-list the
+    # query used before, for CUSTOM environments with 24 slots a day at long horizons
+    from sqlalchemy import and_
+
+    import database
+    import utilities
+
+    def keyInList(validBookingKeys):
+        allBookingKeys = set()
+        for bookingKeys in validBookingKeys.values():
+            allBookingKeys.update(bookingKeys or {})
+        result = {environmentId: {} for environmentId in validBookingKeys}
+        with database.Session() as session:
+            bookings = list(session.query(Booking.environment, Booking.booking_key, Booking.user_id).where(
+                and_(
+                    Booking.environment.in_(validBookingKeys.keys()),
+                    Booking.booking_key.in_(allBookingKeys),
+                )
+            ))
+        for booking in bookings:
+            if booking[1] in (validBookingKeys[booking[0]] or {}):
+                result[booking[0]].setdefault(booking[1], []).append(booking)
+        return result
+
+    def sortedBookings(environmentBookings):
+        # The two queries return each slot's bookings in different orders
+        return {
+            environmentId: {bookingKey: sorted(map(tuple, bookings)) for bookingKey, bookings in bookingKeys.items()}
+            for environmentId, bookingKeys in environmentBookings.items()
+        }
+
+    Booking = database.Booking
+    environments = max(args.environments)
+    rows = []
+    for days in (7, 30, 60):
+        organisationId = f"T0SLOTRANGE{days}"
+        bookingSettings = {"numberDaysAdvance": days, "bookingTimes": [f"{hour:02d}:00" for hour in range(24)]}
+        resourceTypeId, _ = seedResourceType(organisationId, environments, args.bookings * 10, bookingSettings=bookingSettings)
+        validBookingKeys = {
+            environment[0]: utilities.getValidBookings(environment[3], environment[4], TIME_ZONE, environment[0])
+            for environment in database.getEnvironments(organisationId, resourceTypeId, TIME_ZONE)
+        }
+        if sortedBookings(keyInList(validBookingKeys)) != sortedBookings(database.getEnvironmentBookings(validBookingKeys)):
+            print(f"  {days} days: slot ranges returned different bookings to the IN-list")
+            return True
+
+        for name, function in (("key IN-list", keyInList), ("slot range", database.getEnvironmentBookings)):
+            with countQueries() as counts:
+                function(validBookingKeys)
+            rows.append((days, environments, name, counts["parameters"], f"{timeCall(lambda: function(validBookingKeys), args.repeat):.2f}"))
+    printTable(("days", "environments", "query", "parameters", "ms"), rows)
+
+
+@benchmark("delete")
+def benchmarkDelete(args):
+    # Deleting a large resource type with the set based deletes, against an ORM delete
+    # and version bump per environment as deleteResourceType used to do
+    import database
+
+    Booking, Environment, Share = database.Booking, database.Environment, database.Share
+    environments = max(args.environments)
+    bookingsPerEnvironment = args.bookings * 50
+
+    def seedBulk(organisationId):
+        resourceTypeId, environmentIds = seedResourceType(organisationId, environments, 0)
+        with database.engine.begin() as connection:
+            connection.execute(Booking.__table__.insert(), [
+                {"environment": environmentId, "booking_key": f"2000-01-01 {index}", "user_id": "U0BENCH"}
+                for environmentId in environmentIds for index in range(bookingsPerEnvironment)
+            ])
+            connection.execute(Share.__table__.insert(), [
+                {"environment": environmentId, "channel_id": "C0BENCH", "timestamp": f"{environmentId}.{index}"}
+                for environmentId in environmentIds for index in range(10)
+            ])
+        return resourceTypeId, environmentIds
+
+    def perEnvironment(resourceTypeId):
+        with database.Session.begin() as session:
+            for environmentId, in list(session.query(Environment.id).where(Environment.resource_type == resourceTypeId)):
+                session.execute(Booking.__table__.delete().where(Booking.environment == environmentId))
+                environment = session.query(Environment).filter(Environment.id == environmentId).one()
+                session.delete(environment)
+                database._bumpResourceTypeVersion(session, environment.resource_type)
+            resourceType = session.query(database.ResourceType).filter(database.ResourceType.id == resourceTypeId).one()
+            session.delete(resourceType)
+            session.query(database.ResourceTypeVersion).filter(database.ResourceTypeVersion.resource_type == resourceTypeId).delete()
+
+    rows = []
+    for name, function in (("per environment", perEnvironment), ("set based", database.deleteResourceType)):
+        resourceTypeId, environmentIds = seedBulk(f"T0DELETE{len(rows)}")
+        with countQueries() as counts:
+            startTime = time.perf_counter()
+            function(resourceTypeId)
+            elapsed = time.perf_counter() - startTime
+        with database.Session() as session:
+            sharesLeft = session.query(Share).filter(Share.environment.in_(environmentIds)).count()
+        rows.append((name, environments, environments * bookingsPerEnvironment, counts["queries"], sharesLeft, f"{elapsed * 1000:.0f}"))
+    printTable(("path", "environments", "bookings", "statements", "shares left", "ms"), rows)
+
+
+def referenceValidBookings(bookingType: str, bookingSettings: dict, tzName: str, now) -> dict:
+    # generateValidBookings as it was before schedules were compiled, going through
+    # datetime for every slot, kept as the reference for the slots check
+    from datetime import datetime, timedelta, timezone
+    from zoneinfo import ZoneInfo
+
+    now = now.astimezone(ZoneInfo(tzName))
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    days = [today] + [(today + timedelta(days=i)).replace(hour=0, minute=0, second=0, microsecond=0) for i in range(1, bookingSettings.get("numberDaysAdvance", 0))]
+    if bookingType == "DAILY":
+        return {day.strftime('%Y-%m-%d'): day.strftime('%a, %d %B') for day in days}
+    elif bookingType == "ONE-OFF":
+        bookingKey = datetime.utcfromtimestamp(bookingSettings["date"])
+        bookingDate = datetime.fromtimestamp(bookingSettings["date"], tz=ZoneInfo(tzName))
+        if bookingDate >= now:
+            return {bookingKey.strftime('%Y-%m-%d %H:%M'): bookingDate.strftime('%a, %d %B %H:%M')}
+        return None
+    results = {}
+    for day in days:
+        for bookingTime in bookingSettings['bookingTimes']:
+            hours, minutes = bookingTime.split(":")
+            result = day + timedelta(hours=int(hours), minutes=int(minutes))
+            results[result.astimezone(tz=timezone.utc).strftime('%Y-%m-%d %H:%M')] = result.strftime('%a, %d %B %H:%M')
+    return results
+
+
+@benchmark("slots")
+def benchmarkSlots(args):
+    # Compiled schedules against the datetime reference in every timezone, around each
+    # offset change from 2020 to 2030 and on ordinary days, fails on any difference
+    # Then the cost of compiling schedules and generating slots with each
+    from datetime import date, datetime, time as dayTime, timedelta
+    import tracemalloc
+    from zoneinfo import ZoneInfo, available_timezones
+
+    import utilities
+
+    configurations = (
+        ("DAILY", {"numberDaysAdvance": 7}),
+        # Times either side of the usual change times, including ones skipped or repeated
+        ("CUSTOM", {"numberDaysAdvance": 7, "bookingTimes": ["00:00", "00:30", "01:00", "01:30", "02:00", "02:30", "03:00", "12:00", "23:30", "23:59"]}),
+    )
+    schedules = [(bookingType, bookingSettings, utilities.BookingSchedule(bookingType, bookingSettings)) for bookingType, bookingSettings in configurations]
+
+    checked = 0
+    mismatches = []
+    timeZoneNames = sorted(available_timezones())
+    for tzName in timeZoneNames:
+        zone = ZoneInfo(tzName)
+        # Local dates the offset changes on, each checked from a few days before
+        startDates = [date(2020, 1, 15), date(2025, 7, 15)]
+        day = date(2020, 1, 1)
+        offset = datetime.combine(day, dayTime(), zone).utcoffset()
+        while day < date(2030, 1, 1):
+            nextOffset = datetime.combine(day + timedelta(days=1), dayTime(), zone).utcoffset()
+            if nextOffset != offset:
+                startDates.append(day - timedelta(days=3))
+            day, offset = day + timedelta(days=1), nextOffset
+        for startDate in startDates:
+            for hour in (0, 13):
+                now = datetime.combine(startDate, dayTime(hour, 30), zone)
+                for bookingType, bookingSettings, schedule in schedules:
+                    expected = referenceValidBookings(bookingType, bookingSettings, tzName, now)
+                    actual = utilities.generateValidBookings(schedule, tzName, now)
+                    checked += 1
+                    # Order matters too, the modal lists slots in it
+                    if list(expected.items()) != list(actual.items()):
+                        mismatches.append((tzName, now, bookingType, set(expected.items()) ^ set(actual.items())))
+    print(f"{checked} windows checked in {len(timeZoneNames)} timezones, {len(mismatches)} differ")
+    for tzName, now, bookingType, difference in mismatches[:5]:
+        print(f"  {tzName} {now.isoformat()} {bookingType}: {sorted(difference)[:4]}")
+
+    # Compiling and generating, the reference parses the settings on every call
+    customSettings = {"numberDaysAdvance": 60, "bookingTimes": [f"{hour:02d}:00" for hour in range(23)]}
+    now = datetime.now(ZoneInfo(TIME_ZONE))
+    schedule = utilities.BookingSchedule("CUSTOM", customSettings)
+    compile = timeCall(lambda: [utilities.BookingSchedule("CUSTOM", customSettings) for _ in range(1000)], args.repeat)
+    reference = timeCall(lambda: referenceValidBookings("CUSTOM", customSettings, TIME_ZONE, now), args.repeat)
+    compiled = timeCall(lambda: utilities.generateValidBookings(schedule, TIME_ZONE, now), args.repeat)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [utilities.BookingSchedule("CUSTOM", customSettings) for _ in range(1000)]
+    scheduleBytes = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    before = tracemalloc.take_snapshot()
+    kept = [{"numberDaysAdvance": 60, "bookingTimes": [f"{hour:02d}:00" for hour in range(23)]} for _ in range(1000)]
+    settingsBytes = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+    del kept
+
+    printTable(("CUSTOM, 60 days, 23 times a day", "value"), [
+        ("compile schedule us", f"{compile:.2f}"),
+        ("schedule bytes", scheduleBytes // 1000),
+        ("settings dict bytes", settingsBytes // 1000),
+        ("reference generate ms", f"{reference:.2f}"),
+        ("compiled generate ms", f"{compiled:.2f}"),
+    ])
+    return len(mismatches) > 0
+
+
+@benchmark("valid-bookings")
+def benchmarkValidBookings(args):
+    # Generating booking windows against the cached lookup, per booking type and horizon
+    import database
+    import utilities
+
+    customTimes = [f"{hour:02d}:00" for hour in range(23)]
+    rows = []
+    for days in (7, 30, 60):
+        configurations = (
+            ("DAILY", {"numberDaysAdvance": days}),
+            ("CUSTOM", {"numberDaysAdvance": days, "bookingTimes": customTimes}),
+            ("ONE-OFF", {"date": int(time.time()) + days * 24 * 60 * 60}),
+        )
+        for environmentId, (bookingType, bookingSettings) in enumerate(configurations):
+            # Environment ids as the app passes them, so the compiled schedule is reused
+            environmentId += days * 10
+            schedule = utilities.getSchedule(bookingType, bookingSettings, environmentId)
+            uncached = timeCall(lambda: [utilities.generateValidBookings(schedule, TIME_ZONE) for _ in range(100)], args.repeat)
+            utilities.getValidBookings(bookingType, bookingSettings, TIME_ZONE, environmentId)
+            cached = timeCall(lambda: [utilities.getValidBookings(bookingType, bookingSettings, TIME_ZONE, environmentId) for _ in range(100)], args.repeat)
+            slots = len(utilities.generateValidBookings(schedule, TIME_ZONE))
+            rows.append((bookingType, days, slots, f"{uncached * 10:.1f}", f"{cached * 10:.1f}"))
+    printTable(("type", "days", "slots", "uncached us", "cached us"), rows)
+
+    # Hit rate over the lookups of repeated home renders, the first render fills the cache
+    organisationId = "T0VALIDBOOKINGS"
+    resourceTypeId, _ = seedResourceType(organisationId, max(args.environments), 0)
+
+    def homeLookups():
+        for environment in database.getEnvironments(organisationId, resourceTypeId, TIME_ZONE):
+            utilities.getValidBookings(environment[3], environment[4], TIME_ZONE, environment[0])
+
+    utilities.valid_bookings_cache.clear()
+    before = utilities.valid_bookings_cache.stats()
+    for _ in range(args.repeat):
+        homeLookups()
+    after = utilities.valid_bookings_cache.stats()
+    hits = after["hits"] - before["hits"]
+    misses = after["misses"] - before["misses"]
+    print(f"{args.repeat} home renders of {max(args.environments)} environments: {hits} hits, {misses} misses, {hits / (hits + misses):.1%} hit rate")
+
+
+@benchmark("availability")
+def benchmarkAvailability(args):
+    # Remaining places and the user's own bookings for every slot, per slot with
+    # numberBookingsRemaining and userHasBooking as the views used to, against building
+    # utilities.Availability and reading each environment's rows
+    import utilities
+
+    userId = "U0BENCH0"
+    configurations = [(count, CUSTOM_SETTINGS) for count in args.environments]
+    configurations.append((max(args.environments), {"numberDaysAdvance": 30, "bookingTimes": [f"{hour:02d}:00" for hour in range(8, 20)]}))
+    rows = []
+    mismatches = 0
+    for numberEnvironments, bookingSettings in configurations:
+        validBookingKeys = utilities.getValidBookings("CUSTOM", bookingSettings, TIME_ZONE)
+        keys = list(validBookingKeys)
+        environments = [(environmentId, 5, validBookingKeys) for environmentId in range(numberEnvironments)]
+        bookings = {}
+        for environmentId in range(numberEnvironments):
+            environmentBookings = bookings.setdefault(environmentId, {})
+            for index in range(args.bookings):
+                bookingKey = random.choice(keys)
+                slotBookings = environmentBookings.setdefault(bookingKey, [])
+                if len(slotBookings) < 5:
+                    slotBookings.append((environmentId, bookingKey, f"U0BENCH{index % 3}"))
+
+        def perSlot():
+            return [
+                (utilities.numberBookingsRemaining(bookings[environment[0]].get(bookingKey, []), environment[1]),
+                 utilities.userHasBooking(bookings[environment[0]].get(bookingKey, []), userId))
+                for environment in environments for bookingKey in environment[2]
+            ]
+
+        def availabilityRows():
+            availability = utilities.Availability(environments, bookings, userId)
+            return [
+                (remaining, hasBooking == 1)
+                for environment in environments for remaining, hasBooking in zip(*availability.row(environment[0]))
+            ]
+
+        expected = perSlot()
+        mismatches += sum(1 for pair in zip(expected, availabilityRows()) if pair[0] != pair[1])
+        build = timeCall(lambda: utilities.Availability(environments, bookings, userId), args.repeat)
+        rows.append((numberEnvironments, f"{len(expected):,}", f"{timeCall(perSlot, args.repeat):.2f}",
+                     f"{build:.2f}", f"{timeCall(availabilityRows, args.repeat):.2f}"))
+    printTable(("environments", "slots", "per-slot ms", "build ms", "build and rows ms"), rows)
+    print(f"{mismatches} cells differ")
+    return mismatches > 0
+
+
+# The environment blocks of the home tab as the Jinja template rendered them before the
+# Block Kit builders, kept here as the baseline for the render benchmark
+JINJA_HOME_BOOKINGS = """{% for environment in data['environments'] %}
+{
+    "type": "header",
+    "text": {"type": "plain_text", "text": "# {{ environment[1] }}"}
+},
+{
+    "type": "section",
+    "text": {"type": "mrkdwn", "text": "{% if environment[2] %}{{ environment[2] }}{% endif %}\\n{% for bookingKey in environment[7] %}- {{ environment[7][bookingKey] }} {% if bookingKey in environment[6].keys() %}{% for booking in environment[6][bookingKey] %}<@{{ booking[2] }}> {% endfor %}{% else %}:free:{% endif %}\\n{% endfor %}"},
+    "accessory": {
+        "type": "button",
+        "text": {"type": "plain_text", "text": "Book {{ environment[1] | truncate(24) }}", "emoji": true},
+        "value": "{{ environment[0] }}",
+        "action_id": "button-book-clicked",
+    },
+},
+{% endfor %}"""
+
+@benchmark("render")
+def benchmarkRender(args):
+    # Home view built as Block Kit dicts and serialised, against the Jinja template text
+    import jinja2
+
+    import utilities
+    import views
+
+    template = jinja2.Environment().from_string(JINJA_HOME_BOOKINGS)
+    validBookingKeys = utilities.getValidBookings("CUSTOM", CUSTOM_SETTINGS, TIME_ZONE)
+    rows = []
+    for numberBookings in (10, 100, 1000):
+        environments = []
+        for environmentId in range(10):
+            bookings = {}
+            for index in range(numberBookings // 10):
+                bookingKey = random.choice(list(validBookingKeys))
+                bookings.setdefault(bookingKey, []).append((environmentId, bookingKey, f"U0BENCH{index}"))
+            environments.append((environmentId, f"Environment {environmentId}", "Description", "CUSTOM", CUSTOM_SETTINGS, 5, bookings, validBookingKeys))
+
+        jinja = timeCall(lambda: template.render(data={"environments": environments}), args.repeat)
+        builders = timeCall(lambda: views.serialize(views.generate_home_view([(1, "Rooms", None, [])], 1, "Rooms", None, environments)), args.repeat)
+        rows.append((numberBookings, len(environments), f"{jinja:.2f}", f"{builders:.2f}"))
+    printTable(("bookings", "environments", "jinja ms", "builders ms"), rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the database and view code paths")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help=f"Any of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--environments", default="10,40,160", help="Comma separated environment counts")
+    parser.add_argument("--bookings", type=int, default=20, help="Bookings to seed per environment")
+    parser.add_argument("--threads", default="1,4,16", help="Comma separated thread counts")
+    parser.add_argument("--operations", type=int, default=50, help="Add and remove pairs per thread")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per measurement, the median is reported")
+    args = parser.parse_args()
+    args.environments = [int(value) for value in args.environments.split(",")]
+    args.threads = [int(value) for value in args.threads.split(",")]
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks {', '.join(unknown)}")
+
+    # Templates are loaded relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    configureEnvironment(tempfile.mkdtemp(prefix="benchmark-"))
+    # Benchmarks that check correctness return True when they fail
+    failed = []
+    for name in args.benchmarks:
+        print(f"\n{name}")
+        if BENCHMARKS[name](args):
+            failed.append(name)
+    if failed:
+        print(f"\nFailed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+import contextlib
+import copy
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import logging
+import os
+import time
+import uuid
+
+from slack_bolt import BoltResponse
+from slack_sdk.oauth.installation_store.sqlite3 import SQLite3InstallationStore
+from slack_sdk.oauth.state_store.sqlite3 import SQLite3OAuthStateStore
+
+import cache
+import database
+import dispatcher
+import idempotency
+import installations
+import metrics
+import retention
+import rollover
+import views
+from views import (
+    add_env_template,
+    add_resource_type_template,
+    delete_enviroment_template,
+    delete_resource_type_template,
+    error_template,
+    manage_settings_template,
+    modify_enviroment_template,
+    modify_resource_type_template,
+    render_home_template,
+    share_env_template,
+)
+import utilities
+
+# Setup and handler logic shared by app.py and async_app.py
+# The entry points only register the sync or async listeners, which do their Slack
+# and database calls and leave the rest to the functions here
+
+# Authorize reads the installation on every request, so lookups are cached
+TOKEN_ROTATION_EXPIRATION_MINUTES = 60 * 24
+installation_store = installations.CachedInstallationStore(
+    SQLite3InstallationStore(
+        database=os.environ["OAUTH_DATABASE_STR"],
+        client_id=os.environ["SLACK_CLIENT_ID"]
+    ),
+    ttl=int(os.environ.get("INSTALLATION_CACHE_TTL_SECONDS", 60 * 5)),
+    tokenRotationExpirationMinutes=TOKEN_ROTATION_EXPIRATION_MINUTES
+)
+
+def oauth_settings_args():
+    # Passed to OAuthSettings or AsyncOAuthSettings
+    return dict(
+        client_id=os.environ["SLACK_CLIENT_ID"],
+        client_secret=os.environ["SLACK_CLIENT_SECRET"],
+        scopes=os.environ["SLACK_SCOPES"].split(","),
+        installation_store=installation_store,
+        state_store=SQLite3OAuthStateStore(
+            database=os.environ["OAUTH_DATABASE_STR"],
+            expiration_seconds=60 * 10
+        ),
+        token_rotation_expiration_minutes=TOKEN_ROTATION_EXPIRATION_MINUTES,
+        install_page_rendering_enabled=False
+    )
+
+def drop_duplicate(body, context):
+    # Runs once the request is verified, dropping duplicate deliveries and Slack's
+    # retries before any database or Slack work
+    # Returns the response to send for a duplicate, None to carry on
+    if idempotency.isDuplicate(body):
+        metrics.duplicate_requests.inc(metrics.getRequestName(body))
+        logging.info(f"Dropping duplicate request {idempotency.getRequestKey(body)}")
+        return BoltResponse(status=200, body="")
+    context["authorize_started"] = time.perf_counter()
+    return None
+
+@contextlib.contextmanager
+def timed_dispatch(req):
+    # Middleware next() only marks a middleware as passed, the listeners run once the
+    # whole chain has returned, so requests are timed around dispatch instead
+    stats = metrics.RequestStats(metrics.getRequestName(req.body))
+    token = metrics.current_request.set(stats)
+    try:
+        # Listeners return as soon as ack() is called, so this is the time to ack
+        yield stats
+    finally:
+        metrics.current_request.reset(token)
+        metrics.ack_latency.observe(stats.name, time.perf_counter() - stats.startTime)
+        stats.dispatched()
+
+def record_authorize_latency(body, context):
+    # Runs straight after authorize, which is skipped for some requests like url_verification
+    if "authorize_started" in context:
+        metrics.authorize_latency.observe(metrics.getRequestName(body), time.perf_counter() - context["authorize_started"])
+
+# Time database queries for the metrics endpoint
+metrics.instrumentEngine(database.engine)
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+
+# Cache of Slack user timezones and team info to save Web API calls
+user_timezone_cache = cache.TTLCache(
+    maxSize=int(os.environ.get("USER_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("USER_CACHE_TTL_SECONDS", 60 * 60))
+)
+team_info_cache = cache.TTLCache(
+    maxSize=int(os.environ.get("TEAM_CACHE_SIZE", 1000)),
+    ttl=int(os.environ.get("TEAM_CACHE_TTL_SECONDS", 60 * 60 * 24))
+)
+
+# Rendered home views, short TTL as ONE-OFF environments expire during the day
+home_view_cache = cache.TTLCache(
+    maxSize=int(os.environ.get("HOME_CACHE_SIZE", 1000)),
+    ttl=int(os.environ.get("HOME_CACHE_TTL_SECONDS", 60 * 5))
+)
+
+# Shared messages are updated in the background, rate limited per workspace
+# The dispatchers run on threads so are always given a synchronous client
+share_dispatcher = dispatcher.ShareUpdateDispatcher(
+    workers=int(os.environ.get("SHARE_UPDATE_WORKERS", 4)),
+    ratePerMinute=int(os.environ.get("SHARE_UPDATE_RATE_PER_MINUTE", 50))
+)
+
+# Opt in to pushing re-rendered home tabs to recent viewers when bookings or environments change
+home_pusher = dispatcher.HomePushDispatcher(
+    render=lambda *args: get_home_view(*args)[0],
+    enabled=os.environ.get("HOME_PUSH_ENABLED", "false").lower() == "true",
+    workers=int(os.environ.get("HOME_PUSH_WORKERS", 2)),
+    ratePerMinute=int(os.environ.get("HOME_PUSH_RATE_PER_MINUTE", 100)),
+    delaySeconds=float(os.environ.get("HOME_PUSH_DELAY_SECONDS", 2)),
+    viewerTtl=int(os.environ.get("HOME_PUSH_VIEWER_TTL_SECONDS", 60 * 30))
+)
+
+def start_schedulers():
+    # Archive past bookings and prune stale shares, 0 to disable and run retention.py from cron instead
+    retentionIntervalSeconds = int(os.environ.get("RETENTION_INTERVAL_SECONDS", 60 * 60 * 6))
+    if retentionIntervalSeconds > 0:
+        retention.startScheduler(retentionIntervalSeconds)
+
+    # Warm each timezone's booking windows at its midnight and expire ONE-OFF environments as they start
+    if os.environ.get("ROLLOVER_ENABLED", "true").lower() == "true":
+        rollover.startScheduler()
+
+# Slack lookups
+# -----------------------------------
+# The entry points make the Web API call on a miss and pass the response to be cached
+
+def cachedUserTimeZone(teamId, userId):
+    return user_timezone_cache.get((teamId, userId))
+
+def cacheUserTimeZone(teamId, userId, response):
+    timeZoneName = response.data['user']['tz']
+    user_timezone_cache.set((teamId, userId), timeZoneName)
+    logging.debug(f"users_info cache miss {user_timezone_cache.stats()}")
+    return timeZoneName
+
+def cachedOrganisationId(teamId):
+    return team_info_cache.get(teamId)
+
+def cacheOrganisationId(teamId, response):
+    organisationId = response.data["team"]["id"]
+    team_info_cache.set(teamId, organisationId)
+    logging.debug(f"team_info cache miss {team_info_cache.stats()}")
+    return organisationId
+
+def user_changed(event):
+    # Users timezone may have changed so drop any cached value
+    # Matched on userId alone, as users can be shared across workspaces
+    userId = event["user"]["id"]
+    user_timezone_cache.invalidateWhere(lambda key: key[1] == userId)
+
+# Views
+# -----------------------------------
+# Synchronous, the async app runs those that touch the database in a thread
+
+def get_home_view(organisationId, userId, resourceTypeId: int = None, timeZoneName: str = None, page: int = 0, environmentId: int = None):
+    # Rendered views are cached until the resource type's data version changes
+    # Shows the given page of environments, or the page with environmentId on it
+    # Returns the view, its bookings and the resource type shown
+    cacheKey = None
+    dataVersion = database.getResourceTypeVersion(organisationId, resourceTypeId)
+    if dataVersion is not None:
+        resourceTypeId, version, administrators = dataVersion
+        localDate = datetime.now(ZoneInfo(timeZoneName)).date()
+        cacheKey = (organisationId, resourceTypeId, timeZoneName, localDate, userId in administrators, version, page, environmentId)
+        cached = home_view_cache.get(cacheKey)
+        if cached is not None:
+            return cached + (resourceTypeId,)
+
+    result, environmentBookings = render_home_template(organisationId, userId, resourceTypeId, timeZoneName, page, environmentId)
+    if cacheKey is not None:
+        home_view_cache.set(cacheKey, (result, environmentBookings))
+    return result, environmentBookings, resourceTypeId
+
+def error_view(error):
+    error_template["blocks"][1]["text"]["text"] = str(error)
+    return error_template
+
+def view_resource_type_id(body):
+    # The resource type a modal was opened from
+    return int(body["view"]["private_metadata"].split(",")[0])
+
+def clicked_environment_id(body):
+    actionId = body['actions'][0]['action_id']
+    if actionId == 'message-button-book-clicked':
+        # Find the environmentId
+        return int(next(filter(lambda x: x['block_id'] == 'env_id', body["message"]["blocks"]), None)["accessory"]["value"])
+    elif actionId == 'button-book-clicked':
+        return body["actions"][0]["value"]
+    return None
+
+def booking_modal(environment, userId):
+    return views.serialize(views.generate_booking_modal(environment, environment[3], userId))
+
+def my_bookings_modal(bookings):
+    return views.serialize(views.generate_my_bookings_modal(bookings))
+
+def modify_environment_modal(body):
+    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
+
+    # Environments are loaded as the user types, see handle_environment_options
+    generated_template = copy.deepcopy(modify_enviroment_template)
+    titleStr = utilities.truncateString(f"Modify {resourceTypeName}")
+    generated_template["title"]["text"] = titleStr
+    generated_template["private_metadata"] = str(resourceTypeId)
+    return generated_template
+
+def modify_environment_select_modal(body, environment):
+    resourceTypeId = int(body["view"]["private_metadata"])
+
+    generated_template = copy.deepcopy(modify_enviroment_template)
+    generated_template["title"]["text"] = body["view"]["title"]["text"]
+    generated_template["private_metadata"] = str(resourceTypeId)
+    generated_template["blocks"][0]["elements"][0]["initial_option"] = body["actions"][
+        0
+    ]["selected_option"]
+    generated_template["blocks"] += views.generateModifyEnvironment(environment)
+    return generated_template
+
+def share_environment_modal(body):
+    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
+
+    return share_env_template.render(
+        resourceTypeId = resourceTypeId,
+        resourceTypeName = resourceTypeName
+    )
+
+def add_environment_modal(body):
+    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
+    return add_env_template.render(
+        data={
+            "resourceTypeId": resourceTypeId,
+            "resourceTypeName": resourceTypeName,
+            "bookingType": "DAILY",
+        }
+    )
+
+def add_environment_times_modal(body):
+    bookingType = body["view"]["state"]["values"]["env_booking_type"]["booking-type-changed"]["selected_option"]["value"]
+    resourceTypeId = int(body["view"]["private_metadata"])
+    resourceTypeName = body["view"]["title"]["text"]
+
+    # Timepicker handling
+    actionId = body['actions'][0]['action_id']
+    bookingTimes = utilities.getEnvironmentTimes(body["view"]["state"]["values"])
+    if actionId == 'environment-custom-add-more':
+        if len(bookingTimes) < 23:
+            bookingTimes.append("00:00")
+    elif actionId == 'environment-custom-remove-last':
+        with contextlib.suppress(IndexError):
+            bookingTimes.pop()
+
+    return add_env_template.render(
+        data={
+            "resourceTypeId": resourceTypeId,
+            "resourceTypeName": resourceTypeName,
+            "bookingType": bookingType,
+        },
+        bookingTimes=bookingTimes
+    )
+
+def delete_environment_modal(body):
+    resourceTypeId, resourceTypeName = body["actions"][0]["value"].split(",")
+
+    generated_template = copy.deepcopy(delete_enviroment_template)
+    generated_template["private_metadata"] = str(resourceTypeId)
+    titleStr = utilities.truncateString(f"Delete {resourceTypeName}")
+    generated_template["title"]["text"] = titleStr
+    return generated_template
+
+def manage_settings_view(resourceTypes, **options):
+    return manage_settings_template.render(data={"resourceTypes": list(resourceTypes)}, **options)
+
+def add_resource_type_modal(body):
+    return add_resource_type_template.render(
+        userId=body["user"]["id"]
+    )
+
+def modify_resource_type_modal(body, resourceTypes):
+    actionId = body['actions'][0]['action_id']
+    print(f"Processing {actionId}")
+    userId = body["user"]["id"]
+
+    currentResourceType = None
+    blockIdSuffix = None
+    if actionId == "modify-modal-resourcetype-select":
+        resourceTypeId = int(body["view"]["state"]["values"]["resourcetype_id"]["modify-modal-resourcetype-select"]["selected_option"]["value"])
+        currentResourceType = next(
+            (
+                resourceType
+                for resourceType in resourceTypes
+                if resourceType[0] == resourceTypeId
+            ),
+            None,
+        )
+        blockIdSuffix = str(uuid.uuid4()) # Randomise block_ids to get around slack re-rendering bug
+        print(f"Switching to {currentResourceType[1]}")
+    elif actionId == "button-modify-resourcetype":
+        currentResourceType = resourceTypes[0] # Default to first element
+
+    # Check if user can modify the resource
+    canModifyResource = userId in currentResourceType[3]
+
+    return modify_resource_type_template.render(
+        currentResourceType=currentResourceType,
+        canModifyResource=canModifyResource,
+        blockIdSuffix = blockIdSuffix
+    )
+
+def delete_resource_type_modal(resourceTypes):
+    return delete_resource_type_template.render(
+        currentResourceType=resourceTypes[0] # Default to first element
+    )
+
+def share_message_environment(environment, environmentBookings, timeZoneName):
+    # Join bookings data onto the environment
+    # Re-use the bookings already loaded for the home page
+    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName, environment[0])
+    bookings = (environmentBookings or {}).get(environment[0])
+    if bookings is None:
+        bookings = database.getEnvironmentBookings({environment[0]: validBookingKeys})[environment[0]]
+    return tuple(environment) + (bookings, validBookingKeys)
+
+# Modal submissions
+# -----------------------------------
+
+def read_add_environment(body):
+    # Returns the new environment's fields, or the errors to show
+    stateData = body["view"]["state"]["values"]
+    newEnvironment = stateData["env_name"]["plain_text_input-action"]["value"]
+    description = stateData["env_desc"]["plain_text_input-action"]["value"]
+    bookingType = stateData["env_booking_type"]["booking-type-changed"][
+        "selected_option"
+    ]["value"]
+    numberUsers = int(stateData["env_num_users"]["number_input-action"]["value"])
+
+    booking_settings, errors = utilities.getBookingSettings(bookingType, stateData)
+    return (newEnvironment, description, bookingType, booking_settings, numberUsers), errors
+
+def environment_exists_errors(environmentName):
+    return {
+        "env_name": f"Environment {environmentName} already exists"
+    }
+
+def read_delete_environment(body):
+    return body["view"]["state"]["values"]["env_name"][
+        "delete-environment-select"
+    ]["selected_option"]["value"]
+
+def read_modify_environment(body):
+    # Extract name and description keys
+    filtered_env_name = filter(
+        lambda x: "env_name_" in x, body["view"]["state"]["values"].keys()
+    )
+    env_name_key = list(filtered_env_name)[0]
+    filtered_env_description = filter(
+        lambda x: "env_description_" in x, body["view"]["state"]["values"].keys()
+    )
+    env_description_key = list(filtered_env_description)[0]
+
+    environmentId = body["view"]["state"]["values"]["env_id"][
+        "modify-environment-select"
+    ]["selected_option"]["value"]
+    environmentName = body["view"]["state"]["values"][env_name_key][
+        "plain_text_input-action"
+    ]["value"]
+    environmentDescription = body["view"]["state"]["values"][env_description_key][
+        "plain_text_input-action"
+    ]["value"]
+    return environmentId, environmentName, environmentDescription
+
+def read_resource_type(body):
+    # Returns the block id suffix, the resource type id when modifying and the submitted fields
+    userId = body["user"]["id"]
+    actionId = body['view']['callback_id']
+
+    stateData = body["view"]["state"]["values"]
+
+    block_id = ""
+    resourceTypeId = None
+    if actionId == "modify-resource-type":
+         # Extract the random block id
+        block_id = utilities.extractBlockIdString(stateData, "resourcetype_name")
+        resourceTypeId = int(body["view"]["private_metadata"])
+    resourceTypeName = stateData[f"resourcetype_name{block_id}"]["plain_text_input-action"]["value"]
+    resourceTypeDesc = stateData[f"resourcetype_desc{block_id}"]["plain_text_input-action"]["value"]
+    resourceTypeAdministrators = stateData[f"resourcetype_admins{block_id}"]["multi_users_select-action"]["selected_users"]
+
+    if len(resourceTypeAdministrators) == 0:
+        print("Adding current user as default administrator")
+        resourceTypeAdministrators.append(userId)
+    return block_id, resourceTypeId, resourceTypeName, resourceTypeDesc, resourceTypeAdministrators
+
+def resource_type_exists_errors(block_id, resourceTypeName):
+    return {
+        f"resourcetype_name{block_id}": f"There's already a resource named {resourceTypeName}"
+    }
+
+def read_delete_resource_type(body):
+    stateData = body["view"]["state"]["values"]
+    return int(stateData["resourcetype_name"]["delete-resourcetype-select"]["selected_option"]["value"])
+
+DELETE_RESOURCE_TYPE_ERRORS = {
+    "resourcetype_name": "You don't have access to delete this"
+}
+
+def read_share_environment(body):
+    # Returns the channel and environment to share
+    stateData = body["view"]["state"]["values"]
+
+    selectedChannel = stateData["selected_channel"]["modify-channel-share"]["selected_channel"]
+    environmentId = stateData["selected_env"]["modify-environment-share"]["selected_option"]["value"]
+    return selectedChannel, environmentId
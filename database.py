@@ -4,28 +4,51 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     JSON,
     Integer,
     String,
     and_,
+    bindparam,
     create_engine,
+    exists,
     func,
+    inspect,
+    literal,
+    or_,
+    select,
+    text,
     UniqueConstraint,
     CheckConstraint,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import PendingRollbackError, IntegrityError, NoResultFound
+from sqlalchemy.exc import DatabaseError, IntegrityError, NoResultFound
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
 
 import datetime
 import os
 
+import cache
 import utilities
 
-engine = create_engine(
-    os.environ["DATABASE_STR"], poolclass=SingletonThreadPool, echo=False
-)
+def createEngine(databaseStr: str):
+    # In-memory SQLite only exists on a single connection so can't be pooled
+    databaseUrl = make_url(databaseStr)
+    if databaseUrl.get_backend_name() == "sqlite" and databaseUrl.database in (None, "", ":memory:"):
+        return create_engine(databaseStr, poolclass=SingletonThreadPool, echo=False)
+    return create_engine(
+        databaseStr,
+        poolclass=QueuePool,
+        pool_size=int(os.environ.get("DATABASE_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DATABASE_MAX_OVERFLOW", 10)),
+        pool_timeout=int(os.environ.get("DATABASE_POOL_TIMEOUT", 30)),
+        pool_pre_ping=os.environ.get("DATABASE_POOL_PRE_PING", "true").lower() == "true",
+        echo=False,
+    )
+
+engine = createEngine(os.environ["DATABASE_STR"])
 
 Base = declarative_base()
 
@@ -48,7 +71,8 @@ class Environment(Base):
     name = Column(String)
     description = Column(String, nullable=True)
     resource_type = Column(Integer, ForeignKey("resource_types.id"), index=True)
-    booking_type = Column(String)
+    # ONE-OFF environments are looked up by the rollover job, see getOneOffEnvironments
+    booking_type = Column(String, index=True)
     booking_settings = Column(JSON)
     maximum_users = Column(Integer)
     __table_args__ = (
@@ -62,7 +86,25 @@ class Booking(Base):
     environment = Column(Integer, ForeignKey("environments.id"), index=True)
     user_id = Column(String)
     booking_key = Column(String, index=True)
-    __table_args__ = (UniqueConstraint("environment", "booking_key", "user_id", name="uix_env_date"),)
+    # Start of the booked slot, so windows of bookings can be fetched as a range
+    slot = Column(DateTime, nullable=True, index=True)
+    # uix_env_date also serves lookups by environment and booking key
+    __table_args__ = (
+        UniqueConstraint("environment", "booking_key", "user_id", name="uix_env_date"),
+        # A user's upcoming bookings, see getUserBookings
+        Index("ix_bookings_user_slot", "user_id", "slot"),
+        Index("ix_bookings_environment_slot", "environment", "slot"),
+    )
+
+# Past bookings are moved here by the retention job
+class ArchivedBooking(Base):
+    __tablename__ = "archived_bookings"
+    id = Column(Integer, primary_key=True)
+    environment = Column(Integer, index=True)
+    user_id = Column(String)
+    booking_key = Column(String)
+    slot = Column(DateTime)
+    archived = Column(DateTime, default=datetime.datetime.utcnow)
 
 # Used to record references to shares to update them later
 class Share(Base):
@@ -75,88 +117,209 @@ class Share(Base):
 		DateTime(timezone=True),
 		default=datetime.datetime.utcnow
 	)
+    __table_args__ = (Index("ix_shares_channel_timestamp", "channel_id", "timestamp"),)
+
+# Bumped whenever anything shown on a resource type's home page changes
+# Used as a cache key for rendered views
+class ResourceTypeVersion(Base):
+    __tablename__ = "resource_type_versions"
+    resource_type = Column(Integer, primary_key=True)
+    organisation_id = Column(String, index=True)
+    version = Column(Integer, default=0)
+
+# Every worker process starts the background jobs, the last run of each is recorded
+# so only one of them does the work, see claimJobRun
+class JobRun(Base):
+    __tablename__ = "job_runs"
+    name = Column(String, primary_key=True)
+    last_run = Column(DateTime)
 
 Base.metadata.create_all(engine)
 
-# Create a session
+def _addMissingColumns():
+    # create_all doesn't alter existing tables, so columns added to them since are added here
+    # New columns must be nullable
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existingColumns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existingColumns:
+                continue
+            columnType = column.type.compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {columnType}"))
+            except DatabaseError:
+                # Another worker added it first
+                pass
+
+_addMissingColumns()
+
+def _addMissingIndexes():
+    # create_all only creates indexes along with new tables
+    # Indexes added to existing tables are created here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except DatabaseError:
+                # Another worker created it first
+                pass
+
+_addMissingIndexes()
+
+def _addMissingResourceTypeVersions():
+    # Resource types created before versions were tracked
+    missingVersions = (
+        ResourceTypeVersion.__table__.insert()
+        .from_select(
+            ["resource_type", "organisation_id", "version"],
+            select(ResourceType.id, ResourceType.organisation_id, literal(0)).where(
+                ~exists().where(ResourceTypeVersion.resource_type == ResourceType.id)
+            ),
+        )
+    )
+    try:
+        with engine.begin() as connection:
+            connection.execute(missingVersions)
+    except IntegrityError:
+        # Another worker added them first
+        pass
+
+_addMissingResourceTypeVersions()
+
+def _backfillBookingSlots(batchSize: int = 1000):
+    # Bookings made before slots were stored
+    while True:
+        with engine.begin() as connection:
+            bookings = list(connection.execute(
+                select(Booking.id, Booking.booking_key).where(Booking.slot == None).limit(batchSize)
+            ))
+            if len(bookings) == 0:
+                return
+            connection.execute(
+                Booking.__table__.update().where(Booking.id == bindparam("bookingId")),
+                [{"bookingId": bookingId, "slot": utilities.getBookingSlot(bookingKey)} for bookingId, bookingKey in bookings],
+            )
+
+_backfillBookingSlots()
+
+# Each function runs as its own unit of work on a session from the pool
+# Session.begin() commits on success and rolls back on any exception
 Session = sessionmaker(bind=engine)
-session = Session()
+
+
+# Data versions
+# -----------------------------------
+
+def getResourceTypeVersion(organisationId: str, resourceTypeId: int = None):
+    # Returns resourceTypeId, version and administrators
+    # Defaults to the first resource type, matching the home page
+    with Session() as session:
+        query = (
+            session.query(ResourceTypeVersion.resource_type, ResourceTypeVersion.version, ResourceType.administrators)
+            .join(ResourceType, ResourceType.id == ResourceTypeVersion.resource_type)
+            .filter(ResourceTypeVersion.organisation_id == organisationId)
+        )
+        if resourceTypeId is not None:
+            query = query.filter(ResourceTypeVersion.resource_type == int(resourceTypeId))
+        return query.order_by(ResourceTypeVersion.resource_type).first()
+
+def _bumpResourceTypeVersion(session, resourceTypeId: int):
+    session.query(ResourceTypeVersion).filter(ResourceTypeVersion.resource_type == resourceTypeId).update(
+        {"version": ResourceTypeVersion.version + 1}, synchronize_session=False
+    )
+
+def _bumpEnvironmentVersion(session, environmentId: int):
+    resourceTypeId = select(Environment.resource_type).where(Environment.id == environmentId).scalar_subquery()
+    session.query(ResourceTypeVersion).filter(ResourceTypeVersion.resource_type == resourceTypeId).update(
+        {"version": ResourceTypeVersion.version + 1}, synchronize_session=False
+    )
+
+def _bumpOrganisationVersions(session, organisationId: str):
+    session.query(ResourceTypeVersion).filter(ResourceTypeVersion.organisation_id == organisationId).update(
+        {"version": ResourceTypeVersion.version + 1}, synchronize_session=False
+    )
+
+def _getOrganisationId(session, resourceTypeId: int) -> str:
+    return session.query(ResourceType.organisation_id).filter(ResourceType.id == resourceTypeId).scalar()
 
 
 # Resource Types
 def addResourceType(name: str, organisationId: str, description: str = None, administrators: list = []):
-    try:
+    with Session.begin() as session:
         newResourceType = ResourceType(
             name=name, organisation_id=organisationId, description=description, administrators=administrators
         )
         session.add(newResourceType)
-        session.commit()
-    except (PendingRollbackError, IntegrityError):
-        session.rollback()
-        raise
+        session.flush()
+        session.add(ResourceTypeVersion(resource_type=newResourceType.id, organisation_id=organisationId))
+        # Other resource types show the new one in their select
+        _bumpOrganisationVersions(session, organisationId)
+        return newResourceType.id
 
 def getResourceType(resourceTypeId: int):
-    try:
+    with Session() as session:
         resourceTypes = session.query(
             ResourceType.id, ResourceType.name, ResourceType.description, ResourceType.administrators
         ).filter(ResourceType.id == resourceTypeId).one()
         return resourceTypes
-    except NoResultFound:
-        session.rollback()
-        raise
 
 def getResourceTypes(organisationId: str):
-    try:
+    with Session() as session:
         resourceTypes = session.query(
             ResourceType.id, ResourceType.name, ResourceType.description, ResourceType.administrators
-        ).filter(ResourceType.organisation_id == organisationId).all()
+        ).filter(ResourceType.organisation_id == organisationId).order_by(ResourceType.id).all()
         return resourceTypes
-    except NoResultFound:
-        return None
 
 
 def modifyResourceType(resourceTypeId: int, name: str, description: str, administrators: list):
-    session.query(ResourceType).filter(ResourceType.id == resourceTypeId).update({
-        "name": name,
-        "description": description,
-        "administrators": administrators
-    })
-    session.commit()
+    with Session.begin() as session:
+        session.query(ResourceType).filter(ResourceType.id == resourceTypeId).update({
+            "name": name,
+            "description": description,
+            "administrators": administrators
+        })
+        _bumpOrganisationVersions(session, _getOrganisationId(session, resourceTypeId))
+    user_bookings_cache.clear()
 
 def deleteResourceType(resourceTypeId: int):
-    # Get all the environments for the resource type
-    environments = list(session.query(Environment.id).where(Environment.resource_type == resourceTypeId))
-    for environmentId, in environments:
-        deleteEnvironment(environmentId)
-    # Get current resource type object and delete it
-    deleteResourceType = (
-        session.query(ResourceType).filter(ResourceType.id == resourceTypeId).one()
-    )
-    session.delete(deleteResourceType)
-    session.commit()
+    with Session.begin() as session:
+        # Delete all the environments for the resource type along with their bookings and shares
+        environmentIds = list(session.scalars(select(Environment.id).where(Environment.resource_type == resourceTypeId)))
+        _deleteEnvironments(session, environmentIds)
+        # Get current resource type object and delete it
+        deleteResourceType = (
+            session.query(ResourceType).filter(ResourceType.id == resourceTypeId).one()
+        )
+        session.delete(deleteResourceType)
+        session.query(ResourceTypeVersion).filter(ResourceTypeVersion.resource_type == resourceTypeId).delete()
+        _bumpOrganisationVersions(session, deleteResourceType.organisation_id)
+    user_bookings_cache.clear()
 
 # Environments
 # -----------------------------------
 
 
 def getEnvironment(environmentId: int):
-    try:
-        return (
-            session.query(
-                Environment.id,
-                Environment.name,
-                Environment.description,
-                ResourceType.id,
-                Environment.booking_type,
-                Environment.booking_settings,
-                Environment.maximum_users,
+    with Session() as session:
+        try:
+            return (
+                session.query(
+                    Environment.id,
+                    Environment.name,
+                    Environment.description,
+                    ResourceType.id,
+                    Environment.booking_type,
+                    Environment.booking_settings,
+                    Environment.maximum_users,
+                )
+                .join(ResourceType)
+                .filter(Environment.id == environmentId)
+                .one()
             )
-            .join(ResourceType)
-            .filter(Environment.id == environmentId)
-            .one()
-        )
-    except NoResultFound:
-        return None
+        except NoResultFound:
+            return None
 
 
 def addEnvironment(
@@ -167,7 +330,7 @@ def addEnvironment(
     maximumUsers: int,
     description: str = None,
 ):
-    try:
+    with Session.begin() as session:
         newEnvironment = Environment(
             name=name,
             description=description,
@@ -177,53 +340,86 @@ def addEnvironment(
             maximum_users=maximumUsers,
         )
         session.add(newEnvironment)
-        session.commit()
-    except (PendingRollbackError, IntegrityError):
-        session.rollback()
-        raise
+        session.flush()
+        _bumpResourceTypeVersion(session, resourceTypeId)
+        return newEnvironment.id
 
 
 def modifyEnvironment(environmentId: int, name: str, description: str = None):
-    session.query(Environment).filter(Environment.id == environmentId).update(
-        {"name": name, "description": description}
-    )
-    session.commit()
+    with Session.begin() as session:
+        session.query(Environment).filter(Environment.id == environmentId).update(
+            {"name": name, "description": description}
+        )
+        _bumpEnvironmentVersion(session, environmentId)
+    user_bookings_cache.clear()
 
 
 def deleteEnvironment(environmentId: int):
-    # Get all bookings for the environment and delete them
-    del_environmentBookings = Booking.__table__.delete().where(
-        Booking.environment == environmentId
-    )
-    session.execute(del_environmentBookings)
+    with Session.begin() as session:
+        resourceTypeId = session.query(Environment.resource_type).filter(Environment.id == environmentId).one()[0]
+        _deleteEnvironments(session, [environmentId])
+        _bumpResourceTypeVersion(session, resourceTypeId)
+    user_bookings_cache.clear()
+
+def _deleteEnvironments(session, environmentIds: list, chunkSize: int = 500):
+    # Set based deletes of environments with their bookings and shares
+    # Chunked to keep the number of bound parameters per statement down
+    # Callers clear user_bookings_cache once the transaction has committed
+    for index in range(0, len(environmentIds), chunkSize):
+        chunk = environmentIds[index:index + chunkSize]
+        session.execute(Booking.__table__.delete().where(Booking.environment.in_(chunk)))
+        session.execute(Share.__table__.delete().where(Share.environment.in_(chunk)))
+        session.execute(Environment.__table__.delete().where(Environment.id.in_(chunk)))
+
+def getAllEnvironments(organisationId: str, resourceTypeId: int) -> list:
+    # Every environment including expired ones, see getEnvironments
+    with Session() as session:
+        return list(
+            session.query(
+                Environment.id,
+                Environment.name,
+                Environment.description,
+                Environment.booking_type,
+                Environment.booking_settings,
+                Environment.maximum_users,
+            )
+            .join(ResourceType)
+            .filter(
+                and_(
+                    ResourceType.organisation_id == organisationId,
+                    Environment.resource_type == resourceTypeId,
+                )
+            )
+            # Stable order for the home tab's pages
+            .order_by(Environment.id)
+        )
 
-    deleteEnvironment = (
-        session.query(Environment).filter(Environment.id == environmentId).one()
-    )
-    session.delete(deleteEnvironment)
-    session.commit()
+def getBookingSchedules() -> list:
+    # Booking type and settings of every environment, for warming valid bookings
+    with Session() as session:
+        return session.query(Environment.booking_type, Environment.booking_settings).all()
 
-def getEnvironments(organisationId: str, resourceTypeId: int, timeZoneName: str) -> str:
-    result = list(
-        session.query(
-            Environment.id,
-            Environment.name,
-            Environment.description,
-            Environment.booking_type,
-            Environment.booking_settings,
-            Environment.maximum_users,
+def getOneOffEnvironments() -> list:
+    # id, resource type and settings of every ONE-OFF environment
+    with Session() as session:
+        return (
+            session.query(Environment.id, Environment.resource_type, Environment.booking_settings)
+            .filter(Environment.booking_type == "ONE-OFF")
+            .all()
         )
-        .join(ResourceType)
-        .filter(
-            and_(
-                ResourceType.organisation_id == organisationId,
-                Environment.resource_type == resourceTypeId,
-            )
+
+def bumpResourceTypeVersions(resourceTypeIds: list):
+    # Invalidate views rendered for these resource types
+    with Session.begin() as session:
+        session.query(ResourceTypeVersion).filter(ResourceTypeVersion.resource_type.in_(resourceTypeIds)).update(
+            {"version": ResourceTypeVersion.version + 1}, synchronize_session=False
         )
-    )
+
+def getEnvironments(organisationId: str, resourceTypeId: int, timeZoneName: str) -> str:
+    result = getAllEnvironments(organisationId, resourceTypeId)
     # Filter out all environments that don't have valid dates
     # i.e. one time bookings that are in the past
-    filtered_environments = filter(lambda x: utilities.getValidBookings(x[3], x[4], timeZoneName) != None, result)
+    filtered_environments = filter(lambda x: utilities.getValidBookings(x[3], x[4], timeZoneName, x[0]) != None, result)
 
     return list(filtered_environments)
 
@@ -232,85 +428,238 @@ def getEnvironments(organisationId: str, resourceTypeId: int, timeZoneName: str)
 # -----------------------------------
 
 
-def addBooking(environmentId: int, bookingKey: str, userId: str):
+# addBooking results
+BOOKING_ADDED = "added"
+BOOKING_FULL = "full"
+BOOKING_EXISTS = "exists"
+
+
+def addBooking(environmentId: int, bookingKey: str, userId: str) -> str:
     # For the requested environment try and add a booking
+    # Returns BOOKING_FULL without booking if the slot is already full and BOOKING_EXISTS
+    # if the user already has it, e.g. from a double click
     try:
-        newBooking = Booking(environment=environmentId, booking_key=bookingKey, user_id=userId)
-        session.add(newBooking)
-        session.commit()
-    except (PendingRollbackError, IntegrityError):
-        session.rollback()
-        raise
+        with Session.begin() as session:
+            # Lock the environment row so bookings for it are serialised, SQLite ignores this
+            # as its write statements already take the database write lock before reading
+            session.execute(select(Environment.id).where(Environment.id == environmentId).with_for_update())
+
+            # Capacity check and insert as a single statement
+            bookingCount = (
+                select(func.count(Booking.id))
+                .where(Booking.environment == environmentId, Booking.booking_key == bookingKey)
+                .scalar_subquery()
+            )
+            insertBooking = Booking.__table__.insert().from_select(
+                ["environment", "booking_key", "user_id", "slot"],
+                select(Environment.id, literal(bookingKey), literal(userId), literal(utilities.getBookingSlot(bookingKey), DateTime)).where(
+                    Environment.id == environmentId, Environment.maximum_users > bookingCount
+                ),
+            )
+            if session.execute(insertBooking).rowcount == 0:
+                # The user's own booking may be the one that filled it
+                ownBooking = session.execute(
+                    select(Booking.id).where(
+                        Booking.environment == environmentId, Booking.booking_key == bookingKey, Booking.user_id == userId
+                    )
+                ).first()
+                return BOOKING_FULL if ownBooking is None else BOOKING_EXISTS
+            _bumpEnvironmentVersion(session, environmentId)
+    except IntegrityError:
+        # uix_env_date, the user's other submit got there first
+        return BOOKING_EXISTS
+    user_bookings_cache.invalidate(userId)
+    return BOOKING_ADDED
 
 
 def removeBooking(environmentId: int, bookingKey: str, userId: str):
-    deleteBooking = (
-        session.query(Booking)
-        .filter(Booking.environment == environmentId, Booking.booking_key == bookingKey, Booking.user_id == userId)
-        .one()
-    )
-    session.delete(deleteBooking)
-    session.commit()
-
-def getBookings(
-    organisationId: str = None, environmentId=None, resourceTypeId: int = None, bookingKey: str = None, timeZoneName: str = None
-) -> list:
-    # Get information about the current environment
-    environmentData = getEnvironment(environmentId)
-    validBookingKeys = utilities.getValidBookings(environmentData[4], environmentData[5], timeZoneName)
-    if bookingKey and environmentId:
-        return list(
-            session.query(Booking.environment, Booking.booking_key, Booking.user_id)
-            .join(Environment)
-            .where(
-                and_(
-                    Booking.booking_key == bookingKey,
-                    Environment.id == environmentId
-                )
-            )
+    with Session.begin() as session:
+        deleteBooking = (
+            session.query(Booking)
+            .filter(Booking.environment == environmentId, Booking.booking_key == bookingKey, Booking.user_id == userId)
+            .one()
         )
-    elif environmentId:
-        return list(
-            session.query(Booking.environment, Booking.booking_key, Booking.user_id)
-            .join(Environment)
-            .where(
-                and_(
-                    Booking.booking_key.in_(validBookingKeys),
-                    Environment.id == environmentId
-                )
+        session.delete(deleteBooking)
+        _bumpEnvironmentVersion(session, environmentId)
+    user_bookings_cache.invalidate(userId)
+
+# Each user's upcoming bookings, dropped by addBooking and removeBooking
+# Other workers only see changes made elsewhere when their entry expires
+user_bookings_cache = cache.TTLCache(
+    maxSize=int(os.environ.get("USER_BOOKINGS_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("USER_BOOKINGS_TTL_SECONDS", 60))
+)
+
+def getUserBookings(organisationId: str, userId: str, fresh: bool = False) -> list:
+    # A user's bookings across the organisation from yesterday onwards, soonest first
+    # DAILY slots are local dates, so callers drop the ones that have passed in the user's timezone
+    # Rows are environment id, environment name, resource type id, resource type name,
+    # booking type, booking settings and booking key
+    # fresh skips the cached entry when it's known to be stale, the result is still cached
+    since = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=1)
+    cached = None if fresh else user_bookings_cache.get(userId)
+    if cached is not None and cached[0] == (organisationId, since):
+        return cached[1]
+
+    with Session() as session:
+        bookings = (
+            session.query(
+                Environment.id,
+                Environment.name,
+                ResourceType.id,
+                ResourceType.name,
+                Environment.booking_type,
+                Environment.booking_settings,
+                Booking.booking_key,
             )
+            .join(Environment, Booking.environment == Environment.id)
+            .join(ResourceType, Environment.resource_type == ResourceType.id)
+            .filter(
+                Booking.user_id == userId,
+                Booking.slot >= since,
+                ResourceType.organisation_id == organisationId,
+            )
+            .order_by(Booking.slot, Environment.name)
+            .all()
         )
-    else:
-        return list(
-            session.query(Booking.environment, Booking.booking_key, Booking.user_id)
-            .join(Environment)
-            .where(
-                and_(
-                    Booking.booking_key.in_(validBookingKeys),
-                    Environment.resource_type == resourceTypeId,
+    user_bookings_cache.set(userId, ((organisationId, since), bookings))
+    return bookings
+
+def getEnvironmentBookings(validBookingKeys: dict) -> dict:
+    # Get the bookings for a set of environments in a single query
+    # validBookingKeys maps each environmentId to its valid booking keys
+    # Returned grouped by environmentId and then bookingKey
+    result = {environmentId: {} for environmentId in validBookingKeys}
+
+    # Each environment's keys cover a window of slots, environments sharing a window are
+    # fetched with one range so the statement size doesn't grow with the number of slots
+    windows = {}
+    for environmentId, bookingKeys in validBookingKeys.items():
+        if bookingKeys:
+            window = (utilities.getBookingSlot(min(bookingKeys)), utilities.getBookingSlot(max(bookingKeys)))
+            windows.setdefault(window, []).append(environmentId)
+    if len(windows) == 0:
+        return result
+
+    with Session() as session:
+        bookings = list(session.query(Booking.environment, Booking.booking_key, Booking.user_id).where(
+            or_(*(
+                and_(Booking.environment.in_(environmentIds), Booking.slot.between(start, end))
+                for (start, end), environmentIds in windows.items()
+            ))
+        ))
+    for booking in bookings:
+        # Keys are only valid for the environment they were generated for
+        if booking[1] in validBookingKeys[booking[0]]:
+            result[booking[0]].setdefault(booking[1], []).append(booking)
+    return result
+
+
+def archiveBookings(before: datetime.datetime, batchSize: int = 1000) -> int:
+    # Move bookings for slots before the given time into archived_bookings
+    # Each batch is its own transaction so locks are only held briefly
+    archived = 0
+    while True:
+        with Session.begin() as session:
+            # Rows another process is archiving are skipped, SQLite ignores this as
+            # its writes are already serialised
+            bookingIds = [
+                bookingId for bookingId, in
+                session.query(Booking.id).where(Booking.slot < before).order_by(Booking.slot).limit(batchSize)
+                .with_for_update(skip_locked=True)
+            ]
+            if len(bookingIds) == 0:
+                return archived
+            # Bookings already archived by an overlapping run are only deleted
+            session.execute(
+                ArchivedBooking.__table__.insert().from_select(
+                    ["id", "environment", "user_id", "booking_key", "slot", "archived"],
+                    select(
+                        Booking.id, Booking.environment, Booking.user_id, Booking.booking_key, Booking.slot,
+                        literal(datetime.datetime.utcnow(), DateTime),
+                    ).where(Booking.id.in_(bookingIds), ~exists().where(ArchivedBooking.id == Booking.id)),
                 )
             )
+            session.execute(Booking.__table__.delete().where(Booking.id.in_(bookingIds)))
+            archived += len(bookingIds)
+
+
+# Background jobs
+# -----------------------------------
+
+def claimJobRun(name: str, dueBefore: datetime.datetime, now: datetime.datetime) -> bool:
+    # Claims a run of a background job if it last ran before dueBefore
+    # Only one of the processes racing for a run gets True
+    with Session.begin() as session:
+        claimed = session.query(JobRun).filter(JobRun.name == name, JobRun.last_run < dueBefore).update(
+            {"last_run": now}, synchronize_session=False
         )
+        if claimed > 0:
+            return True
+        if session.query(exists().where(JobRun.name == name)).scalar():
+            return False
+    try:
+        with Session.begin() as session:
+            session.add(JobRun(name=name, last_run=now))
+        return True
+    except IntegrityError:
+        return False
 
 
 # Shares
 # -----------------------------------
 
 def addShare(environmentId: int, channelId: str, timestamp: str):
-    try:
+    with Session.begin() as session:
         newShare = Share(
             environment=environmentId,
             channel_id=channelId,
             timestamp=timestamp
         )
         session.add(newShare)
-        session.commit()
-    except (PendingRollbackError, IntegrityError):
-        session.rollback()
-        raise
 
 def getShares(environmentId: int):
-    return list(
-        session.query(Share.channel_id, Share.timestamp)
-        .where(Share.environment == environmentId)
-    )
\ No newline at end of file
+    with Session() as session:
+        return list(
+            session.query(Share.channel_id, Share.timestamp)
+            .where(Share.environment == environmentId)
+        )
+
+def deleteShare(channelId: str, timestamp: str):
+    with Session.begin() as session:
+        session.execute(
+            Share.__table__.delete().where(
+                and_(Share.channel_id == channelId, Share.timestamp == timestamp)
+            )
+        )
+
+def _shareHasExpired(created: datetime.datetime, bookingType: str, bookingSettings: dict, now: datetime.datetime) -> bool:
+    # Shares of deleted environments, past ONE-OFF bookings or older than the booking window
+    if bookingType is None:
+        return True
+    if bookingType == "ONE-OFF":
+        return datetime.datetime.utcfromtimestamp(bookingSettings["date"]) < now
+    if created.tzinfo is not None:
+        created = created.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return created < now - datetime.timedelta(days=bookingSettings["numberDaysAdvance"])
+
+def deleteStaleShares(now: datetime.datetime, batchSize: int = 1000) -> int:
+    # Shares whose messages no longer need updating, checked a batch at a time
+    deleted = 0
+    lastShareId = 0
+    while True:
+        with Session.begin() as session:
+            shares = list(
+                session.query(Share.id, Share.created, Environment.booking_type, Environment.booking_settings)
+                .outerjoin(Environment, Environment.id == Share.environment)
+                .where(Share.id > lastShareId)
+                .order_by(Share.id)
+                .limit(batchSize)
+            )
+            if len(shares) == 0:
+                return deleted
+            lastShareId = shares[-1][0]
+            staleShareIds = [share[0] for share in shares if _shareHasExpired(share[1], share[2], share[3], now)]
+            if staleShareIds:
+                session.execute(Share.__table__.delete().where(Share.id.in_(staleShareIds)))
+                deleted += len(staleShareIds)
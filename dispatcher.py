@@ -0,0 +1,320 @@
+import logging
+import queue
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+import database
+
+# Errors meaning the shared message is gone and should stop being updated
+DELETED_MESSAGE_ERRORS = ("message_not_found", "channel_not_found", "is_archived", "not_in_channel")
+
+
+class RateBudget:
+    # Spaces calls out evenly to stay under a per minute limit
+    def __init__(self, ratePerMinute: int):
+        self.interval = 60 / ratePerMinute
+        self.nextTime = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.nextTime - now)
+            self.nextTime = max(now, self.nextTime) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Hold back every call until Slack's Retry-After has passed
+        with self._lock:
+            self.nextTime = max(self.nextTime, time.monotonic() + seconds)
+
+
+class ShareUpdateDispatcher:
+    # Background chat_update fan-out for shared booking messages
+    # Only the latest render for each (channel, ts) is kept, so a burst of
+    # bookings results in a single update per message
+    def __init__(self, workers: int = 4, ratePerMinute: int = 50):
+        self.workers = workers
+        self.ratePerMinute = ratePerMinute
+        self.sent = 0
+        self.coalesced = 0
+        self.rateLimited = 0
+        self.pruned = 0
+        self.failed = 0
+        self._pending = {}
+        self._inFlight = set()
+        self._budgets = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, teamId: str, client, environmentId: int, channelId: str, timestamp: str, blocks: list):
+        key = (channelId, timestamp)
+        with self._lock:
+            self._startWorkers()
+            alreadyQueued = key in self._pending or key in self._inFlight
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = (teamId, client, environmentId, blocks)
+        # Messages in flight are re-queued by their worker once it finishes
+        if not alreadyQueued:
+            self._queue.put(key)
+
+    def join(self):
+        # Wait until every submitted update has been processed
+        self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "rateLimited": self.rateLimited,
+            "pruned": self.pruned,
+            "failed": self.failed,
+        }
+
+    def _startWorkers(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"share-updates-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _budget(self, teamId: str) -> RateBudget:
+        with self._lock:
+            if teamId not in self._budgets:
+                self._budgets[teamId] = RateBudget(self.ratePerMinute)
+            return self._budgets[teamId]
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            try:
+                with self._lock:
+                    item = self._pending.pop(key, None)
+                    if item is not None:
+                        self._inFlight.add(key)
+                if item is not None:
+                    self._update(key, item)
+            except Exception:
+                logging.exception(f"Share update worker failed for {key}")
+            finally:
+                with self._lock:
+                    self._inFlight.discard(key)
+                    requeue = key in self._pending
+                if requeue:
+                    self._queue.put(key)
+                self._queue.task_done()
+
+    def _update(self, key, item):
+        channelId, timestamp = key
+        teamId, client, environmentId, blocks = item
+        budget = self._budget(teamId)
+        budget.acquire()
+        try:
+            client.chat_update(channel=channelId, ts=timestamp, blocks=blocks)
+            self.sent += 1
+        except SlackApiError as e:
+            error = e.response.get("error")
+            if e.response.status_code == 429:
+                self.rateLimited += 1
+                retryAfter = int(e.response.headers.get("Retry-After", 1))
+                logging.warning(f"chat.update rate limited for {teamId}, retrying in {retryAfter}s")
+                budget.pause(retryAfter)
+                # Retry unless a newer render has already replaced this one
+                with self._lock:
+                    self._pending.setdefault(key, item)
+            elif error in DELETED_MESSAGE_ERRORS:
+                self.pruned += 1
+                logging.info(f"Removing share {channelId} {timestamp} for environment {environmentId}: {error}")
+                database.deleteShare(channelId, timestamp)
+            else:
+                self.failed += 1
+                logging.error(f"Error updating channel {channelId} {timestamp}: {error}")
+
+
+class HomePushDispatcher:
+    # Background views_publish of re-rendered home tabs to users who recently viewed
+    # the changed resource type, so they see new bookings without reopening the tab
+    # Changes are coalesced per resource type for delaySeconds, and each distinct
+    # (timezone, admin, page) view is rendered once and shared by its viewers
+    def __init__(self, render, enabled: bool = False, workers: int = 2, ratePerMinute: int = 100,
+                 delaySeconds: float = 2, viewerTtl: float = 60 * 30, maxViewers: int = 1000, maxPending: int = 1000):
+        # render(organisationId, userId, resourceTypeId, timeZoneName, page, environmentId) returns the view
+        self.render = render
+        self.enabled = enabled
+        self.workers = workers
+        self.ratePerMinute = ratePerMinute
+        self.delaySeconds = delaySeconds
+        self.viewerTtl = viewerTtl
+        self.maxViewers = maxViewers
+        self.maxPending = maxPending
+        self.sent = 0
+        self.renders = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.rateLimited = 0
+        self.failed = 0
+        # organisationId -> {userId: (viewedAt, resourceTypeId, timeZoneName, page, environmentId)}, oldest first
+        self._viewers = {}
+        self._pending = {}
+        self._inFlight = set()
+        # (organisationId, userId) -> (client, view) of publishes to retry after a rate limit
+        self._retries = {}
+        self._budgets = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def viewed(self, organisationId: str, userId: str, resourceTypeId: int, timeZoneName: str, page: int = 0, environmentId: int = None):
+        # Record the home tab a user has just been shown
+        if not self.enabled or resourceTypeId is None:
+            return
+        with self._lock:
+            viewers = self._viewers.setdefault(organisationId, {})
+            viewers.pop(userId, None)
+            viewers[userId] = (time.monotonic(), int(resourceTypeId), timeZoneName, page, environmentId)
+            while len(viewers) > self.maxViewers:
+                del viewers[next(iter(viewers))]
+
+    def left(self, organisationId: str, userId: str):
+        # The user's home tab is showing something else, e.g. settings
+        with self._lock:
+            self._viewers.get(organisationId, {}).pop(userId, None)
+
+    def submit(self, organisationId: str, resourceTypeId: int, client):
+        # Queue a push for a resource type whose bookings or environments have changed
+        if not self.enabled:
+            return
+        key = (organisationId, int(resourceTypeId))
+        now = time.monotonic()
+        with self._lock:
+            if not any(viewer[1] == key[1] for viewer in self._viewers.get(organisationId, {}).values()):
+                return
+            alreadyQueued = key in self._pending or key in self._inFlight
+            if key in self._pending:
+                self.coalesced += 1
+                firstChange = self._pending[key][0]
+            elif len(self._pending) >= self.maxPending:
+                self.dropped += 1
+                return
+            else:
+                firstChange = now
+            self._startWorkers()
+            self._pending[key] = (firstChange, now, client)
+        # Resource types in flight are re-queued by their worker once it finishes
+        if not alreadyQueued:
+            self._queue.put(key)
+
+    def join(self):
+        # Wait until every submitted push has been processed
+        self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "retrying": len(self._retries),
+            "sent": self.sent,
+            "renders": self.renders,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "rateLimited": self.rateLimited,
+            "failed": self.failed,
+        }
+
+    def _startWorkers(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"home-pushes-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _budget(self, organisationId: str) -> RateBudget:
+        with self._lock:
+            if organisationId not in self._budgets:
+                self._budgets[organisationId] = RateBudget(self.ratePerMinute)
+            return self._budgets[organisationId]
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            try:
+                with self._lock:
+                    retry = self._retries.pop(key, None)
+                if retry is not None:
+                    self._publish(key[0], key[1], *retry)
+                    continue
+                # Let a burst of changes settle so it results in a single push
+                with self._lock:
+                    firstChange = self._pending[key][0] if key in self._pending else None
+                if firstChange is not None:
+                    time.sleep(max(0.0, firstChange + self.delaySeconds - time.monotonic()))
+                with self._lock:
+                    item = self._pending.pop(key, None)
+                    if item is not None:
+                        self._inFlight.add(key)
+                if item is not None:
+                    self._push(key, item)
+            except Exception:
+                logging.exception(f"Home push worker failed for {key}")
+            finally:
+                with self._lock:
+                    self._inFlight.discard(key)
+                    requeue = key in self._pending
+                if requeue:
+                    self._queue.put(key)
+                self._queue.task_done()
+
+    def _push(self, key, item):
+        organisationId, resourceTypeId = key
+        _, lastChange, client = item
+        dataVersion = database.getResourceTypeVersion(organisationId, resourceTypeId)
+        if dataVersion is None:
+            return
+        administrators = dataVersion[2]
+
+        # Viewers shown a render since the last change already have it
+        now = time.monotonic()
+        groups = {}
+        with self._lock:
+            for userId, (viewedAt, viewedResourceTypeId, timeZoneName, page, environmentId) in self._viewers.get(organisationId, {}).items():
+                if viewedResourceTypeId == resourceTypeId and viewedAt < lastChange and now - viewedAt < self.viewerTtl:
+                    groups.setdefault((timeZoneName, userId in administrators, page, environmentId), []).append(userId)
+
+        for (timeZoneName, _, page, environmentId), userIds in groups.items():
+            view = self.render(organisationId, userIds[0], resourceTypeId, timeZoneName, page, environmentId)
+            self.renders += 1
+            for userId in userIds:
+                # This view replaces any rate limited one still waiting to be retried
+                with self._lock:
+                    self._retries.pop((organisationId, userId), None)
+                self._publish(organisationId, userId, client, view)
+
+    def _publish(self, organisationId: str, userId: str, client, view):
+        budget = self._budget(organisationId)
+        budget.acquire()
+        try:
+            client.views_publish(user_id=userId, view=view)
+            self.sent += 1
+        except SlackApiError as e:
+            if e.response.status_code == 429:
+                self.rateLimited += 1
+                retryAfter = int(e.response.headers.get("Retry-After", 1))
+                logging.warning(f"views.publish rate limited for {organisationId}, retrying in {retryAfter}s")
+                budget.pause(retryAfter)
+                # Queued again, its worker waits on the paused budget before retrying
+                key = (organisationId, userId)
+                with self._lock:
+                    alreadyQueued = key in self._retries
+                    self._retries[key] = (client, view)
+                if not alreadyQueued:
+                    self._queue.put(key)
+            else:
+                self.failed += 1
+                logging.error(f"Error pushing home tab to {userId}: {e.response.get('error')}")
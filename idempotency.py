@@ -0,0 +1,35 @@
+import hashlib
+import json
+import os
+
+import cache
+
+# Requests seen recently, Slack retries events for up to a few minutes
+recent_requests = cache.TTLCache(
+    maxSize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 100000)),
+    ttl=int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 60 * 10))
+)
+
+
+def getRequestKey(body: dict):
+    # Identifies a delivery of a Slack request, retries share the same key
+    requestType = body.get("type")
+    if requestType == "event_callback" and body.get("event_id"):
+        return ("event", body["event_id"])
+    elif requestType == "block_actions" and body.get("actions"):
+        return ("action", body.get("trigger_id"), body["actions"][0].get("action_ts"))
+    elif requestType == "view_submission":
+        # The view id and hash stay the same when a modal is resubmitted after
+        # response_action errors, so the submitted values are part of the key
+        values = json.dumps(body["view"].get("state", {}).get("values", {}), sort_keys=True)
+        return ("view", body["view"]["id"], body["view"].get("hash"), hashlib.sha1(values.encode()).hexdigest())
+    return None
+
+
+def isDuplicate(body: dict) -> bool:
+    # Records the request, returning True if it has already been seen
+    # Only covers this process, a retry can still reach another worker
+    requestKey = getRequestKey(body)
+    if requestKey is None:
+        return False
+    return not recent_requests.add(requestKey)
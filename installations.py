@@ -0,0 +1,116 @@
+import logging
+import time
+from typing import Optional
+
+from slack_sdk.oauth.installation_store import Bot, Installation, InstallationStore
+from slack_sdk.oauth.installation_store.async_installation_store import AsyncInstallationStore
+
+import async_database
+import cache
+
+
+class CachedInstallationStore(InstallationStore, AsyncInstallationStore):
+    # Caches installation lookups, Bolt's authorize reads the store on every request
+    # Entries expire before their tokens are due to be rotated, so authorize always
+    # decides whether to rotate from the stored installation rather than a cached copy
+    # Saves and deletes invalidate this process's entries, other workers wait for the TTL
+    def __init__(self, store, ttl: float = 300, maxSize: int = 1000, tokenRotationExpirationMinutes: int = 120):
+        self.store = store
+        self.tokenRotationExpirationMinutes = tokenRotationExpirationMinutes
+        self.cache = cache.TTLCache(maxSize=maxSize, ttl=ttl)
+
+    @property
+    def logger(self):
+        return self.store.logger
+
+    def _cacheTime(self, *expiresAt) -> float:
+        # Seconds until the earliest token enters the rotation window
+        expiresAt = [expiry for expiry in expiresAt if expiry is not None]
+        if len(expiresAt) == 0:
+            return self.cache.ttl
+        return min(self.cache.ttl, min(expiresAt) - self.tokenRotationExpirationMinutes * 60 - time.time())
+
+    def _cached(self, key, find, expiresAt):
+        result = self.cache.get(key)
+        if result is None:
+            result = find()
+            # Missing installations aren't cached so new installs are picked up straight away
+            if result is not None:
+                cacheTime = self._cacheTime(*expiresAt(result))
+                if cacheTime > 0:
+                    self.cache.set(key, result, ttl=cacheTime)
+            logging.debug(f"Installation cache miss {self.cache.stats()}")
+        return result
+
+    async def _asyncCached(self, key, find, expiresAt):
+        # Hits are answered on the event loop, only misses read the store in a thread
+        result = self.cache.get(key)
+        if result is None:
+            result = await async_database.runInThread(self._cached, key, find, expiresAt)
+        return result
+
+    def invalidate(self, enterpriseId: Optional[str], teamId: Optional[str]):
+        self.cache.invalidateWhere(lambda key: key[1] == enterpriseId and key[2] == teamId)
+
+    def save(self, installation: Installation):
+        self.store.save(installation)
+        self.invalidate(installation.enterprise_id, installation.team_id)
+
+    def save_bot(self, bot: Bot):
+        self.store.save_bot(bot)
+        self.invalidate(bot.enterprise_id, bot.team_id)
+
+    def _botLookup(self, enterprise_id: Optional[str], team_id: Optional[str], is_enterprise_install: Optional[bool]):
+        return (
+            ("bot", enterprise_id, team_id, is_enterprise_install),
+            lambda: self.store.find_bot(enterprise_id=enterprise_id, team_id=team_id, is_enterprise_install=is_enterprise_install),
+            lambda bot: (bot.bot_token_expires_at,),
+        )
+
+    def _installationLookup(self, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str], is_enterprise_install: Optional[bool]):
+        return (
+            ("installation", enterprise_id, team_id, user_id, is_enterprise_install),
+            lambda: self.store.find_installation(enterprise_id=enterprise_id, team_id=team_id, user_id=user_id, is_enterprise_install=is_enterprise_install),
+            lambda installation: (installation.bot_token_expires_at, installation.user_token_expires_at),
+        )
+
+    def find_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str], is_enterprise_install: Optional[bool] = False) -> Optional[Bot]:
+        return self._cached(*self._botLookup(enterprise_id, team_id, is_enterprise_install))
+
+    def find_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None, is_enterprise_install: Optional[bool] = False) -> Optional[Installation]:
+        return self._cached(*self._installationLookup(enterprise_id, team_id, user_id, is_enterprise_install))
+
+    def delete_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str]) -> None:
+        self.store.delete_bot(enterprise_id=enterprise_id, team_id=team_id)
+        self.invalidate(enterprise_id, team_id)
+
+    def delete_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None) -> None:
+        self.store.delete_installation(enterprise_id=enterprise_id, team_id=team_id, user_id=user_id)
+        self.invalidate(enterprise_id, team_id)
+
+    def delete_all(self, *, enterprise_id: Optional[str], team_id: Optional[str]):
+        self.store.delete_all(enterprise_id=enterprise_id, team_id=team_id)
+        self.invalidate(enterprise_id, team_id)
+
+    # The async app shares the synchronous SQLite store, its reads and writes run on
+    # async_database's thread pool so they don't block the event loop
+    async def async_save(self, installation: Installation):
+        await async_database.runInThread(self.save, installation)
+
+    async def async_save_bot(self, bot: Bot):
+        await async_database.runInThread(self.save_bot, bot)
+
+    async def async_find_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str], is_enterprise_install: Optional[bool] = False) -> Optional[Bot]:
+        return await self._asyncCached(*self._botLookup(enterprise_id, team_id, is_enterprise_install))
+
+    async def async_find_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None, is_enterprise_install: Optional[bool] = False) -> Optional[Installation]:
+        return await self._asyncCached(*self._installationLookup(enterprise_id, team_id, user_id, is_enterprise_install))
+
+    async def async_delete_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str]) -> None:
+        await async_database.runInThread(self.delete_bot, enterprise_id=enterprise_id, team_id=team_id)
+
+    async def async_delete_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None) -> None:
+        await async_database.runInThread(self.delete_installation, enterprise_id=enterprise_id, team_id=team_id, user_id=user_id)
+
+    async def async_delete_all(self, *, enterprise_id: Optional[str], team_id: Optional[str]):
+        await async_database.runInThread(self.delete_all, enterprise_id=enterprise_id, team_id=team_id)
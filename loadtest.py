@@ -0,0 +1,293 @@
+# Load test for the Flask or ASGI app against a stub Slack Web API
+# Runs everything locally with its own databases, nothing is sent to Slack
+# python loadtest.py --environments 50 --bookings 5000 --requests 500 --concurrency 8
+# python loadtest.py --app async
+import argparse
+import contextlib
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+SIGNING_SECRET = "loadtest-signing-secret"
+TEAM_ID = "T0LOADTEST"
+BOT_USER_ID = "U0LOADBOT"
+ADMIN_USER_ID = "U0LOADADMIN"
+SCENARIOS = ("app_home_opened", "button-book-clicked", "create-booking", "remove-booking", "add-booking")
+
+
+class StubSlackApi(BaseHTTPRequestHandler):
+    # Enough of the Web API for every call the app makes
+    responses = {
+        "auth.test": {"team_id": TEAM_ID, "user_id": BOT_USER_ID, "bot_id": "B0LOADBOT"},
+        "users.info": {"user": {"tz": "Europe/London"}},
+        "team.info": {"team": {"id": TEAM_ID}},
+        "chat.postMessage": {"channel": "C0LOADTEST", "ts": "1700000000.000100"},
+    }
+    calls = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        method = urllib.parse.urlparse(self.path).path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        body = json.dumps({"ok": True, **self.responses.get(method, {})}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections under load
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def startServer(server) -> int:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port
+
+
+def configureEnvironment(directory: str, slackApiPort: int):
+    # The app reads its settings on import
+    os.environ.update({
+        "DATABASE_STR": f"sqlite:///{os.path.join(directory, 'bookings.db')}",
+        "OAUTH_DATABASE_STR": os.path.join(directory, "oauth.db"),
+        "SLACK_API_URL": f"http://127.0.0.1:{slackApiPort}/api/",
+        "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+        "SLACK_CLIENT_ID": "loadtest.client",
+        "SLACK_CLIENT_SECRET": "loadtest-client-secret",
+        "SLACK_SCOPES": "chat:write,users:read,team:read",
+        "RETENTION_INTERVAL_SECONDS": "0",
+    })
+
+
+def startAsgiServer(api) -> int:
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(api, log_level="warning", lifespan="off", backlog=128))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return sock.getsockname()[1]
+
+
+def seed(common, database, utilities, environments: int, bookings: int, capacity: int) -> list:
+    from slack_sdk.oauth.installation_store import Installation
+
+    common.installation_store.save(Installation(
+        app_id="A0LOADTEST", enterprise_id=None, team_id=TEAM_ID, user_id=ADMIN_USER_ID,
+        bot_token="xoxb-loadtest", bot_id="B0LOADBOT", bot_user_id=BOT_USER_ID, installed_at=time.time(),
+    ))
+    database.addResourceType("Load test", TEAM_ID, "Seeded by loadtest.py", [ADMIN_USER_ID])
+    resourceTypeId = database.getResourceTypes(TEAM_ID)[0][0]
+    for index in range(environments):
+        if index % 2:
+            database.addEnvironment(f"Environment {index}", resourceTypeId, "CUSTOM", {"numberDaysAdvance": 30, "bookingTimes": ["09:00", "13:00"]}, capacity)
+        else:
+            database.addEnvironment(f"Environment {index}", resourceTypeId, "DAILY", {"numberDaysAdvance": 30}, capacity)
+
+    seeded = []
+    for environment in database.getEnvironments(TEAM_ID, resourceTypeId, "Europe/London"):
+        bookingKeys = list(utilities.getValidBookings(environment[3], environment[4], "Europe/London"))
+        seeded.append((resourceTypeId, environment[0], bookingKeys))
+    for index in range(bookings):
+        _, environmentId, bookingKeys = random.choice(seeded)
+        with contextlib.suppress(Exception):
+            database.addBooking(environmentId, random.choice(bookingKeys), f"U0SEED{index}")
+    return seeded
+
+
+# Signed payloads
+# -----------------------------------
+
+def signedRequest(url: str, body: str, contentType: str) -> urllib.request.Request:
+    timestamp = str(int(time.time()))
+    signature = hmac.new(SIGNING_SECRET.encode(), f"v0:{timestamp}:{body}".encode(), hashlib.sha256).hexdigest()
+    return urllib.request.Request(url, data=body.encode(), method="POST", headers={
+        "Content-Type": contentType,
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": f"v0={signature}",
+    })
+
+def eventRequest(url: str, event: dict) -> urllib.request.Request:
+    body = json.dumps({
+        "type": "event_callback",
+        "team_id": TEAM_ID,
+        "api_app_id": "A0LOADTEST",
+        "event_id": f"Ev{random.getrandbits(48):012X}",
+        "event": event,
+        "authorizations": [{"team_id": TEAM_ID, "user_id": BOT_USER_ID, "is_bot": True, "enterprise_id": None, "is_enterprise_install": False}],
+    })
+    return signedRequest(url, body, "application/json")
+
+def interactionRequest(url: str, payload: dict) -> urllib.request.Request:
+    payload = {"team": {"id": TEAM_ID}, "api_app_id": "A0LOADTEST", "is_enterprise_install": False, **payload}
+    body = urllib.parse.urlencode({"payload": json.dumps(payload)})
+    return signedRequest(url, body, "application/x-www-form-urlencoded")
+
+def buildRequest(url: str, scenario: str, index: int, seeded: list) -> urllib.request.Request:
+    resourceTypeId, environmentId, bookingKeys = seeded[index % len(seeded)]
+    # Each request books as a different user so create and remove pair up
+    userId = f"U0LOAD{index}"
+    bookingKey = bookingKeys[index % len(bookingKeys)]
+    user = {"id": userId, "team_id": TEAM_ID}
+    view = {"id": f"V0LOAD{index}", "type": "modal", "private_metadata": f"{resourceTypeId},{environmentId}", "state": {"values": {}}}
+    actionTs = f"{time.time():.6f}"
+
+    if scenario == "app_home_opened":
+        return eventRequest(url, {"type": "app_home_opened", "user": userId, "tab": "home", "event_ts": actionTs})
+    elif scenario == "button-book-clicked":
+        return interactionRequest(url, {
+            "type": "block_actions", "user": user, "trigger_id": f"trigger.{index}",
+            "actions": [{"action_id": "button-book-clicked", "block_id": f"env_{environmentId}", "value": str(environmentId), "action_ts": actionTs}],
+        })
+    elif scenario in ("create-booking", "remove-booking"):
+        return interactionRequest(url, {
+            "type": "block_actions", "user": user, "trigger_id": f"trigger.{index}", "view": {**view, "callback_id": "add-booking"},
+            "actions": [{"action_id": scenario, "block_id": bookingKey, "value": str(environmentId), "action_ts": actionTs}],
+        })
+    elif scenario == "add-booking":
+        return interactionRequest(url, {"type": "view_submission", "user": user, "view": {**view, "callback_id": "add-booking"}})
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+# Running
+# -----------------------------------
+
+def runScenario(url: str, scenario: str, numberRequests: int, concurrency: int, seeded: list) -> dict:
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    indexes = iter(range(numberRequests))
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            request = buildRequest(url, scenario, index, seeded)
+            startTime = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    failed = response.status != 200
+            except Exception:
+                failed = True
+            latency = time.perf_counter() - startTime
+            with lock:
+                latencies.append(latency)
+                errors += failed
+
+    startTime = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - startTime
+
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50": percentiles[49] * 1000,
+        "p95": percentiles[94] * 1000,
+        "p99": percentiles[98] * 1000,
+    }
+
+
+def waitForListeners(common, metrics, timeout: float = 60):
+    # Lazy listeners carry on after the response, let them finish before the next scenario
+    # A request's duration is recorded once its last listener has finished
+    def observed(histogram):
+        return sum(series["count"] for series in histogram.snapshot().values())
+
+    deadline = time.monotonic() + timeout
+    while observed(metrics.request_duration) < observed(metrics.ack_latency) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    common.share_dispatcher.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Flask or ASGI app against a stub Slack API")
+    parser.add_argument("--app", choices=("sync", "async"), default="sync", help="app.py under werkzeug or async_app.py under uvicorn")
+    parser.add_argument("--environments", type=int, default=20, help="Environments to seed")
+    parser.add_argument("--bookings", type=int, default=1000, help="Bookings to seed")
+    parser.add_argument("--capacity", type=int, default=1000, help="Maximum users per environment")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run")
+    args = parser.parse_args()
+
+    # Templates are loaded relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    directory = tempfile.mkdtemp(prefix="loadtest-")
+    slackApiPort = startServer(StubServer(("127.0.0.1", 0), StubSlackApi))
+    configureEnvironment(directory, slackApiPort)
+
+    # The app logs every booking, keep the report readable
+    output = sys.stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        import logging
+
+        import common
+        import database
+        import metrics
+        import utilities
+
+        logging.disable(logging.WARNING)
+        seeded = seed(common, database, utilities, args.environments, args.bookings, args.capacity)
+        if args.app == "sync":
+            from werkzeug.serving import make_server
+
+            import app
+            appPort = startServer(make_server("127.0.0.1", 0, app.flask_app, threaded=True))
+        else:
+            import async_app
+            appPort = startAsgiServer(async_app.api)
+        url = f"http://127.0.0.1:{appPort}/slack/events"
+
+        results = []
+        for scenario in args.scenarios.split(","):
+            results.append(runScenario(url, scenario, args.requests, args.concurrency, seeded))
+            waitForListeners(common, metrics)
+
+    print(f"{args.app} app, {args.environments} environments, {args.bookings} bookings, {args.requests} requests per scenario, concurrency {args.concurrency}", file=output)
+    print(f"{'scenario':<22}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}", file=output)
+    for result in results:
+        print(
+            f"{result['scenario']:<22}{result['requests']:>9}{result['errors']:>8}{result['rps']:>9.1f}"
+            f"{result['p50']:>9.1f}{result['p95']:>9.1f}{result['p99']:>9.1f}",
+            file=output,
+        )
+    print(f"Stub Slack API calls: {dict(sorted(StubSlackApi.calls.items()))}", file=output)
+
+
+if __name__ == "__main__":
+    main()
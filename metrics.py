@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import threading
+import time
+
+from slack_sdk import WebClient
+from sqlalchemy import event
+
+# Upper bounds in seconds, Slack requires an ack within 3 seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, float("inf"))
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, float("inf"))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float("inf"))
+# Slack allows 100 blocks per view
+BLOCK_BUCKETS = (10, 25, 50, 75, 90, 100, float("inf"))
+BYTE_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 250000, float("inf"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    # Cumulative latency histogram, one set of buckets per label
+    def __init__(self, name: str, buckets: tuple = DEFAULT_BUCKETS, labelName: str = "request"):
+        self.name = name
+        self.buckets = buckets
+        self.labelName = labelName
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label: str, value: float):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                label: {"counts": list(series["counts"]), "sum": series["sum"], "count": series["count"]}
+                for label, series in self._series.items()
+            }
+
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = [f"# TYPE {self.name} histogram"]
+        for label, series in sorted(self.snapshot().items()):
+            label = label.replace("\\", "\\\\").replace('"', '\\"')
+            for bound, count in zip(self.buckets, series["counts"]):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{self.labelName}="{label}",le="{le}"}} {count}')
+            lines.append(f'{self.name}_sum{{{self.labelName}="{label}"}} {series["sum"]}')
+            lines.append(f'{self.name}_count{{{self.labelName}="{label}"}} {series["count"]}')
+        return "\n".join(lines)
+
+
+class Counter:
+    # Monotonic count, one per label
+    def __init__(self, name: str, labelName: str = "request"):
+        self.name = name
+        self.labelName = labelName
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label: str, amount: int = 1):
+        with self._lock:
+            self._series[label] = self._series.get(label, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._series)
+
+    def render(self) -> str:
+        lines = [f"# TYPE {self.name} counter"]
+        for label, count in sorted(self.snapshot().items()):
+            label = label.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'{self.name}{{{self.labelName}="{label}"}} {count}')
+        return "\n".join(lines)
+
+
+def getRequestName(body: dict) -> str:
+    # Label for a Slack request, the action_id, callback_id or event type
+    requestType = body.get("type")
+    if requestType == "block_actions" and body.get("actions"):
+        return body["actions"][0]["action_id"]
+    elif requestType == "block_suggestion":
+        return body["action_id"]
+    elif requestType in ("view_submission", "view_closed"):
+        return body["view"]["callback_id"]
+    elif requestType == "event_callback":
+        return body["event"]["type"]
+    return requestType or "unknown"
+
+
+ack_latency = Histogram("slack_ack_latency_seconds")
+authorize_latency = Histogram("slack_authorize_latency_seconds")
+request_duration = Histogram("slack_request_duration_seconds", (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, float("inf")))
+db_query_duration = Histogram("db_query_duration_seconds", QUERY_BUCKETS)
+db_queries_per_request = Histogram("db_queries_per_request", COUNT_BUCKETS)
+slack_api_call_duration = Histogram("slack_api_call_duration_seconds")
+slack_api_calls_per_request = Histogram("slack_api_calls_per_request", COUNT_BUCKETS)
+
+duplicate_requests = Counter("slack_duplicate_requests_total")
+
+# Time to warm a timezone's new booking windows at midnight, see rollover.py
+rollover_duration = Histogram("booking_rollover_duration_seconds", labelName="timezone")
+
+# Size of rendered views, see views.check_view_limits
+view_blocks = Histogram("slack_view_blocks", BLOCK_BUCKETS, labelName="view")
+view_bytes = Histogram("slack_view_bytes", BYTE_BUCKETS, labelName="view")
+views_over_limit = Counter("slack_views_over_limit_total", labelName="view")
+
+HISTOGRAMS = (
+    ack_latency,
+    authorize_latency,
+    request_duration,
+    db_query_duration,
+    db_queries_per_request,
+    slack_api_call_duration,
+    slack_api_calls_per_request,
+    view_blocks,
+    view_bytes,
+    rollover_duration,
+)
+
+COUNTERS = (duplicate_requests, views_over_limit)
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in HISTOGRAMS + COUNTERS) + "\n"
+
+
+# Per request stats
+# -----------------------------------
+
+class RequestStats:
+    # Counts the queries and Slack calls made while handling one request
+    # Listener threads started for the request are tracked so the total
+    # duration is recorded once the last of them finishes
+    def __init__(self, name: str):
+        self.name = name
+        self.startTime = time.perf_counter()
+        self.queries = 0
+        self.slackCalls = 0
+        self._pending = 0
+        self._dispatched = False
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self._pending += 1
+
+    def end(self):
+        with self._lock:
+            self._pending -= 1
+        self._finishIfDone()
+
+    def dispatched(self):
+        # Called once every listener for the request has been started
+        with self._lock:
+            self._dispatched = True
+        self._finishIfDone()
+
+    def addQuery(self):
+        with self._lock:
+            self.queries += 1
+
+    def addSlackCall(self):
+        with self._lock:
+            self.slackCalls += 1
+
+    def _finishIfDone(self):
+        with self._lock:
+            if self._finished or not self._dispatched or self._pending > 0:
+                return
+            self._finished = True
+        request_duration.observe(self.name, time.perf_counter() - self.startTime)
+        db_queries_per_request.observe(self.name, self.queries)
+        slack_api_calls_per_request.observe(self.name, self.slackCalls)
+
+
+# The request being handled, copied into listener threads by ContextThreadPoolExecutor
+current_request = contextvars.ContextVar("current_request", default=None)
+
+def _currentRequestName(stats: RequestStats) -> str:
+    # Work done outside a request, like share updates and retention
+    return "background" if stats is None else stats.name
+
+def recordQuery(duration: float):
+    stats = current_request.get()
+    if stats is not None:
+        stats.addQuery()
+    db_query_duration.observe(_currentRequestName(stats), duration)
+
+def recordSlackCall(duration: float):
+    stats = current_request.get()
+    if stats is not None:
+        stats.addSlackCall()
+    slack_api_call_duration.observe(_currentRequestName(stats), duration)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # Runs tasks in the context they were submitted from, and tracks them
+    # against the current request
+    def submit(self, fn, /, *args, **kwargs):
+        context = contextvars.copy_context()
+        stats = context.get(current_request)
+        if stats is not None:
+            stats.begin()
+
+        def run():
+            try:
+                return context.run(fn, *args, **kwargs)
+            finally:
+                if stats is not None:
+                    stats.end()
+
+        return super().submit(run)
+
+
+class InstrumentedWebClient(WebClient):
+    # Every Web API method goes through api_call
+    def api_call(self, *args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return super().api_call(*args, **kwargs)
+        finally:
+            recordSlackCall(time.perf_counter() - startTime)
+
+def instrumentClient(client, clientClass=InstrumentedWebClient):
+    # Copy of a per request client from Bolt that records its calls
+    instrumentedClient = clientClass(
+        token=client.token,
+        base_url=client.base_url,
+        timeout=client.timeout,
+        ssl=client.ssl,
+        proxy=client.proxy,
+        headers=client.headers,
+        retry_handlers=client.retry_handlers,
+    )
+    # Includes the team_id
+    instrumentedClient.default_params = dict(client.default_params)
+    return instrumentedClient
+
+def instrumentEngine(engine):
+    # Time every query through SQLAlchemy engine events
+    @event.listens_for(engine, "before_cursor_execute")
+    def startQueryTimer(connection, cursor, statement, parameters, context, executemany):
+        context._metricsStartTime = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stopQueryTimer(connection, cursor, statement, parameters, context, executemany):
+        recordQuery(time.perf_counter() - context._metricsStartTime)
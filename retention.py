@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+import logging
+import os
+import threading
+import time
+
+import database
+
+# Bookings are kept for a couple of days past their slot, DAILY slots are local
+# dates so this covers every timezone
+BOOKING_RETENTION_DAYS = int(os.environ.get("BOOKING_RETENTION_DAYS", 2))
+
+
+def runRetention() -> dict:
+    # Archive past bookings and remove shares that no longer need updating
+    startTime = time.perf_counter()
+    now = datetime.utcnow()
+    archivedBookings = database.archiveBookings(now - timedelta(days=BOOKING_RETENTION_DAYS))
+    deletedShares = database.deleteStaleShares(now)
+    seconds = time.perf_counter() - startTime
+    logging.info(f"Retention archived {archivedBookings} bookings and deleted {deletedShares} shares in {seconds:.2f}s")
+    return {"archivedBookings": archivedBookings, "deletedShares": deletedShares, "seconds": seconds}
+
+
+def startScheduler(intervalSeconds: int) -> threading.Thread:
+    # Runs the job every interval on a background thread, the first run waits
+    # an interval so it doesn't slow down startup
+    # Every worker process starts one, only the first to claim each interval runs it
+    def run():
+        while True:
+            time.sleep(intervalSeconds)
+            try:
+                now = datetime.utcnow()
+                if database.claimJobRun("retention", now - timedelta(seconds=intervalSeconds / 2), now):
+                    runRetention()
+            except Exception:
+                logging.exception("Retention job failed")
+
+    thread = threading.Thread(target=run, name="retention", daemon=True)
+    thread.start()
+    return thread
+
+
+# Can also be run from cron
+# python retention.py
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    runRetention()
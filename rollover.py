@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import os
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+import database
+import metrics
+import utilities
+
+# Upper bound on how long the scheduler sleeps, so newly seen timezones and
+# ONE-OFF environments are picked up
+MAX_SLEEP_SECONDS = int(os.environ.get("ROLLOVER_MAX_SLEEP_SECONDS", 60 * 5))
+
+
+def runRollover(timeZoneNames: list) -> dict:
+    # Warm the valid bookings cache with the new day's windows for every
+    # booking schedule in use, so the first users after midnight don't pay for it
+    startTime = time.perf_counter()
+    schedules = {}
+    for bookingType, bookingSettings in database.getBookingSchedules():
+        # ONE-OFF windows aren't cached, they're checked against the current time
+        if bookingType != "ONE-OFF":
+            schedules[(bookingType, json.dumps(bookingSettings, sort_keys=True))] = (bookingType, bookingSettings)
+    queryTime = time.perf_counter() - startTime
+
+    for timeZoneName in timeZoneNames:
+        timeZoneStart = time.perf_counter()
+        for bookingType, bookingSettings in schedules.values():
+            utilities.getValidBookings(bookingType, bookingSettings, timeZoneName)
+        metrics.rollover_duration.observe(timeZoneName, queryTime + time.perf_counter() - timeZoneStart)
+
+    seconds = time.perf_counter() - startTime
+    logging.info(f"Rolled over {len(schedules)} booking schedules for {', '.join(timeZoneNames)} in {seconds:.3f}s")
+    return {"schedules": len(schedules), "timeZones": len(timeZoneNames), "seconds": seconds}
+
+
+def expireOneOffEnvironments(since: datetime, now: datetime) -> tuple:
+    # Invalidate the views of resource types with ONE-OFF environments that started
+    # since the last check, so they drop out of cached home tabs straight away
+    # Returns the number expired and the next start time, if any
+    expired = set()
+    lastStart = None
+    nextStart = None
+    for environmentId, resourceTypeId, bookingSettings in database.getOneOffEnvironments():
+        start = datetime.fromtimestamp(bookingSettings["date"], tz=timezone.utc)
+        if since < start <= now:
+            expired.add(resourceTypeId)
+            lastStart = max(start, lastStart or start)
+        elif start > now and (nextStart is None or start < nextStart):
+            nextStart = start
+    # Every worker process checks, only the first past the latest start bumps the versions
+    if len(expired) == 0 or not database.claimJobRun("rollover-expiry", _utcNaive(lastStart), _utcNaive(now)):
+        return 0, nextStart
+    database.bumpResourceTypeVersions(list(expired))
+    logging.info(f"Expired ONE-OFF environments in resource types {sorted(expired)}")
+    return len(expired), nextStart
+
+
+def _utcNaive(moment: datetime) -> datetime:
+    # DateTime columns hold naive UTC
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def nextMidnight(timeZoneName: str, now: datetime) -> datetime:
+    # Start of the next local day, in UTC
+    zone = ZoneInfo(timeZoneName)
+    tomorrow = now.astimezone(zone).date() + timedelta(days=1)
+    return datetime.combine(tomorrow, datetime.min.time(), tzinfo=zone).astimezone(timezone.utc)
+
+
+def startScheduler() -> threading.Thread:
+    # Wakes at each active timezone's local midnight and as ONE-OFF environments start
+    def run():
+        localDates = {}
+        lastCheck = datetime.now(timezone.utc)
+        while True:
+            try:
+                now = datetime.now(timezone.utc)
+                due = []
+                for timeZoneName in sorted(utilities.active_time_zones.copy()):
+                    localDate = now.astimezone(ZoneInfo(timeZoneName)).date()
+                    # Newly seen timezones were warmed by the request that used them
+                    if localDates.setdefault(timeZoneName, localDate) != localDate:
+                        due.append(timeZoneName)
+                        localDates[timeZoneName] = localDate
+                if len(due) > 0:
+                    runRollover(due)
+
+                _, nextStart = expireOneOffEnvironments(lastCheck, now)
+                lastCheck = now
+
+                wakeTimes = [now + timedelta(seconds=MAX_SLEEP_SECONDS)]
+                wakeTimes += [nextMidnight(timeZoneName, now) for timeZoneName in localDates]
+                if nextStart is not None:
+                    wakeTimes.append(nextStart)
+                sleepSeconds = (min(wakeTimes) - datetime.now(timezone.utc)).total_seconds()
+            except Exception:
+                logging.exception("Rollover job failed")
+                sleepSeconds = MAX_SLEEP_SECONDS
+            # Just past the boundary, so the new day is already current
+            time.sleep(max(sleepSeconds, 0) + 1)
+
+    thread = threading.Thread(target=run, name="rollover", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,160 @@
+import os
+import re
+import threading
+
+import cache
+import database
+import utilities
+
+# Slack shows at most 100 options in a select
+MAX_OPTIONS = 100
+# Longer query words are matched against the names of the indexed candidates
+MAX_PREFIX_LENGTH = 10
+
+
+def _words(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+
+class PrefixIndex:
+    # In-memory index of rows by the prefixes of the words in their name, so
+    # "ro" and "room a" both find "Meeting Room A"
+    # Rows are getEnvironments / getResourceTypes rows, id first and name second
+    def __init__(self, rows=()):
+        self.rows = {}
+        self.prefixes = {}
+        # Rows sorted by name, rebuilt on the first search after a change
+        self._sorted = None
+        self._lock = threading.Lock()
+        for row in rows:
+            self._add(tuple(row))
+
+    @staticmethod
+    def _prefixes(name: str) -> set:
+        return {
+            word[:length]
+            for word in _words(name)
+            for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1)
+        }
+
+    def _add(self, row):
+        self._remove(row[0])
+        self._sorted = None
+        self.rows[row[0]] = row
+        for prefix in self._prefixes(row[1]):
+            self.prefixes.setdefault(prefix, set()).add(row[0])
+
+    def _remove(self, rowId):
+        row = self.rows.pop(rowId, None)
+        if row is None:
+            return
+        self._sorted = None
+        for prefix in self._prefixes(row[1]):
+            rowIds = self.prefixes[prefix]
+            rowIds.discard(rowId)
+            if len(rowIds) == 0:
+                del self.prefixes[prefix]
+
+    def add(self, row):
+        # Adds or replaces a row
+        with self._lock:
+            self._add(tuple(row))
+
+    def remove(self, rowId):
+        with self._lock:
+            self._remove(rowId)
+
+    def search(self, query: str) -> list:
+        # Rows where every word of the query starts a word of the name, sorted by name
+        queryWords = _words(query)
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self.rows.values(), key=lambda row: (row[1].lower(), row[0]))
+            if len(queryWords) == 0:
+                matches = self._sorted
+            else:
+                rowIds = set.intersection(*(self.prefixes.get(word[:MAX_PREFIX_LENGTH], set()) for word in queryWords))
+                # Picking a large set out of the sorted rows is quicker than sorting it
+                if len(rowIds) > len(self.rows) // 8:
+                    matches = [row for row in self._sorted if row[0] in rowIds]
+                else:
+                    matches = sorted((self.rows[rowId] for rowId in rowIds), key=lambda row: (row[1].lower(), row[0]))
+
+        longWords = [word for word in queryWords if len(word) > MAX_PREFIX_LENGTH]
+        if len(longWords) > 0:
+            matches = [
+                row for row in matches
+                if all(any(nameWord.startswith(word) for nameWord in _words(row[1])) for word in longWords)
+            ]
+        return matches
+
+
+# Indexes per resource type's environments and per organisation's resource types
+# Changes made by this process update its indexes, other workers reload theirs when they expire
+indexes = cache.TTLCache(
+    maxSize=int(os.environ.get("SEARCH_INDEX_CACHE_SIZE", 1000)),
+    ttl=int(os.environ.get("SEARCH_INDEX_TTL_SECONDS", 60))
+)
+
+def _getIndex(key, load) -> PrefixIndex:
+    index = indexes.get(key)
+    if index is None:
+        index = PrefixIndex(load())
+        indexes.set(key, index)
+    return index
+
+def _updateIndex(key, update):
+    # Only indexes that are already loaded need updating
+    index = indexes.get(key)
+    if index is not None:
+        update(index)
+
+
+# Environments
+# -----------------------------------
+
+
+def searchEnvironments(organisationId: str, resourceTypeId: int, query: str, timeZoneName: str, limit: int = MAX_OPTIONS) -> list:
+    # getEnvironments rows matching the query, expired ones are only filtered out of the matches
+    index = _getIndex(
+        ("environments", organisationId, int(resourceTypeId)),
+        lambda: database.getAllEnvironments(organisationId, resourceTypeId)
+    )
+    result = []
+    for environment in index.search(query):
+        if utilities.getValidBookings(environment[3], environment[4], timeZoneName, environment[0]) is not None:
+            result.append(environment)
+            if len(result) == limit:
+                break
+    return result
+
+def environmentAdded(organisationId: str, resourceTypeId: int, environment):
+    _updateIndex(("environments", organisationId, int(resourceTypeId)), lambda index: index.add(environment))
+
+def environmentModified(organisationId: str, resourceTypeId: int, environmentId: int, name: str, description: str):
+    def update(index):
+        environment = index.rows.get(int(environmentId))
+        if environment is not None:
+            index.add((environment[0], name, description) + environment[3:])
+    _updateIndex(("environments", organisationId, int(resourceTypeId)), update)
+
+def environmentDeleted(organisationId: str, resourceTypeId: int, environmentId: int):
+    _updateIndex(("environments", organisationId, int(resourceTypeId)), lambda index: index.remove(int(environmentId)))
+
+
+# Resource Types
+# -----------------------------------
+
+
+def searchResourceTypes(organisationId: str, query: str, limit: int = MAX_OPTIONS) -> list:
+    # getResourceTypes rows matching the query
+    index = _getIndex(("resourceTypes", organisationId), lambda: database.getResourceTypes(organisationId))
+    return index.search(query)[:limit]
+
+def resourceTypeSaved(organisationId: str, resourceType):
+    # Added or modified
+    _updateIndex(("resourceTypes", organisationId), lambda index: index.add(resourceType))
+
+def resourceTypeDeleted(organisationId: str, resourceTypeId: int):
+    _updateIndex(("resourceTypes", organisationId), lambda index: index.remove(int(resourceTypeId)))
+    indexes.invalidate(("environments", organisationId, int(resourceTypeId)))
@@ -1,8 +1,15 @@
-from datetime import datetime, timedelta, timezone
+from array import array
+import calendar
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+import functools
+import json
+import os
 import time
 
-# Jinja2 methods
+import cache
+
+# Booking helpers
 def userHasBooking(bookings, userId):
     for booking in bookings:
         if booking[2] == userId:
@@ -12,6 +19,46 @@ def userHasBooking(bookings, userId):
 def numberBookingsRemaining(bookings, numberBookingsAllowed):
     return numberBookingsAllowed - len(bookings)
 
+class Availability:
+    # Remaining places and the user's own bookings for a set of environments' slots, computed
+    # in one pass and packed one row per environment in the order of its valid booking keys
+    # Views read whole rows instead of checking each slot's bookings
+    __slots__ = ("remaining", "mine", "_rows")
+
+    def __init__(self, environments, bookings: dict, userId: str = None):
+        # environments are (environmentId, maximumUsers, validBookingKeys)
+        # bookings are grouped by environmentId and then bookingKey, see database.getEnvironmentBookings
+        self.remaining = array("l")
+        self.mine = bytearray()
+        self._rows = {}
+        # Column of each key, environments sharing a schedule share the valid booking keys dict
+        columns = {}
+        for environmentId, maximumUsers, validBookingKeys in environments:
+            bookingKeys = validBookingKeys or {}
+            start = len(self.remaining)
+            # Every slot starts free, then only the booked ones are touched
+            self.remaining.extend(array("l", (maximumUsers,)) * len(bookingKeys))
+            self.mine.extend(bytes(len(bookingKeys)))
+            self._rows[environmentId] = (start, len(self.remaining))
+            environmentBookings = bookings.get(environmentId)
+            if not bookingKeys or not environmentBookings:
+                continue
+            column = columns.get(id(bookingKeys))
+            if column is None:
+                column = columns[id(bookingKeys)] = {bookingKey: index for index, bookingKey in enumerate(bookingKeys)}
+            for bookingKey, slotBookings in environmentBookings.items():
+                index = column.get(bookingKey)
+                if index is None:
+                    continue
+                self.remaining[start + index] -= len(slotBookings)
+                if userId is not None and userHasBooking(slotBookings, userId):
+                    self.mine[start + index] = 1
+
+    def row(self, environmentId) -> tuple:
+        # The environment's remaining places and own booking flags, one per valid booking key
+        start, end = self._rows[environmentId]
+        return self.remaining[start:end], self.mine[start:end]
+
 def truncateString(inputStr: str) -> str:
     if len(inputStr) >= 24:
         inputStr = f"{inputStr[:22]}.."
@@ -20,30 +67,134 @@ def truncateString(inputStr: str) -> str:
 def getCurrentTime():
     return int(time.time())
 
+# Names used in booking labels, as strftime's %a and %B
+DAY_NAMES = tuple(calendar.day_abbr)
+MONTH_NAMES = tuple(calendar.month_name)
+
+class BookingSchedule:
+    # Booking settings parsed once, CUSTOM times are minutes past local midnight
+    __slots__ = ("bookingType", "numberDaysAdvance", "minutes", "date", "key")
+
+    def __init__(self, bookingType: str, bookingSettings: dict):
+        self.bookingType = bookingType
+        self.numberDaysAdvance = 0
+        self.minutes = array("H")
+        self.date = None
+        if bookingType == "ONE-OFF":
+            self.date = int(bookingSettings["date"])
+        elif bookingType in ("DAILY", "CUSTOM"):
+            self.numberDaysAdvance = int(bookingSettings["numberDaysAdvance"])
+            for bookingTime in bookingSettings.get("bookingTimes", []) if bookingType == "CUSTOM" else []:
+                hours, minutes = (int(part) for part in bookingTime.split(":"))
+                if not (0 <= hours < 24 and 0 <= minutes < 60):
+                    raise ValueError(f"Invalid booking time {bookingTime}")
+                self.minutes.append(hours * 60 + minutes)
+        else:
+            raise ValueError(f"Unknown booking type {bookingType}")
+        # Hashable stand in for the settings in cache keys
+        self.key = (bookingType, self.numberDaysAdvance, self.minutes.tobytes(), self.date)
+
+# Compiled schedules by environment id, or by settings when there's no id
+# Settings can't be changed, the stored settings are compared in case an id is reused
+schedule_cache = cache.TTLCache(maxSize=int(os.environ.get("SCHEDULE_CACHE_SIZE", 10000)), ttl=60 * 60 * 24)
+
+def getSchedule(bookingType, bookingSettings, environmentId=None) -> BookingSchedule:
+    cacheKey = environmentId if environmentId is not None else (bookingType, json.dumps(bookingSettings, sort_keys=True))
+    cached = schedule_cache.get(cacheKey)
+    if cached is not None and cached[0] == bookingType and cached[1] == bookingSettings:
+        return cached[2]
+    schedule = BookingSchedule(bookingType, bookingSettings)
+    schedule_cache.set(cacheKey, (bookingType, bookingSettings, schedule))
+    return schedule
+
+# Valid bookings only change when the local date rolls over, so they're cached
+# against the schedule, timezone and local date
+# Rollover warms one entry per schedule per timezone, size it to hold them all
+valid_bookings_cache = cache.TTLCache(maxSize=int(os.environ.get("VALID_BOOKINGS_CACHE_SIZE", 4096)), ttl=60 * 60 * 24)
+
+# Timezones bookings have been shown in, rolled over at their midnight by rollover.py
+active_time_zones = set()
+
 # Get list of the valid booking types for the current enviromment config
-# Returned as key value pairs
-def getValidBookings(bookingType, bookingSettings, tzName) -> dict[str]:
-    if bookingType == "DAILY":
-        result = {}
-        for day in getNextNDays(bookingSettings["numberDaysAdvance"], tzName):
-            result[day.strftime('%Y-%m-%d')] = day.strftime('%a, %d %B')
-        return result
-    elif bookingType == "ONE-OFF":
-        bookingKey = datetime.utcfromtimestamp(bookingSettings["date"])
-        bookingDate = datetime.fromtimestamp(bookingSettings["date"], tz=ZoneInfo(tzName))
-        currentDateTime = datetime.now(tz=ZoneInfo(tzName))
+# Returned as key value pairs, shared between callers so must not be modified
+# Pass the environment id to reuse its compiled schedule
+def getValidBookings(bookingType, bookingSettings, tzName, environmentId=None) -> dict[str]:
+    active_time_zones.add(tzName)
+    schedule = getSchedule(bookingType, bookingSettings, environmentId)
+    # ONE-OFF bookings expire at their start time rather than at midnight
+    if bookingType == "ONE-OFF":
+        return generateValidBookings(schedule, tzName)
+
+    localDate = datetime.now(ZoneInfo(tzName)).date()
+    cacheKey = (schedule.key, tzName, localDate)
+    result = valid_bookings_cache.get(cacheKey)
+    if result is None:
+        result = generateValidBookings(schedule, tzName)
+        valid_bookings_cache.set(cacheKey, result)
+    return result
+
+@functools.lru_cache(maxsize=4096)
+def _dateStrings(ordinal: int) -> tuple:
+    # Booking key and label for a date, as strftime('%Y-%m-%d') and strftime('%a, %d %B')
+    day = date.fromordinal(ordinal)
+    return (
+        f"{day.year:04d}-{day.month:02d}-{day.day:02d}",
+        f"{DAY_NAMES[day.weekday()]}, {day.day:02d} {MONTH_NAMES[day.month]}",
+    )
+
+@functools.lru_cache(maxsize=4096)
+def _utcOffsetMinutes(tzName: str, ordinal: int):
+    # Offset for the whole of a local date, None if it changes during the day or isn't whole minutes
+    zone = ZoneInfo(tzName)
+    day = date.fromordinal(ordinal)
+    nextDay = date.fromordinal(ordinal + 1)
+    offset = datetime(day.year, day.month, day.day, tzinfo=zone).utcoffset()
+    if offset != datetime(nextDay.year, nextDay.month, nextDay.day, tzinfo=zone).utcoffset() or offset % timedelta(minutes=1):
+        return None
+    return offset // timedelta(minutes=1)
+
+def generateValidBookings(schedule: BookingSchedule, tzName, now: datetime = None) -> dict[str]:
+    # now defaults to the current time, benchmark.py checks other dates against the datetime version
+    zone = ZoneInfo(tzName)
+    currentDateTime = datetime.now(tz=zone) if now is None else now.astimezone(zone)
+    if schedule.bookingType == "ONE-OFF":
+        bookingKey = datetime.utcfromtimestamp(schedule.date)
+        bookingDate = datetime.fromtimestamp(schedule.date, tz=zone)
         if bookingDate >= currentDateTime:
             return {bookingKey.strftime('%Y-%m-%d %H:%M') : bookingDate.strftime('%a, %d %B %H:%M')}
         else:
             return None
-    elif bookingType == "CUSTOM":
-        results = {}
-        for day in getNextNDays(bookingSettings["numberDaysAdvance"], tzName):
-            for bookingTime in bookingSettings['bookingTimes']:
-                hours, minutes = bookingTime.split(":")
-                result = day + timedelta(hours=int(hours), minutes=int(minutes))
-                results[result.astimezone(tz=timezone.utc).strftime('%Y-%m-%d %H:%M')] = result.strftime('%a, %d %B %H:%M')
-        return results
+
+    # Today and the following days, always at least today
+    today = currentDateTime.date().toordinal()
+    days = range(today, today + max(schedule.numberDaysAdvance, 1))
+    if schedule.bookingType == "DAILY":
+        return dict(_dateStrings(day) for day in days)
+
+    results = {}
+    for day in days:
+        label = _dateStrings(day)[1]
+        offsetMinutes = _utcOffsetMinutes(tzName, day)
+        if offsetMinutes is None:
+            # Days the offset changes on go through datetime
+            localDay = date.fromordinal(day)
+            midnight = datetime(localDay.year, localDay.month, localDay.day, tzinfo=zone)
+            for minutes in schedule.minutes:
+                result = midnight + timedelta(minutes=minutes)
+                results[result.astimezone(tz=timezone.utc).strftime('%Y-%m-%d %H:%M')] = f"{label} {minutes // 60:02d}:{minutes % 60:02d}"
+            continue
+        # Booking times are local, so their UTC key is the time less the day's offset
+        for minutes in schedule.minutes:
+            dayShift, utcMinutes = divmod(minutes - offsetMinutes, 24 * 60)
+            results[f"{_dateStrings(day + dayShift)[0]} {utcMinutes // 60:02d}:{utcMinutes % 60:02d}"] = f"{label} {minutes // 60:02d}:{minutes % 60:02d}"
+    return results
+
+def getBookingSlot(bookingKey: str) -> datetime:
+    # Typed slot start for a booking key
+    # CUSTOM and ONE-OFF keys are UTC times, DAILY keys are dates
+    if len(bookingKey) == 10:
+        return datetime.strptime(bookingKey, '%Y-%m-%d')
+    return datetime.strptime(bookingKey, '%Y-%m-%d %H:%M')
 
 def databaseResultToDict(input_rows, id):
     # Turn the n-th item to the dictionary key
@@ -55,15 +206,58 @@ def databaseResultToDict(input_rows, id):
             result[row[id]] = [row]
     return result
 
-def getNextNDays(num_days, tzName):
-    # Get the set of dates that can be booked in app
-    # Using users timezone
-    today = datetime.now(ZoneInfo(tzName)).replace(hour=0, minute=0, second=0, microsecond=0)
-    valid_days = [today]
-    for i in range(1, num_days):
-        result = today + timedelta(days=i)
-        valid_days.append(result.replace(hour=0, minute=0, second=0, microsecond=0))
-    return valid_days
-
 def extractBlockIdString(blocks, targetString):
     return list(filter(lambda x: targetString in x, blocks.keys()))[0].replace(targetString, "")
+
+def getEnvironmentTimes(bodyState):
+    bookingTimes = []
+    for envKey in bodyState.keys():
+        if "env_custom_time" in envKey:
+            newTime = bodyState[envKey]['environment-custom-timepicker-change']['selected_time']
+            bookingTimes.append(newTime)
+    return bookingTimes
+
+# Booking settings from the add environment modal, along with any validation errors
+def getBookingSettings(bookingType, stateData):
+    booking_settings = {}
+    if bookingType == "DAILY":
+        booking_settings = {
+            "numberDaysAdvance": int(
+                stateData["env_num_days"]["number_input-action"]["value"]
+            )
+        }
+    elif bookingType == "ONE-OFF":
+        # Check booking date isn't in the past
+        oneOffDate = stateData["env_oneoff_date"]["datepicker-action"]["selected_date_time"]
+        oneOffDateTime = datetime.fromtimestamp(oneOffDate)
+        currentDateTime = datetime.now()
+        if oneOffDateTime <= currentDateTime:
+            print(f"ONE-OFF booking is in the past {oneOffDateTime}")
+            errors = {
+                "env_oneoff_date":  "Cannot create bookings in the past"
+            }
+            return None, errors
+        
+        booking_settings = {
+            "date": stateData["env_oneoff_date"]["datepicker-action"]["selected_date_time"]
+        }
+    elif bookingType == "CUSTOM":
+        # Timepicker handling
+        bookingTimes = getEnvironmentTimes(stateData)
+        # Raise an error if any bookingTimes have duplicates
+        if len(bookingTimes) != len(set(bookingTimes)):
+            # TODO: Work out a way to display these errors on the home screen
+            # Got a problem with inputs currently
+            print("Duplicates found")
+            errors = {
+                "env_custom_time_1":  "Duplicate times are not allowed"
+            }
+            return None, errors
+        # 
+        booking_settings = {
+            "bookingTimes": bookingTimes,
+            "numberDaysAdvance": int(
+                stateData["env_num_days"]["number_input-action"]["value"]
+            )
+        }
+    return booking_settings, None
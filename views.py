@@ -1,125 +1,257 @@
 import copy
+import jinja2
+import json
+import logging
+import math
+import orjson
+import os
 import uuid
 
+import database
+import metrics
 import utilities
 
-ENVIRONMENT_HEADER = {
-    "type": "header",
-    "text": {"type": "plain_text", "text": "undefined"},
-}
-
-ENVIRONMENT_SECTION = {
-    "type": "section",
-    "text": {"type": "mrkdwn", "text": ""},
-    "accessory": {
-        "type": "button",
-        "text": {"type": "plain_text", "text": "Book", "emoji": True},
-        "value": "undefined",
-        "action_id": "button-book-clicked",
-    },
-}
+# Slack rejects views with more than 100 blocks, or section text over 3000 characters
+MAX_VIEW_BLOCKS = 100
+MAX_SECTION_TEXT = 3000
 
+# Environments per page of the home tab, two blocks each
+# Capped so a page plus the other home blocks stays under MAX_VIEW_BLOCKS
+HOME_PAGE_SIZE = min(int(os.environ.get("HOME_PAGE_SIZE", 20)), 40)
 
-def generateBookingStr(date, environmentId, bookings):
-    bookingStr = ""
-    booking = list(
-        filter(lambda x: x[0] == int(environmentId) and x[1] == date, bookings)
-    )
-    if len(booking) > 0:
-        bookingStr += f"- {str(date)} - Booked by <@{booking[0][2]}>\n"
-    else:
-        bookingStr += f"- {str(date)} - :sailboat: Free\n"
-    return bookingStr
+# Preload templates
+delete_enviroment_template = json.load(open("templates/deleteEnvironment.json", "r"))
+modify_enviroment_template = json.load(open("templates/modifyEnvironment.json", "r"))
+error_template = json.load(open("templates/errorPage.json", "r"))
 
+jinja_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"), autoescape=jinja2.select_autoescape()
+)
+jinja_env.globals.update({
+    "getCurrentTime" : utilities.getCurrentTime()
+})
 
-def generate_booking_list(environmentId, bookings, userId):
-    GENERATED_MARKUP = []
-    valid_dates = utilities.getNextNDays(2)
-    for date in valid_dates:
-        bookingStr = generateBookingStr(date, environmentId, bookings)
-        booking = list(
-            filter(lambda x: x[0] == int(environmentId) and x[1] == date, bookings)
-        )
-        if len(booking) > 0:
-            if booking[0][2] == userId:
-                GENERATED_MARKUP.append(
-                    {
-                        "type": "section",
-                        "block_id": f"{str(date)}",
-                        "text": {"type": "mrkdwn", "text": bookingStr},
-                        "accessory": {
-                            "type": "button",
-                            "text": {
-                                "type": "plain_text",
-                                "text": "Remove Booking",
-                                "emoji": True,
-                            },
-                            "value": f"{str(environmentId)}",
-                            "action_id": "remove-booking",
-                        },
-                    }
-                )
-            else:
-                GENERATED_MARKUP.append(
-                    {
-                        "type": "section",
-                        "block_id": f"booking-section-{str(date)}",
-                        "text": {"type": "mrkdwn", "text": bookingStr},
-                    }
-                )
+add_env_template = jinja_env.get_template("addEnvironment.json")
+share_env_template = jinja_env.get_template("shareEnvironment.json")
+manage_settings_template = jinja_env.get_template("manageSettings.json")
+add_resource_type_template = jinja_env.get_template("addResourceType.json")
+modify_resource_type_template = jinja_env.get_template("modifyResourceType.json")
+delete_resource_type_template = jinja_env.get_template("deleteResourceType.json")
+
+
+def serialize(view) -> str:
+    # Views are built as dicts and serialised once before being sent to Slack
+    return orjson.dumps(view).decode()
+
+
+def truncate(text: str, length: int, killwords: bool = False, end: str = "...", leeway: int = 5) -> str:
+    # Same behaviour as the Jinja truncate filter used by the old templates
+    if len(text) <= length + leeway:
+        return text
+    if killwords:
+        return text[: length - len(end)] + end
+    return text[: length - len(end)].rsplit(" ", 1)[0] + end
+
+
+def plain_text(text: str, emoji: bool = True) -> dict:
+    return {"type": "plain_text", "text": text, "emoji": emoji}
+
+
+def button(text: str, value: str, actionId: str, style: str = None) -> dict:
+    result = {"type": "button", "text": plain_text(text), "value": value, "action_id": actionId}
+    if style:
+        result["style"] = style
+    return result
+
+
+def generate_bookings_text(description, bookings, validBookingKeys, remaining, maximumUsers) -> str:
+    # Description followed by one line per slot listing who has booked it
+    # remaining is the environment's Availability row
+    lines = [description or ""]
+    for (bookingKey, bookingLabel), slotRemaining in zip((validBookingKeys or {}).items(), remaining):
+        if slotRemaining < maximumUsers:
+            users = "".join(f"<@{booking[2]}> " for booking in bookings[bookingKey])
         else:
-            GENERATED_MARKUP.append(
+            users = ":free:"
+        lines.append(f"- {bookingLabel} {users}")
+    return truncate("\n".join(lines), MAX_SECTION_TEXT - 1, killwords=True, leeway=0) + "\n"
+
+
+def generate_home_view(
+    resourceTypesData, resourceTypeId=None, resourceTypeName=None, resourceTypeDescription=None, environments=[], isAdmin=False,
+    page=0, pageCount=1
+) -> dict:
+    # environments are the page's getEnvironments rows with bookings and valid booking keys appended
+    blocks = [{"type": "section", "text": plain_text("I'd like to book ...")}]
+
+    if len(resourceTypesData) == 0:
+        blocks.append({"type": "section", "text": plain_text("Open \"Settings :gear:\" to start configuring your bookings!")})
+    else:
+        resourceTypeOptions = [
+            {"text": plain_text(resourceType[1]), "value": str(resourceType[0])}
+            for resourceType in resourceTypesData
+        ]
+        resourceTypeSelect = {
+            "type": "static_select",
+            "placeholder": plain_text("Select options"),
+            "options": resourceTypeOptions,
+            "action_id": "modify-resourcetype-select",
+        }
+        for resourceType, option in zip(resourceTypesData, resourceTypeOptions):
+            if resourceType[0] == resourceTypeId:
+                resourceTypeSelect["initial_option"] = option
+        blocks += [
+            {"type": "actions", "block_id": "resourcetype", "elements": [resourceTypeSelect]},
+            {"type": "section", "text": plain_text(resourceTypeDescription or "  ")},
+            {"type": "divider"},
+        ]
+
+        availability = utilities.Availability(
+            [(environment[0], environment[5], environment[7]) for environment in environments],
+            {environment[0]: environment[6] for environment in environments}
+        )
+        for environment in environments:
+            remaining, _ = availability.row(environment[0])
+            blocks += [
+                {"type": "header", "text": {"type": "plain_text", "text": f"# {environment[1]}"}},
                 {
                     "type": "section",
-                    "block_id": f"{str(date)}",
-                    "text": {"type": "mrkdwn", "text": bookingStr},
-                    "accessory": {
-                        "type": "button",
-                        "text": {"type": "plain_text", "text": "Book", "emoji": True},
-                        "value": f"{str(environmentId)}",
-                        "action_id": "create-booking",
-                    },
-                }
-            )
-    return GENERATED_MARKUP
+                    "text": {"type": "mrkdwn", "text": generate_bookings_text(environment[2], environment[6], environment[7], remaining, environment[5])},
+                    "accessory": button(f"Book {truncate(environment[1], 24)}", str(environment[0]), "button-book-clicked"),
+                },
+            ]
 
+        if pageCount > 1:
+            pageButtons = []
+            if page > 0:
+                pageButtons.append(button(":arrow_left: Previous", f"{resourceTypeId},{page - 1}", "home-page-previous"))
+            if page < pageCount - 1:
+                pageButtons.append(button("Next :arrow_right:", f"{resourceTypeId},{page + 1}", "home-page-next"))
+            blocks += [
+                {"type": "context", "elements": [plain_text(f"Page {page + 1} of {pageCount}")]},
+                {"type": "actions", "block_id": "page_block", "elements": pageButtons},
+            ]
 
-def generate_environment_options(environments):
-    GENERATED_MARKUP = []
-    for environment in environments:
-        GENERATED_MARKUP.append(
-            {
-                "text": {"type": "plain_text", "text": environment[1], "emoji": True},
-                "value": str(environment[0]),
-            }
-        )
-    return GENERATED_MARKUP
+        buttonValue = f"{resourceTypeId},{resourceTypeName}"
+        shortName = truncate(resourceTypeName, 20, killwords=True)
+        if len(environments) == 0:
+            blocks.append({
+                "type": "section",
+                "text": plain_text(
+                    f"Try creating some {resourceTypeName} using \"{resourceTypeName} :heavy_plus_sign:\" below\n"
+                    "These are the specific items users can book for the current Resource Type :card_file_box:\n"
+                    "For example\n - Meeting Room A.1\n - Company Lexus AB12 9AB\n - LoadTest-Environment-1\n"
+                ),
+            })
+        else:
+            blocks.append({
+                "type": "actions",
+                "block_id": "share_block",
+                "elements": [button(f"Share {shortName} :arrow_upper_right:", buttonValue, "button-share-environment")],
+            })
+
+        if isAdmin:
+            adminButtons = [button(f"Add {shortName} :heavy_plus_sign:", buttonValue, "button-add-environment", "primary")]
+            if len(environments) > 0:
+                adminButtons += [
+                    button(f"Modify {shortName} :pencil:", buttonValue, "button-modify-environment"),
+                    button(f"Delete {shortName} ❌", buttonValue, "button-delete-environment", "danger"),
+                ]
+            blocks.append({"type": "actions", "block_id": "buttons_block", "elements": adminButtons})
+
+        blocks.append({"type": "divider"})
 
+    blocks.append({
+        "type": "actions",
+        "elements": [
+            button("My bookings :calendar:", "click_my_bookings", "button-my-bookings"),
+            button("Settings :gear:", "click_manage_settings", "button-manage-settings"),
+        ],
+    })
+    return {"type": "home", "blocks": blocks}
+
+
+def generate_booking_modal(environment, resourceTypeId, userId) -> dict:
+    # environment is a getEnvironment row with bookings and valid booking keys appended
+    bookings = environment[7]
+    remainingRow, mineRow = utilities.Availability([(environment[0], environment[6], environment[8])], {environment[0]: bookings}, userId).row(environment[0])
+    blocks = []
+    for (bookingKey, bookingLabel), remaining, hasBooking in zip((environment[8] or {}).items(), remainingRow, mineRow):
+        users = "".join(f" <@{booking[2]}> " for booking in bookings.get(bookingKey, ()))
+        block = {
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": f"{bookingLabel}\n- {users}\n{remaining} remaining"},
+            "block_id": bookingKey,
+        }
+        if remaining > 0 or hasBooking:
+            if hasBooking:
+                block["accessory"] = button("Remove Booking", str(environment[0]), "remove-booking")
+            else:
+                block["accessory"] = button("Add Booking", str(environment[0]), "create-booking")
+        blocks.append(block)
+
+    return {
+        "type": "modal",
+        "callback_id": "add-booking",
+        "private_metadata": f"{resourceTypeId},{environment[0]}",
+        "title": plain_text(f"Book {truncate(environment[1], 16, True, '..', 0)}"),
+        "submit": plain_text("Done"),
+        "close": plain_text("Cancel"),
+        "blocks": blocks,
+    }
+
+
+def generate_booking_share_message(environment) -> list:
+    # environment is a getEnvironment row with bookings and valid booking keys appended
+    remaining, _ = utilities.Availability([(environment[0], environment[6], environment[8])], {environment[0]: environment[7]}).row(environment[0])
+    return [
+        {"type": "header", "text": plain_text(f"# {environment[1]}")},
+        {
+            "type": "section",
+            "block_id": "env_id",
+            "text": {"type": "mrkdwn", "text": generate_bookings_text(environment[2], environment[7], environment[8], remaining, environment[6])},
+            "accessory": button("Book", str(environment[0]), "message-button-book-clicked"),
+        },
+    ]
 
-def generate_environment_list(environments, bookings):
-    GENERATED_MARKUP = []
-    for environment in environments:
-        newHeaderSection = copy.deepcopy(ENVIRONMENT_HEADER)
-        newHeaderSection["text"]["text"] = f"# {environment[1]}"
-        GENERATED_MARKUP.append(newHeaderSection)
+def get_my_bookings(organisationId, userId, timeZoneName: str, fresh: bool = False) -> list:
+    # The user's upcoming bookings with their labels, dropping any that have passed
+    # Rows are getUserBookings rows with the booking label appended
+    result = []
+    for booking in database.getUserBookings(organisationId, userId, fresh):
+        validBookingKeys = utilities.getValidBookings(booking[4], booking[5], timeZoneName, booking[0])
+        if validBookingKeys and booking[6] in validBookingKeys:
+            result.append(tuple(booking) + (validBookingKeys[booking[6]],))
+    return result
 
-        newEnvironmentSection = copy.deepcopy(ENVIRONMENT_SECTION)
 
-        valid_dates = utilities.getNextNDays(2)
-        bookingStr = ""
-        # If defined as description test for environment
-        if environment[2]:
-            bookingStr += f"{environment[2]}\n\n"
+def generate_my_bookings_modal(bookings) -> dict:
+    # bookings are get_my_bookings rows, each cancelled without leaving the modal
+    blocks = []
+    for booking in bookings[:MAX_VIEW_BLOCKS - 1]:
+        blocks.append({
+            "type": "section",
+            "text": {"type": "mrkdwn", "text": f"*{booking[1]}* ({booking[3]})\n{booking[7]}"},
+            "accessory": button("Cancel", f"{booking[2]},{booking[0]},{booking[6]}", "my-bookings-cancel", "danger"),
+        })
+    if len(bookings) > len(blocks):
+        blocks.append({"type": "context", "elements": [plain_text(f"and {len(bookings) - len(blocks)} more")]})
+    if len(bookings) == 0:
+        blocks.append({"type": "section", "text": plain_text("You have no upcoming bookings")})
 
-        for date in valid_dates:
-            bookingStr += generateBookingStr(date, environment[0], bookings)
+    return {
+        "type": "modal",
+        "callback_id": "my-bookings",
+        "title": plain_text("My bookings"),
+        "close": plain_text("Close"),
+        "blocks": blocks,
+    }
 
-        newEnvironmentSection["text"]["text"] = bookingStr
-        newEnvironmentSection["accessory"]["text"]["text"] = f"Book {environment[1]}"
-        newEnvironmentSection["accessory"]["value"] = str(environment[0])
-        GENERATED_MARKUP.append(newEnvironmentSection)
 
-    return GENERATED_MARKUP
+def generate_select_options(rows) -> list:
+    # Options for an external_select from getEnvironments or getResourceTypes rows
+    # Slack limits option text to 75 characters
+    return [{"text": plain_text(truncate(row[1], 75, leeway=0)), "value": str(row[0])} for row in rows]
 
 
 MODIFY_ENVIRONMENT_SECTION = [
@@ -175,4 +307,97 @@ def generateResourceTypeDescription(descriptionText):
                 "emoji": True
             }
         ]
-    }
\ No newline at end of file
+    }
+
+
+def check_view_limits(name: str, view: dict, result: str):
+    # Track the size of views against Slack's limits, Slack rejects the whole view when one is exceeded
+    metrics.view_blocks.observe(name, len(view["blocks"]))
+    metrics.view_bytes.observe(name, len(result))
+    if len(view["blocks"]) > MAX_VIEW_BLOCKS:
+        metrics.views_over_limit.inc(name)
+        logging.warning(f"{name} view has {len(view['blocks'])} blocks, over Slack's limit of {MAX_VIEW_BLOCKS}")
+
+
+def render_home_template(organisationId, userId, resourceTypeId: int = None, timeZoneName: str = None, page: int = 0, environmentId: int = None):
+    # Returns the rendered home view and the bookings loaded for it
+    # Only the page of environments shown is rendered, the page with environmentId if it's given
+    resourceTypesData = list(database.getResourceTypes(organisationId))
+
+    # If no resources have been defined yet
+    if len(resourceTypesData) == 0:
+        view = generate_home_view([])
+        result = serialize(view)
+        check_view_limits("home", view, result)
+        return result, None
+    
+    else:
+
+        if resourceTypeId is None:
+            resourceTypeId = resourceTypesData[0][0]
+        resourceTypeId = int(resourceTypeId)
+
+        resourceTypeData = next(
+            (
+                resourceType
+                for resourceType in resourceTypesData
+                if resourceType[0] == resourceTypeId
+            ),
+            None,
+        )
+        environments = list(database.getEnvironments(organisationId, resourceTypeId, timeZoneName))
+
+        # If no environments have been defined yet
+        if len(environments) == 0:
+            view = generate_home_view(
+                resourceTypesData,
+                resourceTypeId,
+                resourceTypeData[1],
+                resourceTypeData[2],
+                isAdmin = userId in resourceTypeData[3]
+            )
+            result = serialize(view)
+            check_view_limits("home", view, result)
+            return result, None
+        
+        else:
+            pageCount = math.ceil(len(environments) / HOME_PAGE_SIZE)
+            if environmentId is not None:
+                page = next(
+                    (index // HOME_PAGE_SIZE for index, environment in enumerate(environments) if environment[0] == int(environmentId)),
+                    page
+                )
+            page = min(max(int(page), 0), pageCount - 1)
+            environments = environments[page * HOME_PAGE_SIZE:(page + 1) * HOME_PAGE_SIZE]
+
+            validBookingKeys = {
+                environment[0]: utilities.getValidBookings(environment[3], environment[4], timeZoneName, environment[0])
+                for environment in environments
+            }
+            # Get the bookings for the page's environments at once, and append them to the object
+            environmentBookings = database.getEnvironmentBookings(validBookingKeys)
+            for index, environment in enumerate(environments):
+                environments[index] = tuple(environment) + (environmentBookings[environment[0]], validBookingKeys[environment[0]])
+
+            view = generate_home_view(
+                resourceTypesData,
+                resourceTypeId,
+                resourceTypeData[1],
+                resourceTypeData[2],
+                environments,
+                isAdmin = userId in resourceTypeData[3],
+                page = page,
+                pageCount = pageCount
+            )
+            result = serialize(view)
+            check_view_limits("home", view, result)
+
+            return result, environmentBookings
+
+
+def get_environment_with_bookings(environmentId, timeZoneName: str):
+    # getEnvironment row with its bookings and valid booking keys appended
+    environment = database.getEnvironment(environmentId)
+    validBookingKeys = utilities.getValidBookings(environment[4], environment[5], timeZoneName, environment[0])
+    bookings = database.getEnvironmentBookings({environment[0]: validBookingKeys})[environment[0]]
+    return tuple(environment) + (bookings, validBookingKeys)